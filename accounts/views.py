@@ -1,6 +1,6 @@
 from django.contrib.auth.decorators import login_required
-from django.db.models import Q
-from django.http import HttpResponse
+from django.db.models import Count, Q
+from django.http import HttpResponse, HttpResponseBadRequest
 from django.shortcuts import get_object_or_404, render, redirect
 from django.views.generic import ListView
 
@@ -9,6 +9,8 @@ from accounts.forms import AccountForm
 
 from datasets.models import Dataset
 
+from main.listing import dataset_listing, keyset_page, next_query
+
 """
 All these views can probably be refactored into django's class views
 they are no longer doing very special things, most of the special things
@@ -17,10 +19,26 @@ to figure out how to put page queries from templates into these views
 """
 
 class AccountList(ListView):
+    """
+    A page at a time, by account_slug, see main/listing.py. The datasets
+    are counted in the same query.
+    """
     model = Account
     context_object_name = "account_list"
     template_name = "accounts/account_list.html"
 
+    def get(self, request, *args, **kwargs):
+        try:
+            self.object_list, cursor = keyset_page(
+                Account.objects.select_related("user").annotate(
+                    dataset_count=Count("datasets")),
+                ("account_slug", "pk"), request.GET.get("cursor"))
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+        context = self.get_context_data(
+            next_cursor=cursor, next_query=next_query(request, cursor))
+        return self.render_to_response(context)
+
 
 #def account_list(request):
 #    '''
@@ -90,15 +108,15 @@ def account_remove(request, account_slug=None):
 # this can probably be refactored
 def account_detail(request, account_slug=None):
     account = get_object_or_404(Account, account_slug=account_slug)
-    d = Dataset.objects.filter(account=account)
+    d = Dataset.objects.filter(account=account).select_related("account__user")
 
     if "q" in request.GET:
         q = request.GET["q"]
         dataset_list = d.filter(
-            Q(title__icontains=q) | Q(author__icontains=q)).order_by("title")
+            Q(title__icontains=q) | Q(author__icontains=q))
     else:
-        dataset_list = d.order_by("title")
+        dataset_list = d
 
     template_name = "accounts/account_detail.html"
-    return render(request, template_name,
-                  context={"account": account, "dataset_list": dataset_list})
+    return dataset_listing(request, dataset_list, template_name,
+                           {"account": account})
@@ -0,0 +1,64 @@
+"""
+Counting how often each dataset's file is loaded, so that the
+refresh_datasets command can keep the popular ones warm first.
+
+Writing to the database on every map view would cost more than it's worth,
+so the counts are added up in memory and written out at most every
+DATASET_ACCESS_FLUSH_INTERVAL seconds, as one UPDATE per dataset. Whatever
+wasn't written out yet is lost when the process stops, that's fine for
+something that only decides an order.
+"""
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from datasets.models import Dataset
+
+import threading
+import time
+
+
+_lock = threading.Lock()
+_counts = {}
+_flushed_at = time.time()
+
+
+def record_access(pk):
+    global _flushed_at
+    with _lock:
+        _counts[pk] = _counts.get(pk, 0) + 1
+        due = (time.time() - _flushed_at >=
+               settings.DATASET_ACCESS_FLUSH_INTERVAL)
+        if due:
+            counts = dict(_counts)
+            _counts.clear()
+            _flushed_at = time.time()
+    if due:
+        _write(counts)
+
+
+def flush():
+    """
+    Writes out everything that was counted so far.
+    """
+    global _flushed_at
+    with _lock:
+        counts = dict(_counts)
+        _counts.clear()
+        _flushed_at = time.time()
+    _write(counts)
+
+
+def forget():
+    """
+    Drops what was counted and not written out yet.
+    """
+    with _lock:
+        _counts.clear()
+
+
+def _write(counts):
+    now = timezone.now()
+    for pk, count in counts.items():
+        Dataset.objects.filter(pk=pk).update(
+            access_count=F("access_count") + count, last_accessed=now)
@@ -1,5 +1,11 @@
 from django.apps import AppConfig
+from django.core import checks
 
 
 class DatasetsConfig(AppConfig):
     name = "datasets"
+
+    def ready(self):
+        from datasets.checks import check_lock_cache, check_page_cache
+        checks.register(check_page_cache, checks.Tags.caches)
+        checks.register(check_lock_cache, checks.Tags.caches)
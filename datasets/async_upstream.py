@@ -0,0 +1,69 @@
+"""
+The same as datasets/upstream.py for the ASGI side (main/asgi.py). The file
+is downloaded with httpx on the event loop, so a slow upstream server only
+costs an open socket while it's sending, not a whole worker thread.
+
+Every event loop gets one httpx.AsyncClient that pools its connections.
+Owncloud logins still go through the owncloud.Client from upstream.py, only
+the webdav download itself is done here.
+"""
+from django.conf import settings
+
+from asgiref.sync import sync_to_async
+
+from datasets.upstream import decrypt_credentials, owncloud_client
+from datasets.upstream import owncloud_file_url
+
+import asyncio
+import http.cookiejar
+import httpx
+import threading
+import weakref
+
+
+_lock = threading.Lock()
+_clients = weakref.WeakKeyDictionary()
+
+
+def async_client():
+    """
+    The shared httpx.AsyncClient of the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    with _lock:
+        client = _clients.get(loop)
+        if client is None:
+            connect, read = settings.DATASET_UPSTREAM_TIMEOUT
+            # like the requests sessions, the client is shared between
+            # datasets with different logins and must never keep a cookie
+            jar = http.cookiejar.CookieJar(
+                http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            client = httpx.AsyncClient(
+                timeout=httpx.Timeout(
+                    read, connect=connect,
+                    pool=settings.DATASET_POOL_TIMEOUT),
+                limits=httpx.Limits(
+                    max_keepalive_connections=settings.DATASET_POOL_MAXSIZE),
+                cookies=jar,
+                follow_redirects=True)
+            _clients[loop] = client
+    return client
+
+
+async def open_upstream(dataset, headers=None):
+    """
+    Returns an httpx.Response that hasn't been read yet, whoever calls this
+    has to aclose() it. Raises httpx.HTTPError when upstream can't be
+    reached at all.
+    """
+    credentials = decrypt_credentials(dataset)
+    url = dataset.url
+    if dataset.owncloud:
+        # the login is cached, this only goes out to owncloud now and then
+        oc = await sync_to_async(owncloud_client, thread_sensitive=False)(
+            dataset.owncloud_instance, *credentials)
+        url = owncloud_file_url(oc, dataset.owncloud_path)
+
+    client = async_client()
+    request = client.build_request("GET", url, headers=headers)
+    return await client.send(request, auth=credentials, stream=True)
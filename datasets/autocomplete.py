@@ -0,0 +1,319 @@
+"""
+Suggestions for the portal's search box while somebody is still typing:
+datasets by title and author, accounts and keywords.
+
+Everything that can be suggested is held in memory in a PrefixIndex, so a
+lookup is a few bisects into a sorted list of words and doesn't touch the
+database. Every word typed has to be the start of a word of the suggestion.
+When that finds too little, suggestions that share enough trigrams with
+what was typed are added, for typos and for the middle of words.
+
+Every process builds its own PrefixIndex the first time it's needed. The
+signal handlers in datasets/models.py change a version number in
+DATASET_AUTOCOMPLETE_CACHE when anything that can be suggested changes,
+and a background job (datasets/jobs.py) builds the index again once that
+is committed. The other processes notice the new version the next time
+they're asked and start a job of their own. That only reaches them when
+they share that cache (memcached, redis, the database). With one they
+can't see, like locmem, every process builds its index again once it's
+DATASET_AUTOCOMPLETE_MAX_AGE seconds old. Either way the old index goes on
+answering until the new one is swapped in, nobody waits for a build but
+the very first one.
+"""
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.urls import reverse
+
+from datasets.checks import process_local
+from datasets.jobs import run_in_background, start_in_background
+
+from main.listing import decode_cursor, encode_cursor
+
+from collections import namedtuple
+
+import bisect
+import heapq
+import re
+import threading
+import time
+import unicodedata
+import uuid
+
+
+VERSION_KEY = "autocomplete-version"
+
+# below this many prefix matches the trigram matches are added
+MIN_PREFIX_MATCHES = 5
+# what part of the typed trigrams a suggestion has to have
+MIN_SIMILARITY = 0.5
+
+# the order suggestions of the same score come in
+KINDS = ("dataset", "keyword", "account")
+
+# a word typed up to this long is looked up in lists sorted in advance,
+# they'd match too much of the index to sort it for every keystroke
+SHORT_PREFIX = 2
+
+Entry = namedtuple("Entry", "kind pk text url")
+
+_lock = threading.Lock()
+_first_build = threading.Lock()
+_index = None
+_version = None
+_built_at = None
+_rebuilding = False
+
+
+def fold(text):
+    """
+    Lower case without accents, what both sides are compared in.
+    """
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    return "".join(c for c in decomposed
+                   if not unicodedata.combining(c)).lower()
+
+
+def words(text):
+    return re.findall(r"\w+", fold(text))
+
+
+def trigrams(text):
+    padded = "  {} ".format(" ".join(words(text)))
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class PrefixIndex:
+
+    def __init__(self, entries):
+        self.entries = entries
+        # what the entries are compared and sorted by
+        self._folded = [" ".join(words(entry.text)) for entry in entries]
+        pairs = sorted((word, number) for number, text in
+                       enumerate(self._folded) for word in set(text.split()))
+        self._words = [word for word, number in pairs]
+        self._numbers = [number for word, number in pairs]
+        self._trigrams = {}
+        for number, entry in enumerate(entries):
+            for trigram in trigrams(entry.text):
+                self._trigrams.setdefault(trigram, []).append(number)
+        self._short = self._short_prefixes()
+
+    def _short_prefixes(self):
+        """
+        For every prefix of up to SHORT_PREFIX letters, what _found gives
+        for it, as sorted keys and the entries that go with them.
+        """
+        best = {}
+        for number, text in enumerate(self._folded):
+            entry = self.entries[number]
+            prefixes = {word[:length] for word in text.split()
+                        for length in range(1, SHORT_PREFIX + 1)}
+            for prefix in prefixes:
+                score = 3.0 if text.startswith(prefix) else 2.0
+                key = (-score, KINDS.index(entry.kind), text, entry.pk)
+                found = best.setdefault(prefix, {})
+                seen = found.get((entry.kind, entry.pk))
+                if seen is None or key < seen[0]:
+                    found[(entry.kind, entry.pk)] = (key, entry)
+        short = {}
+        for prefix, found in best.items():
+            pairs = sorted(found.values())
+            short[prefix] = ([key for key, entry in pairs],
+                             [entry for key, entry in pairs])
+        return short
+
+    @staticmethod
+    def build():
+        Dataset = apps.get_model("datasets", "Dataset")
+        Keyword = apps.get_model("keywords", "Keyword")
+        Account = apps.get_model("accounts", "Account")
+
+        entries = []
+        for pk, title, author, slug, account_slug in Dataset.objects.values_list(
+                "pk", "title", "author", "dataset_slug",
+                "account__account_slug"):
+            url = reverse("datasets:dataset_detail",
+                          kwargs={"account_slug": account_slug,
+                                  "dataset_slug": slug})
+            entries.append(Entry("dataset", pk, title or "", url))
+            if author:
+                entries.append(Entry("dataset", pk, author, url))
+        for pk, keyword, slug in Keyword.objects.values_list(
+                "pk", "keyword", "keyword_slug"):
+            entries.append(Entry("keyword", pk, keyword or "", reverse(
+                "keywords:keyword_detail", kwargs={"keyword_slug": slug})))
+        for pk, username, slug in Account.objects.values_list(
+                "pk", "user__username", "account_slug"):
+            entries.append(Entry("account", pk, username, reverse(
+                "accounts:account_detail", kwargs={"account_slug": slug})))
+        return PrefixIndex(entries)
+
+    def _prefixed(self, word):
+        start = bisect.bisect_left(self._words, word)
+        end = bisect.bisect_left(self._words, word + "\uffff")
+        return set(self._numbers[start:end])
+
+    def lookup(self, q):
+        """
+        Every suggestion for q as (sort key, entry), best first. A dataset
+        found by title and by author is only in there once.
+        """
+        return sorted(self._found(q))
+
+    def _found(self, q):
+        typed = words(q)
+        if not typed:
+            return []
+
+        scores = {}
+        found = self._prefixed(typed[0])
+        for word in typed[1:]:
+            found &= self._prefixed(word)
+        whole = " ".join(typed)
+        for number in found:
+            # starting the same way beats having the words somewhere
+            scores[number] = (3.0 if self._folded[number].startswith(whole)
+                              else 2.0)
+
+        if len(found) < MIN_PREFIX_MATCHES:
+            wanted = trigrams(q)
+            shared = {}
+            for trigram in wanted:
+                for number in self._trigrams.get(trigram, ()):
+                    shared[number] = shared.get(number, 0) + 1
+            for number, count in shared.items():
+                similarity = count / float(len(wanted))
+                if similarity >= MIN_SIMILARITY and number not in scores:
+                    scores[number] = similarity
+
+        best = {}
+        for number, score in scores.items():
+            entry = self.entries[number]
+            key = (-score, KINDS.index(entry.kind), self._folded[number],
+                   entry.pk)
+            seen = best.get((entry.kind, entry.pk))
+            if seen is None or key < seen[0]:
+                best[(entry.kind, entry.pk)] = (key, entry)
+        return best.values()
+
+    def page(self, q, cursor=None, limit=10):
+        """
+        limit suggestions after cursor, and the cursor of the next page or
+        None when there is none.
+        """
+        after = _cursor_key(cursor) if cursor is not None else None
+        short = self._short_page(q, after, limit)
+        if short is not None:
+            return short
+        found = self._found(q)
+        if after is not None:
+            found = [pair for pair in found if pair[0] > after]
+        # one more than asked for tells whether there is a next page
+        found = heapq.nsmallest(limit + 1, found)
+        next_cursor = None
+        if len(found) > limit:
+            next_cursor = encode_cursor(list(found[limit - 1][0]))
+        return [entry for key, entry in found[:limit]], next_cursor
+
+    def _short_page(self, q, after, limit):
+        """
+        page() for a single short word out of the sorted lists, None when
+        that isn't what was typed or the trigrams have to be added.
+        """
+        typed = words(q)
+        if len(typed) != 1 or len(typed[0]) > SHORT_PREFIX:
+            return None
+        keys, entries = self._short.get(typed[0], ([], []))
+        if len(keys) < MIN_PREFIX_MATCHES:
+            return None
+        start = bisect.bisect_right(keys, after) if after is not None else 0
+        end = start + limit
+        next_cursor = None
+        if end < len(keys):
+            next_cursor = encode_cursor(list(keys[end - 1]))
+        return entries[start:end], next_cursor
+
+
+def _cursor_key(cursor):
+    """
+    The sort key in a cursor, ValueError if it isn't one.
+    """
+    score, kind, text, pk = decode_cursor(cursor, 4)
+    try:
+        return (float(score), int(kind), str(text), int(pk))
+    except (TypeError, ValueError):
+        raise ValueError("cursor isn't one this search handed out")
+
+
+def prefix_index():
+    """
+    The PrefixIndex of this process. When anything changed since it was
+    built a new one is built in the background, and this one is handed out
+    until that's done.
+    """
+    global _rebuilding
+    cache = caches[settings.DATASET_AUTOCOMPLETE_CACHE]
+    version = _current_version(cache)
+
+    if _index is None:
+        with _first_build:
+            if _index is None:
+                rebuild()
+
+    with _lock:
+        stale = (_version != version or
+                 (process_local(cache) and time.monotonic() - _built_at >
+                  settings.DATASET_AUTOCOMPLETE_MAX_AGE))
+        start = stale and not _rebuilding
+        if start:
+            _rebuilding = True
+    if start:
+        start_in_background(_rebuild_once)
+    return _index
+
+
+def _current_version(cache):
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.add(VERSION_KEY, version, None)
+        version = cache.get(VERSION_KEY, version)
+    return version
+
+
+def rebuild():
+    """
+    Builds the index from the database and swaps it in for the one this
+    process had.
+    """
+    global _index, _version, _built_at
+    # whatever changes while it's built makes it stale right away
+    version = _current_version(caches[settings.DATASET_AUTOCOMPLETE_CACHE])
+    index = PrefixIndex.build()
+    with _lock:
+        _index, _version, _built_at = index, version, time.monotonic()
+
+
+def _rebuild_once():
+    global _rebuilding
+    try:
+        rebuild()
+    finally:
+        with _lock:
+            _rebuilding = False
+
+
+def invalidate():
+    caches[settings.DATASET_AUTOCOMPLETE_CACHE].set(
+        VERSION_KEY, uuid.uuid4().hex, None)
+    run_in_background(rebuild)
+
+
+def forget():
+    """
+    Forgets the index of this process, the next one is built right away.
+    """
+    global _index, _version, _built_at
+    with _lock:
+        _index = _version = _built_at = None
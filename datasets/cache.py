@@ -0,0 +1,558 @@
+"""
+A copy of each dataset's file kept on our side, so that load_dataset doesn't
+have to decrypt the credentials and download the whole thing from the remote
+server or owncloud for every single map view.
+
+There is one entry per dataset. Each entry remembers the source_version of
+the dataset it was fetched for, so if the url or the login details change
+the old copy is simply never used again (and the post_save receiver in
+datasets/models.py removes it right away).
+
+DATASET_CACHE_BACKEND picks where the copies live:
+
+    "disk" - files in DATASET_CACHE_DIR, at most DATASET_CACHE_MAX_BYTES in
+             total, the least recently used ones are thrown out first.
+    <alias> - any of the CACHES in settings, for when the web servers should
+              share one cache. Entries bigger than DATASET_CACHE_MAX_BYTES are
+              not stored and eviction is left to that backend.
+    None   - no caching at all.
+
+Either way an entry is only good for DATASET_CACHE_TIMEOUT seconds. After
+that it is stale, load_dataset then asks upstream whether the file changed
+(If-None-Match / If-Modified-Since) before downloading it again.
+
+Next to the "raw" file an entry can have variants that were built from it,
+like the geojson version of a csv. Those remember the sha1 of the raw file
+they were made from and are only used as long as it's still the same file.
+"""
+from django.conf import settings
+from django.core.cache import caches
+
+from datasets.singleflight import solo, take_off
+from datasets.upstream import UpstreamError, conditional_headers
+from datasets.upstream import iter_upstream, open_upstream
+
+import hashlib
+import json
+import os
+import time
+import uuid
+
+
+# everything that can be stored for a dataset besides the raw file, tiles
+# aren't listed, there are too many of them to delete one by one
+VARIANTS = ("raw", "geojson", "features", "index", "clusters")
+
+# how many bytes of bodies there are in each DATASET_CACHE_DIR, as far as
+# this process knows. The other processes write there too, so it's counted
+# again from the directory every RECOUNT_SECONDS.
+_totals = {}
+RECOUNT_SECONDS = 5 * 60
+
+
+def source_version(dataset):
+    """
+    Everything that decides which bytes we get back from upstream. The
+    username and password are hashed in their encrypted form, which is all
+    we need to notice that they changed.
+    """
+    parts = [dataset.url, dataset.owncloud, dataset.owncloud_instance,
+             dataset.owncloud_path, dataset.dataset_user,
+             dataset.dataset_password]
+    source = json.dumps([str(part) for part in parts])
+    return hashlib.sha1(source.encode("utf-8")).hexdigest()[:16]
+
+
+class CachedPayload:
+    """
+    One cache hit. meta has "content_type", "fetched_at", "version", "sha1"
+    and whatever validators upstream gave us ("etag", "last_modified"). data
+    is either the bytes themselves or None when the body is read from a file
+    on disk. fresh is False for entries past DATASET_CACHE_TIMEOUT, those
+    have to be revalidated upstream before they are used.
+    """
+
+    def __init__(self, meta, size, data=None, path=None, fresh=True):
+        self.meta = meta
+        self.size = size
+        self.data = data
+        self.path = path
+        self.fresh = fresh
+
+    @property
+    def content_type(self):
+        return self.meta.get("content_type", "application/octet-stream")
+
+    def chunks(self, chunk_size=None):
+        chunk_size = chunk_size or settings.DATASET_CHUNK_SIZE
+        if self.data is not None:
+            for start in range(0, len(self.data), chunk_size):
+                yield self.data[start:start + chunk_size]
+            return
+
+        with open(self.path, "rb") as f:
+            chunk = f.read(chunk_size)
+            while chunk:
+                yield chunk
+                chunk = f.read(chunk_size)
+
+    def read(self):
+        return b"".join(self.chunks())
+
+    def exists(self):
+        """
+        False once the body was evicted from the disk cache.
+        """
+        return self.data is not None or os.path.exists(self.path)
+
+    def read_ranges(self, ranges):
+        """
+        Yields the bytes for each (offset, length) in ranges, without
+        reading the rest of the body.
+        """
+        if self.data is not None:
+            for offset, length in ranges:
+                yield self.data[offset:offset + length]
+            return
+
+        with open(self.path, "rb") as f:
+            for offset, length in ranges:
+                f.seek(offset)
+                yield f.read(length)
+
+
+def _is_fresh(meta, timeout):
+    return time.time() - meta.get("fetched_at", 0) < timeout
+
+
+def _hashing(chunks, entry):
+    """
+    Passes the chunks through, counting and hashing them into entry on the
+    way. entry["complete"] is only set once the last chunk went past.
+    """
+    sha1 = hashlib.sha1()
+    entry["size"] = 0
+    try:
+        for chunk in chunks:
+            sha1.update(chunk)
+            entry["size"] += len(chunk)
+            yield chunk
+        entry["sha1"] = sha1.hexdigest()
+        entry["complete"] = True
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+class DiskPayloadCache:
+    """
+    Every entry is two files, <pk>.<variant>.json with the meta data and the
+    body itself, named after its sha1. The body is written to a temporary
+    file first and the json is replaced last, so readers never see half a
+    file and revalidating an entry only means rewriting the small json. The
+    body's mtime is bumped on every hit and used for the least recently used
+    eviction, which only goes through the directory once the bodies add up
+    to more than max_bytes.
+    """
+
+    def __init__(self, location, max_bytes, timeout):
+        self.location = location
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+
+    def _path(self, name):
+        return os.path.join(self.location, name)
+
+    def _meta_name(self, pk, variant):
+        return "{}.{}.json".format(pk, variant)
+
+    def _read_meta(self, name):
+        try:
+            with open(self._path(name), "rb") as f:
+                return json.loads(f.read().decode("utf-8"))
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_meta(self, name, meta):
+        tmp_path = self._path("{}.{}.tmp".format(name, uuid.uuid4().hex))
+        with open(tmp_path, "wb") as f:
+            f.write(json.dumps(meta).encode("utf-8"))
+        os.replace(tmp_path, self._path(name))
+
+    def get(self, dataset, variant="raw", stale=False):
+        meta = self._read_meta(self._meta_name(dataset.pk, variant))
+        if meta is None or meta.get("version") != source_version(dataset):
+            return None
+
+        fresh = _is_fresh(meta, self.timeout)
+        if not fresh and not stale:
+            return None
+
+        path = self._path(meta["body"])
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return CachedPayload(meta, meta["size"], path=path, fresh=fresh)
+
+    def store(self, dataset, chunks, meta, variant="raw"):
+        """
+        Passes the chunks straight through while also writing them to disk.
+        The entry only shows up once the last chunk went past, a download
+        that stops halfway is thrown away.
+        """
+        os.makedirs(self.location, exist_ok=True)
+        prefix = "{}.{}".format(dataset.pk, variant)
+        tmp_path = self._path("{}.{}.tmp".format(prefix, uuid.uuid4().hex))
+
+        entry = {}
+        hashed = _hashing(chunks, entry)
+        f = open(tmp_path, "wb")
+        try:
+            for chunk in hashed:
+                if f is not None:
+                    if entry["size"] > self.max_bytes:
+                        # too big to ever fit, stop writing but keep going
+                        f.close()
+                        os.remove(tmp_path)
+                        f = None
+                    else:
+                        f.write(chunk)
+                yield chunk
+        finally:
+            hashed.close()
+            if f is not None:
+                f.close()
+                if entry.get("complete"):
+                    self._commit(dataset, variant, tmp_path, meta, entry)
+                else:
+                    os.remove(tmp_path)
+
+    def _commit(self, dataset, variant, tmp_path, meta, entry):
+        meta_name = self._meta_name(dataset.pk, variant)
+        old = self._read_meta(meta_name)
+
+        body = "{}.{}.{}".format(dataset.pk, variant, entry["sha1"])
+        os.replace(tmp_path, self._path(body))
+        self._write_meta(meta_name, dict(
+            meta, version=source_version(dataset), fetched_at=time.time(),
+            sha1=entry["sha1"], size=entry["size"], body=body))
+
+        if old is not None and old.get("body") != body:
+            self._remove(old.get("body"))
+        self._added(entry["size"])
+
+    def revalidated(self, dataset, variant="raw", **validators):
+        """
+        Upstream said the file didn't change, so the entry is good for
+        another DATASET_CACHE_TIMEOUT. New validators replace the old ones.
+        """
+        meta_name = self._meta_name(dataset.pk, variant)
+        meta = self._read_meta(meta_name)
+        if meta is None:
+            return
+        meta.update({k: v for k, v in validators.items() if v})
+        meta["fetched_at"] = time.time()
+        self._write_meta(meta_name, meta)
+
+    def invalidate(self, pk):
+        if not os.path.isdir(self.location):
+            return
+        prefix = "{}.".format(pk)
+        for name in os.listdir(self.location):
+            if name.startswith(prefix) and not name.endswith(".tmp"):
+                self._remove(name)
+
+    def _added(self, size):
+        total = _totals.get(self.location)
+        if (total is None or
+                time.time() - total["counted_at"] > RECOUNT_SECONDS):
+            self.evict()
+            return
+        total["bytes"] += size
+        if total["bytes"] > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        Throws out the least recently used entries until all the bodies fit
+        in max_bytes again, and counts what's left.
+        """
+        entries = []
+        for name in os.listdir(self.location):
+            if not name.endswith(".json"):
+                continue
+            meta = self._read_meta(name)
+            if meta is None:
+                continue
+            try:
+                stat = os.stat(self._path(meta["body"]))
+            except (KeyError, FileNotFoundError):
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name, meta["body"]))
+
+        total = sum(entry[1] for entry in entries)
+        for _, size, meta_name, body in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(meta_name)
+            self._remove(body)
+            total -= size
+        _totals[self.location] = {"bytes": total, "counted_at": time.time()}
+
+    def _remove(self, name):
+        if not name:
+            return
+        path = self._path(name)
+        try:
+            size = os.stat(path).st_size
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        total = _totals.get(self.location)
+        if total is not None and not name.endswith((".json", ".tmp")):
+            total["bytes"] -= size
+
+
+class BackendPayloadCache:
+    """
+    The same thing on top of one of the django cache backends. Entries are
+    kept in the backend for twice DATASET_CACHE_TIMEOUT so that stale ones
+    are still around to be revalidated.
+    """
+
+    def __init__(self, alias, max_bytes, timeout):
+        self.cache = caches[alias]
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+
+    def _key(self, pk, variant):
+        return "dataset-payload:{}:{}".format(pk, variant)
+
+    def get(self, dataset, variant="raw", stale=False):
+        entry = self.cache.get(self._key(dataset.pk, variant))
+        if entry is None:
+            return None
+        meta, data = entry
+        if meta.get("version") != source_version(dataset):
+            return None
+
+        fresh = _is_fresh(meta, self.timeout)
+        if not fresh and not stale:
+            return None
+        return CachedPayload(meta, len(data), data=data, fresh=fresh)
+
+    def store(self, dataset, chunks, meta, variant="raw"):
+        entry = {}
+        hashed = _hashing(chunks, entry)
+        body = []
+        try:
+            for chunk in hashed:
+                if body is not None:
+                    if entry["size"] > self.max_bytes:
+                        body = None
+                    else:
+                        body.append(chunk)
+                yield chunk
+        finally:
+            hashed.close()
+            if entry.get("complete") and body is not None:
+                meta = dict(meta, version=source_version(dataset),
+                            fetched_at=time.time(), sha1=entry["sha1"],
+                            size=entry["size"])
+                self.cache.set(self._key(dataset.pk, variant),
+                               (meta, b"".join(body)), self.timeout * 2)
+
+    def revalidated(self, dataset, variant="raw", **validators):
+        key = self._key(dataset.pk, variant)
+        entry = self.cache.get(key)
+        if entry is None:
+            return
+        meta, data = entry
+        meta.update({k: v for k, v in validators.items() if v})
+        meta["fetched_at"] = time.time()
+        self.cache.set(key, (meta, data), self.timeout * 2)
+
+    def invalidate(self, pk):
+        variants = list(VARIANTS)
+        variants += ["simplified.{}".format(zoom)
+                     for zoom in settings.DATASET_SIMPLIFY_ZOOMS]
+        # and their compressed copies, see datasets/compress.py
+        variants += ["{}.{}".format(variant, encoding)
+                     for variant in variants for encoding in ("gzip", "br")]
+        self.cache.delete_many([self._key(pk, variant)
+                                for variant in variants])
+
+
+class NoPayloadCache:
+
+    def get(self, dataset, variant="raw", stale=False):
+        return None
+
+    def store(self, dataset, chunks, meta, variant="raw"):
+        return chunks
+
+    def revalidated(self, dataset, variant="raw", **validators):
+        pass
+
+    def invalidate(self, pk):
+        pass
+
+
+def payload_cache():
+    """
+    Built from the settings every time, it's cheap and it means the tests can
+    just use override_settings.
+    """
+    backend = settings.DATASET_CACHE_BACKEND
+    if backend is None:
+        return NoPayloadCache()
+    if backend == "disk":
+        return DiskPayloadCache(settings.DATASET_CACHE_DIR,
+                                settings.DATASET_CACHE_MAX_BYTES,
+                                settings.DATASET_CACHE_TIMEOUT)
+    return BackendPayloadCache(backend,
+                               settings.DATASET_CACHE_MAX_BYTES,
+                               settings.DATASET_CACHE_TIMEOUT)
+
+
+class UpstreamPayload:
+    """
+    Stands in for a CachedPayload when the file couldn't be kept in the
+    cache, every call to chunks() downloads it again.
+    """
+
+    def __init__(self, dataset, content_type):
+        self.dataset = dataset
+        self.meta = {"content_type": content_type, "sha1": None}
+        self.size = None
+        self.fresh = True
+
+    @property
+    def content_type(self):
+        return self.meta["content_type"]
+
+    def chunks(self, chunk_size=None):
+        upstream = open_upstream(self.dataset)
+        if upstream.status_code != 200:
+            upstream.close()
+            raise UpstreamError(upstream.status_code)
+        return iter_upstream(upstream, chunk_size)
+
+    def read(self):
+        return b"".join(self.chunks())
+
+
+def fetch_payload(dataset, cache=None):
+    """
+    Makes sure there is a fresh copy of the dataset's file in the cache and
+    returns it, downloading or revalidating it first if needed. This is for
+    the things that need the whole file on our side before they can answer,
+    load_dataset itself streams instead. Raises UpstreamError when upstream
+    doesn't hand over the file.
+    """
+    cache = cache or payload_cache()
+    cached = cache.get(dataset, stale=True)
+    if cached is not None and cached.fresh:
+        return cached
+
+    flight = payload_flight(cache, dataset)
+    if not flight.leader:
+        flight.wait()
+        landed = cache.get(dataset)
+        if landed is not None:
+            return landed
+    try:
+        return _fetch_payload(dataset, cache, cached)
+    finally:
+        flight.land()
+
+
+def payload_flight(cache, dataset, variant="raw"):
+    """
+    The Flight (see datasets/singleflight.py) for building the dataset's
+    file or one of its variants. Without a cache there's nothing the others
+    could wait for, so everybody goes on their own.
+    """
+    key = "{}.{}.{}".format(dataset.pk, variant, source_version(dataset))
+    if isinstance(cache, NoPayloadCache):
+        return solo(key)
+    return take_off(key)
+
+
+def refresh_payload(dataset, cache=None):
+    """
+    Like fetch_payload, but a copy that is still fresh is revalidated too.
+    Returns the copy in the cache afterwards, or the UpstreamPayload when
+    the file can't be cached.
+    """
+    cache = cache or payload_cache()
+    flight = payload_flight(cache, dataset)
+    if not flight.leader:
+        flight.wait()
+        landed = cache.get(dataset)
+        if landed is not None:
+            return landed
+    try:
+        return _fetch_payload(dataset, cache, cache.get(dataset, stale=True))
+    finally:
+        flight.land()
+
+
+def _fetch_payload(dataset, cache, cached):
+    headers = None
+    if cached is not None:
+        headers = conditional_headers(cached.meta.get("etag"),
+                                      cached.meta.get("last_modified"))
+    upstream = open_upstream(dataset, headers)
+
+    if cached is not None and (upstream.status_code == 304 or
+                               upstream.status_code >= 500):
+        upstream.close()
+        if upstream.status_code == 304:
+            cache.revalidated(dataset,
+                              etag=upstream.headers.get("ETag"),
+                              last_modified=upstream.headers.get(
+                                  "Last-Modified"))
+        return cached
+
+    if upstream.status_code != 200:
+        upstream.close()
+        raise UpstreamError(upstream.status_code)
+
+    content_type = upstream.headers.get("Content-Type",
+                                        "application/octet-stream")
+    if isinstance(cache, NoPayloadCache):
+        upstream.close()
+        return UpstreamPayload(dataset, content_type)
+
+    meta = {"content_type": content_type,
+            "etag": upstream.headers.get("ETag"),
+            "last_modified": upstream.headers.get("Last-Modified")}
+    for chunk in cache.store(dataset, iter_upstream(upstream), meta):
+        pass
+    return cache.get(dataset) or UpstreamPayload(dataset, content_type)
+
+
+def get_derived(cache, dataset, variant, source):
+    """
+    The variant, if there is one that was built from exactly this source.
+    It doesn't expire on its own, it's as good as the source is.
+    """
+    if not source.meta.get("sha1"):
+        return None
+    cached = cache.get(dataset, variant, stale=True)
+    if cached is None or cached.meta.get("source_sha1") != source.meta["sha1"]:
+        return None
+    return cached
+
+
+def store_derived(cache, dataset, variant, source, chunks, meta):
+    """
+    Like cache.store, for something built from source. Things built from a
+    file that isn't in the cache itself aren't kept either.
+    """
+    if not source.meta.get("sha1"):
+        return chunks
+    meta = dict(meta, source_sha1=source.meta["sha1"])
+    return cache.store(dataset, chunks, meta, variant)
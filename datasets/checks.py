@@ -0,0 +1,49 @@
+"""
+System checks for the settings that only work when every process sees the
+same cache.
+"""
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+
+def process_local(cache):
+    """
+    True for the caches where the other processes never see what this one
+    wrote.
+    """
+    return isinstance(cache, (LocMemCache, DummyCache))
+
+
+def check_page_cache(app_configs, **kwargs):
+    """
+    The page cache is invalidated by changing version numbers in it (see
+    datasets/pagecache.py). With a cache of its own every process would
+    go on serving its old pages after another process saved a change.
+    """
+    if (settings.PAGE_CACHE is None or
+            not process_local(caches[settings.PAGE_CACHE])):
+        return []
+    return [checks.Error(
+        "PAGE_CACHE is a cache that only this process can see.",
+        hint="Point it at a memcached or redis cache in CACHES, or set it "
+             "to None.",
+        id="datasets.E001")]
+
+
+def check_lock_cache(app_configs, **kwargs):
+    """
+    The flights of datasets/singleflight.py are held in the lock cache so
+    that the other processes wait for them. In a cache of its own every
+    process would think it's the leader and go upstream too.
+    """
+    if (settings.DATASET_LOCK_CACHE is None or
+            not process_local(caches[settings.DATASET_LOCK_CACHE])):
+        return []
+    return [checks.Error(
+        "DATASET_LOCK_CACHE is a cache that only this process can see.",
+        hint="Point it at a memcached or redis cache in CACHES, or set it "
+             "to None.",
+        id="datasets.E002")]
@@ -0,0 +1,194 @@
+"""
+Point clusters for every zoom level, worked out once on the server so the
+"Cluster Points Markers" button doesn't have to make Leaflet.markercluster
+go through every point of a big dataset in the browser.
+
+It's done the way supercluster does it. The points are projected to web
+mercator and, starting at DATASET_CLUSTER_MAX_ZOOM and going down to zoom 0,
+everything within DATASET_CLUSTER_RADIUS pixels of a point is merged into
+it. Each level is made from the one above it, so every level is a single
+pass over a grid.
+
+The levels are kept as the "clusters" variant in the payload cache, next to
+the FeatureIndex they were made from (see datasets/spatial.py). Every level
+is sorted by longitude, so a viewport only looks at a slice of it. Only
+Point features are clustered, lines and polygons are left out.
+"""
+from django.conf import settings
+
+from datasets.cache import fetch_payload, get_derived, payload_cache
+from datasets.cache import payload_flight, store_derived
+from datasets.spatial import load_index, recall, remember
+
+import bisect
+import json
+import math
+
+
+def _mercator(lon, lat):
+    """
+    lon / lat to x / y between 0 and 1, y going down like tile rows do.
+    """
+    sin = math.sin(math.radians(max(min(lat, 85.0511), -85.0511)))
+    y = 0.5 - 0.25 * math.log((1 + sin) / (1 - sin)) / math.pi
+    return lon / 360.0 + 0.5, y
+
+
+def _lon_lat(x, y):
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y))))
+    return round((x - 0.5) * 360.0, 6), round(lat, 6)
+
+
+def _merge(points, radius):
+    """
+    One level up from points, every point takes in the ones within radius
+    that haven't been taken yet. Points are [x, y, count, number], number is
+    the feature's number in the file or None for a cluster.
+    """
+    grid = {}
+    for i, (x, y, count, number) in enumerate(points):
+        grid.setdefault((int(x / radius), int(y / radius)), []).append(i)
+
+    taken = [False] * len(points)
+    merged = []
+    for i, (x, y, count, number) in enumerate(points):
+        if taken[i]:
+            continue
+        taken[i] = True
+        column, row = int(x / radius), int(y / radius)
+        wx, wy, total = x * count, y * count, count
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for j in grid.get((column + dx, row + dy), ()):
+                    if taken[j]:
+                        continue
+                    other = points[j]
+                    if math.hypot(other[0] - x, other[1] - y) <= radius:
+                        taken[j] = True
+                        wx += other[0] * other[2]
+                        wy += other[1] * other[2]
+                        total += other[2]
+        if total == count:
+            merged.append([x, y, count, number])
+        else:
+            merged.append([wx / total, wy / total, total, None])
+    return merged
+
+
+class ClusterLevels:
+
+    def __init__(self, levels):
+        # json only has string keys
+        self.levels = {int(zoom): level for zoom, level in levels.items()}
+        self.max_zoom = max(self.levels) if self.levels else -1
+        self._lons = {zoom: [entry[0] for entry in level]
+                      for zoom, level in self.levels.items()}
+
+    @staticmethod
+    def build(index):
+        """
+        The levels from the points in a FeatureIndex. Zoom levels where
+        nothing is merged any more are left out, above max_zoom the points
+        are served as they are.
+        """
+        points = []
+        for number in range(len(index)):
+            bbox = index.bbox_of(number)
+            if bbox is None or bbox[0] != bbox[2] or bbox[1] != bbox[3]:
+                continue
+            x, y = _mercator(bbox[0], bbox[1])
+            points.append([x, y, 1, number])
+
+        levels = {}
+        merged_yet = False
+        for zoom in range(settings.DATASET_CLUSTER_MAX_ZOOM, -1, -1):
+            radius = settings.DATASET_CLUSTER_RADIUS / (256.0 * 2 ** zoom)
+            merged = _merge(points, radius)
+            merged_yet = merged_yet or len(merged) < len(points)
+            points = merged
+            if merged_yet:
+                level = [list(_lon_lat(x, y)) + [count, number]
+                         for x, y, count, number in points]
+                level.sort(key=lambda entry: entry[0])
+                levels[str(zoom)] = level
+        return levels
+
+    def query(self, zoom, bbox):
+        """
+        The [lon, lat, count, number] of the clusters and single points at
+        zoom in bbox, or None when zoom is above max_zoom.
+        """
+        if zoom > self.max_zoom:
+            return None
+        level = self.levels.get(zoom, [])
+        lons = self._lons.get(zoom, [])
+        start = bisect.bisect_left(lons, bbox[0])
+        end = bisect.bisect_right(lons, bbox[2])
+        return [entry for entry in level[start:end]
+                if bbox[1] <= entry[1] <= bbox[3]]
+
+
+def cluster_features(index, levels, zoom, bbox):
+    """
+    The geojson features for a map at zoom showing bbox. Clusters get the
+    same properties supercluster gives them, single points are the features
+    from the file.
+    """
+    found = levels.query(zoom, bbox)
+    if found is None:
+        numbers = [number for number in index.query(bbox)
+                   if index.bbox_of(number)[:2] == index.bbox_of(number)[2:]]
+        for feature in index.features(numbers):
+            yield feature
+        return
+
+    for lon, lat, count, number in found:
+        if number is None:
+            yield {"type": "Feature",
+                   "properties": {"cluster": True, "point_count": count},
+                   "geometry": {"type": "Point", "coordinates": [lon, lat]}}
+    numbers = sorted(number for lon, lat, count, number in found
+                     if number is not None)
+    for feature in index.features(numbers):
+        yield feature
+
+
+def load_clusters(dataset, cache=None, source=None):
+    """
+    The ClusterLevels for the current version of the dataset's file, built
+    the first time they're asked for, like load_index.
+    """
+    cache = cache or payload_cache()
+    source = source or fetch_payload(dataset, cache)
+    key = ("clusters", dataset.pk, source.meta.get("sha1"))
+
+    levels = recall(key)
+    if levels is not None:
+        return levels
+
+    levels = _read_clusters(cache, dataset, source)
+    if levels is None:
+        flight = payload_flight(cache, dataset, "clusters")
+        if not flight.leader:
+            flight.wait()
+            levels = _read_clusters(cache, dataset, source)
+    if levels is None:
+        try:
+            built = ClusterLevels.build(load_index(dataset, cache, source))
+            encoded = json.dumps(built).encode("utf-8")
+            for chunk in store_derived(cache, dataset, "clusters", source,
+                                       iter([encoded]), {}):
+                pass
+        finally:
+            flight.land()
+        levels = ClusterLevels(built)
+    remember(key, levels)
+    return levels
+
+
+def _read_clusters(cache, dataset, source):
+    stored = get_derived(cache, dataset, "clusters", source)
+    if stored is None:
+        return None
+    return ClusterLevels(json.loads(stored.read().decode("utf-8")))
+
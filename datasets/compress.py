@@ -0,0 +1,122 @@
+"""
+gzip and brotli for the dataset files. Geojson, csv and kml are text and
+shrink to a fifth or a tenth, which is what makes the difference on a slow
+connection at a field station.
+
+load_dataset picks an encoding from the browser's Accept-Encoding. A file
+that comes out of the payload cache is compressed once and the compressed
+copy is kept next to it as another variant ("raw.gzip", "geojson.br", ...)
+built from it, see _compressed_response in main/views.py. Files that are
+streamed through from upstream, and the ones that are built for a single
+request, are compressed on the way out, a chunk at a time.
+
+br needs the brotli package. Without it only gzip is offered.
+"""
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+import re
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def encodings():
+    """
+    The encodings we can do, the one we'd rather use first.
+    """
+    if brotli is not None:
+        return ("br", "gzip")
+    return ("gzip",)
+
+
+def _accepted(header):
+    """
+    The encodings in an Accept-Encoding header with their q values.
+    """
+    accepted = {}
+    for part in header.split(","):
+        match = re.match(r"\s*([\w*-]+)\s*(?:;\s*q\s*=\s*([\d.]+))?", part)
+        if match is None:
+            continue
+        try:
+            q = float(match.group(2)) if match.group(2) else 1.0
+        except ValueError:
+            continue
+        accepted[match.group(1).lower()] = q
+    return accepted
+
+
+def negotiate(header, size=None):
+    """
+    The encoding to send a file of size bytes in (None when it's not known
+    yet), or None to send it as it is.
+    """
+    if not settings.DATASET_COMPRESS or not header:
+        return None
+    if size is not None and size < settings.DATASET_COMPRESS_MIN_BYTES:
+        return None
+    accepted = _accepted(header)
+    best, best_q = None, 0
+    for encoding in encodings():
+        q = accepted.get(encoding, accepted.get("*", 0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compressor(encoding):
+    """
+    compress(chunk) and finish() for one file, both return the compressed
+    bytes that are ready, which can be nothing for a while.
+    """
+    if encoding == "br":
+        state = brotli.Compressor(quality=settings.DATASET_BROTLI_QUALITY)
+        return state.process, state.finish
+    # wbits 16 + 15 is the gzip container around deflate
+    state = zlib.compressobj(settings.DATASET_GZIP_LEVEL, zlib.DEFLATED,
+                             16 + zlib.MAX_WBITS)
+    return state.compress, state.flush
+
+
+def compressed_chunks(chunks, encoding):
+    """
+    The chunks compressed on the way through.
+    """
+    compress, finish = compressor(encoding)
+    try:
+        for chunk in chunks:
+            compressed = compress(chunk)
+            if compressed:
+                yield compressed
+        yield finish()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def encoded_etag(etag, encoding):
+    """
+    The compressed file is a different set of bytes, so it can't have the
+    same strong ETag as the plain one.
+    """
+    if encoding is None or not etag or not etag.endswith('"'):
+        return etag
+    return '{}-{}"'.format(etag[:-1], encoding)
+
+
+def variant_for(variant, encoding):
+    return "{}.{}".format(variant, encoding)
+
+
+def set_encoding(response, encoding):
+    """
+    Content-Encoding and Vary for a dataset file that could have been
+    compressed, whether or not it was.
+    """
+    patch_vary_headers(response, ("Accept-Encoding",))
+    if encoding is not None:
+        response["Content-Encoding"] = encoding
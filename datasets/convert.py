@@ -0,0 +1,380 @@
+"""
+Turning the csv, tsv and kml files people point us at into geojson on the
+server, so the browser doesn't have to parse them with leaflet-omnivore on
+every single view.
+
+Everything here works on an iterator of byte chunks and yields features one
+at a time, a big file is never held in memory as a whole.
+"""
+import codecs
+import csv
+import json
+import re
+import xml.etree.ElementTree as ET
+
+
+GEOJSON_CONTENT_TYPE = "application/geo+json"
+
+# header names that mean latitude / longitude, compared in lower case with
+# spaces, dashes and underscores taken out. Projected columns like northing
+# and easting are in metres, not degrees, so they aren't in here
+LAT_NAMES = ("lat", "latitude", "latdd", "decimallatitude", "y", "ycoord",
+             "ycoordinate")
+LON_NAMES = ("lon", "lng", "long", "longitude", "londd", "decimallongitude",
+             "x", "xcoord", "xcoordinate")
+
+# only \n and \r\n end a line, str.splitlines would also cut at form feeds,
+# \x1c-\x1e and \u2028 inside a value
+_LINE_END = re.compile(r"(?<=\n)")
+
+
+class ConversionError(Exception):
+    pass
+
+
+def iter_lines(chunks, encoding="utf-8-sig"):
+    """
+    Decodes the chunks and cuts them into lines, keeping the line endings so
+    the csv module can deal with quoted newlines itself.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    rest = ""
+    for chunk in chunks:
+        lines = _LINE_END.split(rest + decoder.decode(chunk))
+        rest = lines.pop()
+        for line in lines:
+            yield line
+    rest += decoder.decode(b"", final=True)
+    if rest:
+        yield rest
+
+
+def _normalise(name):
+    for character in " -_.":
+        name = name.replace(character, "")
+    return name.strip().lower()
+
+
+def find_coordinate_columns(header):
+    """
+    Returns the index of the latitude and the longitude column.
+    """
+    names = [_normalise(name) for name in header]
+    lat = lon = None
+    for candidate in LAT_NAMES:
+        if candidate in names:
+            lat = names.index(candidate)
+            break
+    for candidate in LON_NAMES:
+        if candidate in names:
+            lon = names.index(candidate)
+            break
+    if lat is None or lon is None:
+        raise ConversionError(
+            "could not find latitude and longitude columns in {}".format(
+                ", ".join(header)))
+    return lat, lon
+
+
+def sniff_delimiter(line):
+    return max(("\t", ",", ";", "|"), key=line.count)
+
+
+def delimited_features(chunks):
+    """
+    Point features from a csv or tsv file, one per row. The delimiter is
+    guessed from the header line, rows without usable coordinates (or with
+    ones that can't be degrees) are skipped.
+    """
+    lines = iter_lines(chunks)
+    first = next(lines, None)
+    if first is None:
+        return
+
+    delimiter = sniff_delimiter(first)
+    reader = csv.reader(_prepend(first, lines), delimiter=delimiter)
+    header = [name.strip() for name in next(reader)]
+    lat, lon = find_coordinate_columns(header)
+
+    for row in reader:
+        try:
+            coordinates = [float(row[lon]), float(row[lat])]
+        except (IndexError, ValueError):
+            continue
+        if not (-180 <= coordinates[0] <= 180 and
+                -90 <= coordinates[1] <= 90):
+            continue
+        properties = {name: value for index, (name, value)
+                      in enumerate(zip(header, row))
+                      if index not in (lat, lon)}
+        yield {"type": "Feature",
+               "properties": properties,
+               "geometry": {"type": "Point", "coordinates": coordinates}}
+
+
+def _prepend(first, lines):
+    yield first
+    for line in lines:
+        yield line
+
+
+def _local(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+def _children(element, name):
+    return [child for child in element if _local(child.tag) == name]
+
+
+def _descendants(element, name):
+    return [child for child in element.iter() if _local(child.tag) == name]
+
+
+def _kml_coordinates(element):
+    coordinates = []
+    for found in _descendants(element, "coordinates"):
+        for point in (found.text or "").split():
+            try:
+                coordinates.append([float(value)
+                                    for value in point.split(",")][:3])
+            except ValueError:
+                continue
+    return coordinates
+
+
+def _kml_geometry(element):
+    kind = _local(element.tag)
+    if kind == "Point":
+        coordinates = _kml_coordinates(element)
+        if coordinates:
+            return {"type": "Point", "coordinates": coordinates[0]}
+    elif kind in ("LineString", "LinearRing"):
+        return {"type": "LineString",
+                "coordinates": _kml_coordinates(element)}
+    elif kind == "Polygon":
+        rings = []
+        for boundary in ("outerBoundaryIs", "innerBoundaryIs"):
+            for found in _children(element, boundary):
+                rings.append(_kml_coordinates(found))
+        return {"type": "Polygon", "coordinates": rings}
+    elif kind == "MultiGeometry":
+        geometries = [_kml_geometry(child) for child in element]
+        return {"type": "GeometryCollection",
+                "geometries": [geometry for geometry in geometries
+                               if geometry is not None]}
+    return None
+
+
+def _kml_feature(placemark):
+    properties = {}
+    geometry = None
+    for child in placemark:
+        kind = _local(child.tag)
+        if kind in ("name", "description"):
+            properties[kind] = (child.text or "").strip()
+        elif kind == "ExtendedData":
+            for data in _descendants(child, "Data"):
+                value = _children(data, "value")
+                properties[data.get("name")] = (
+                    (value[0].text or "").strip() if value else None)
+            for data in _descendants(child, "SimpleData"):
+                properties[data.get("name")] = (data.text or "").strip()
+        elif geometry is None:
+            geometry = _kml_geometry(child)
+    return {"type": "Feature", "properties": properties,
+            "geometry": geometry}
+
+
+def kml_features(chunks):
+    """
+    One feature per Placemark. The file is parsed incrementally and every
+    Placemark is thrown away again once it has been turned into a feature.
+    """
+    parser = ET.XMLPullParser(events=("end",))
+    try:
+        for chunk in chunks:
+            parser.feed(chunk)
+            for feature in _placemarks(parser):
+                yield feature
+        parser.close()
+        for feature in _placemarks(parser):
+            yield feature
+    except ET.ParseError as e:
+        raise ConversionError("could not read the kml file: {}".format(e))
+
+
+def _placemarks(parser):
+    for event, element in parser.read_events():
+        if _local(element.tag) == "Placemark":
+            yield _kml_feature(element)
+            element.clear()
+
+
+def geojson_chunks(features, chunk_size=64 * 1024):
+    """
+    Writes the features out as one FeatureCollection, in chunks of about
+    chunk_size bytes.
+    """
+    buffer = [b'{"type": "FeatureCollection", "features": [']
+    size = 0
+    separator = b""
+    for feature in features:
+        encoded = separator + json.dumps(feature).encode("utf-8")
+        separator = b", "
+        buffer.append(encoded)
+        size += len(encoded)
+        if size >= chunk_size:
+            yield b"".join(buffer)
+            buffer = []
+            size = 0
+    buffer.append(b"]}")
+    yield b"".join(buffer)
+
+
+def features(ext, chunks):
+    """
+    The features of a file of any of the kinds Dataset.save knows about.
+    """
+    if ext in ("csv", "tsv"):
+        return delimited_features(chunks)
+    if ext == "kml":
+        return kml_features(chunks)
+    return geojson_features(chunks)
+
+
+class _JsonReader:
+    """
+    Reads json values off the decoded chunks one at a time with
+    JSONDecoder.raw_decode, holding on to no more of the text than the
+    value it is in the middle of.
+    """
+
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r"[ \t\n\r]*")
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decode = codecs.getincrementaldecoder("utf-8-sig")().decode
+        self.text = ""
+        self.pos = 0
+        self.done = False
+
+    def _read(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.done = True
+            return self.decode(b"", final=True)
+        return self.decode(chunk)
+
+    def _read_more(self):
+        # at least as much again as what is there, so a big value isn't
+        # parsed from the start over and over
+        wanted = len(self.text) - self.pos + 1
+        parts = [self.text[self.pos:]]
+        read = 0
+        while not self.done and read < wanted:
+            parts.append(self._read())
+            read += len(parts[-1])
+        self.text = "".join(parts)
+        self.pos = 0
+
+    def peek(self):
+        """
+        The next character that isn't whitespace, "" at the end.
+        """
+        while True:
+            self.pos = self.whitespace.match(self.text, self.pos).end()
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if self.done:
+                return ""
+            self._read_more()
+
+    def take(self, character):
+        found = self.peek()
+        if found != character:
+            raise ValueError("expected {!r} but found {!r}".format(
+                character, found or "the end"))
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.text, self.pos)
+            except ValueError:
+                if self.done:
+                    raise
+                self._read_more()
+                continue
+            # a number could go on in the next chunk
+            if end == len(self.text) and not self.done:
+                self._read_more()
+                continue
+            break
+        self.pos = end
+        return value
+
+    def array(self):
+        """
+        The values in the array that comes next.
+        """
+        self.take("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() != ",":
+                break
+            self.pos += 1
+        self.take("]")
+
+
+def geojson_features(chunks):
+    """
+    The features of a FeatureCollection are read one at a time, only the
+    other members of the top object (the type, crs, bbox...) are kept
+    around, so a big file is never in memory as a whole.
+    """
+    reader = _JsonReader(chunks)
+    members = {}
+    streamed = False
+    try:
+        if reader.peek() != "{":
+            raise ConversionError("the geojson file is not a json object")
+        reader.take("{")
+        while reader.peek() != "}":
+            if members or streamed:
+                reader.take(",")
+            name = reader.value()
+            if not isinstance(name, str):
+                raise ValueError("object keys have to be strings")
+            reader.take(":")
+            if (name == "features" and reader.peek() == "[" and
+                    members.get("type", "FeatureCollection") ==
+                    "FeatureCollection"):
+                streamed = True
+                for feature in reader.array():
+                    yield feature
+            else:
+                members[name] = reader.value()
+        reader.take("}")
+        if reader.peek():
+            raise ValueError("there is more after the json object")
+    except ValueError as e:
+        raise ConversionError("could not read the geojson file: {}".format(e))
+
+    if streamed:
+        return
+    if members.get("type") == "FeatureCollection":
+        for feature in members.get("features") or []:
+            yield feature
+    elif members.get("type") == "Feature":
+        yield members
+    elif members.get("type"):
+        yield {"type": "Feature", "properties": {}, "geometry": members}
+
+
+def to_geojson(ext, chunks, chunk_size=64 * 1024):
+    return geojson_chunks(features(ext, chunks), chunk_size)
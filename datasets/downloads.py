@@ -0,0 +1,155 @@
+"""
+Big files are downloaded into the payload cache by a Download of their own,
+at whatever speed upstream sends them, and not at the pace of the browser
+that happened to ask first. The download goes on when that browser leaves.
+
+Every chunk is also appended to a spool file, and the requests for the file
+in the meantime, the first browser's included, follow that file as it
+grows (see Download.follow). So while a big file is on its way nobody in
+this process goes upstream for it again or waits for it to be done. Other
+processes wait for the payload flight to land like before, the Download
+lands it once the whole file is in the cache.
+"""
+from django.conf import settings
+
+import logging
+import os
+import tempfile
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_downloads = {}
+
+
+class Download:
+    """
+    Takes over the payload flight (see datasets/singleflight.py) of its
+    leader. Whoever starts it writes the chunks with write() and calls
+    finish() or abort() at the end, from any one thread at a time.
+    """
+
+    def __init__(self, flight, cache, dataset, meta, length=None):
+        self.flight = flight.hand_over()
+        self.meta = meta
+        self.length = length
+        self.size = 0
+        self.done = False
+        self.error = None
+        self._changed = threading.Condition()
+        self._waiting = []
+        self._stored = cache.store(dataset, self._pull(), meta)
+        fd, self.path = tempfile.mkstemp(prefix="dataset-download-")
+        self._spool = os.fdopen(fd, "wb")
+        with _lock:
+            _downloads[self.flight.key] = self
+
+    def _pull(self):
+        while self._waiting:
+            chunk = self._waiting.pop()
+            if chunk is None:
+                return
+            yield chunk
+
+    def write(self, chunk):
+        self._waiting.append(chunk)
+        next(self._stored)
+        self._spool.write(chunk)
+        self._spool.flush()
+        with self._changed:
+            self.size += len(chunk)
+            self._changed.notify_all()
+
+    def finish(self):
+        """
+        The entry shows up in the cache before anybody is told it's done.
+        """
+        self._waiting.append(None)
+        for chunk in self._stored:
+            pass
+        self._end(None)
+
+    def abort(self, error):
+        self._stored.close()
+        self._end(error)
+
+    def _end(self, error):
+        self._spool.close()
+        with _lock:
+            if _downloads.get(self.flight.key) is self:
+                del _downloads[self.flight.key]
+        with self._changed:
+            self.error = error
+            self.done = True
+            # whoever follows the spool file has it open already
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self._changed.notify_all()
+        self.flight.land()
+
+    def run(self, chunks):
+        """
+        Writes all of chunks, for a thread of its own.
+        """
+        try:
+            for chunk in chunks:
+                self.write(chunk)
+            self.finish()
+        except Exception as e:
+            logger.warning("download %s broke off: %s", self.flight.key, e)
+            if not self.done:
+                self.abort(e)
+
+    def start(self, chunks):
+        threading.Thread(target=self.run, args=(chunks,),
+                         name="dataset-download", daemon=True).start()
+
+    def follow(self, chunk_size=None):
+        """
+        The file from the start, as a generator that waits for the rest
+        while it's on its way. None once the download is over, by then the
+        file is in the cache (or didn't fit).
+        """
+        with self._changed:
+            if self.done:
+                return None
+            f = open(self.path, "rb")
+        return self._follow(f, chunk_size or settings.DATASET_CHUNK_SIZE)
+
+    def _follow(self, f, chunk_size):
+        position = 0
+        with f:
+            while True:
+                with self._changed:
+                    while position == self.size and not self.done:
+                        self._changed.wait()
+                    size, error = self.size, self.error
+                if position < size:
+                    chunk = f.read(min(chunk_size, size - position))
+                    position += len(chunk)
+                    yield chunk
+                elif error is not None:
+                    raise OSError("the download broke off: {}".format(error))
+                else:
+                    return
+
+
+def current_download(key):
+    """
+    The Download for the flight key that is going on in this process, or
+    None.
+    """
+    with _lock:
+        return _downloads.get(key)
+
+
+def streamed(length):
+    """
+    Whether a file of length bytes (None if upstream didn't say) is
+    streamed rather than read whole, see DATASET_STREAM_THRESHOLD.
+    """
+    return length is None or length > settings.DATASET_STREAM_THRESHOLD
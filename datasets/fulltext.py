@@ -0,0 +1,186 @@
+"""
+The full text index behind the portal's search box.
+
+Every dataset has one row in the index with three columns, weighted in
+that order when results are ranked:
+
+    title        - the dataset's title
+    names        - author, account name and keywords
+    description  - the description
+
+On PostgreSQL the row is a tsvector in datasets_dataset_search, with a GIN
+index on it. On SQLite it's a row in the datasets_dataset_fts FTS5 table.
+Both are created by migration 0006. Any other database, or a SQLite built
+without FTS5, gets the icontains search the portal always had.
+
+The index is kept up to date by the signal handlers in datasets/models.py,
+one dataset at a time as it, its keywords or its account's user name
+change. Every word typed into the search box has to be the start of a word
+in one of the columns.
+"""
+from django.conf import settings
+from django.db import connection, connections
+from django.db.models import FloatField, Q
+from django.db.models.expressions import RawSQL
+
+import functools
+import re
+
+
+SQLITE_TABLE = "datasets_dataset_fts"
+POSTGRES_TABLE = "datasets_dataset_search"
+
+# how much a match in title, names or description counts
+WEIGHTS = (10.0, 5.0, 1.0)
+
+
+def enabled(using=connection):
+    return _enabled(using.alias, using.vendor)
+
+
+@functools.lru_cache(maxsize=None)
+def _enabled(alias, vendor):
+    """
+    Looked up once per database, the table only comes and goes with the
+    migration, which forgets the answer (see create_index).
+    """
+    if vendor == "postgresql":
+        return True
+    if vendor != "sqlite":
+        return False
+    with connections[alias].cursor() as cursor:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = %s",
+                       [SQLITE_TABLE])
+        return cursor.fetchone() is not None
+
+
+def create_index(schema_editor):
+    """
+    For the migration, creates the table on the databases that have full
+    text search.
+    """
+    _enabled.cache_clear()
+    vendor = schema_editor.connection.vendor
+    if vendor == "postgresql":
+        schema_editor.execute(
+            "CREATE TABLE {} (dataset_id integer PRIMARY KEY REFERENCES "
+            "datasets_dataset (id) ON DELETE CASCADE DEFERRABLE INITIALLY "
+            "DEFERRED, document tsvector NOT NULL)".format(POSTGRES_TABLE))
+        schema_editor.execute(
+            "CREATE INDEX {0}_document ON {0} USING GIN (document)"
+            .format(POSTGRES_TABLE))
+    elif vendor == "sqlite":
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute("PRAGMA compile_options")
+            options = [row[0] for row in cursor.fetchall()]
+        if "ENABLE_FTS5" not in options:
+            return
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE {} USING fts5(title, names, description, "
+            "tokenize='unicode61 remove_diacritics 2')".format(SQLITE_TABLE))
+
+
+def drop_index(schema_editor):
+    _enabled.cache_clear()
+    vendor = schema_editor.connection.vendor
+    if vendor == "postgresql":
+        schema_editor.execute("DROP TABLE IF EXISTS {}"
+                              .format(POSTGRES_TABLE))
+    elif vendor == "sqlite":
+        schema_editor.execute("DROP TABLE IF EXISTS {}".format(SQLITE_TABLE))
+
+
+def document(dataset):
+    """
+    The title, names and description columns of a dataset.
+    """
+    names = [dataset.author or "", dataset.account.user.username]
+    names += [keyword.keyword or "" for keyword in dataset.keywords.all()]
+    return (dataset.title or "", " ".join(names), dataset.description or "")
+
+
+def index_dataset(dataset, using=connection):
+    if not enabled(using):
+        return
+    title, names, description = document(dataset)
+    with using.cursor() as cursor:
+        if using.vendor == "postgresql":
+            config = settings.DATASET_SEARCH_CONFIG
+            cursor.execute(
+                "INSERT INTO {} (dataset_id, document) VALUES (%s, "
+                "setweight(to_tsvector(%s::regconfig, %s), 'A') || "
+                "setweight(to_tsvector(%s::regconfig, %s), 'B') || "
+                "setweight(to_tsvector(%s::regconfig, %s), 'C')) "
+                "ON CONFLICT (dataset_id) DO UPDATE "
+                "SET document = EXCLUDED.document".format(POSTGRES_TABLE),
+                [dataset.pk, config, title, config, names,
+                 config, description])
+        else:
+            cursor.execute("DELETE FROM {} WHERE rowid = %s"
+                           .format(SQLITE_TABLE), [dataset.pk])
+            cursor.execute(
+                "INSERT INTO {} (rowid, title, names, description) "
+                "VALUES (%s, %s, %s, %s)".format(SQLITE_TABLE),
+                [dataset.pk, title, names, description])
+
+
+def unindex_dataset(pk, using=connection):
+    # on postgresql the foreign key takes care of it
+    if using.vendor == "sqlite" and enabled(using):
+        with using.cursor() as cursor:
+            cursor.execute("DELETE FROM {} WHERE rowid = %s"
+                           .format(SQLITE_TABLE), [pk])
+
+
+def words(q):
+    return re.findall(r"\w+", q)
+
+
+def search(datasets, q, using=connection):
+    """
+    The datasets out of a queryset that match q, best match first, as a
+    queryset. The ranking is done by the database, so slicing it only
+    reads that page's rows. Without any words in q that's all of them, by
+    title.
+    """
+    found = words(q)
+    if not found:
+        return datasets.order_by("title", "pk")
+    if not enabled(using):
+        return datasets.filter(
+            Q(title__icontains=q) |
+            Q(account__user__username__icontains=q) |
+            Q(author__icontains=q) |
+            Q(keywords__keyword__icontains=q) |
+            Q(description__icontains=q)
+        ).order_by("title", "pk").distinct()
+
+    if using.vendor == "postgresql":
+        # the words are letters and digits only, nothing in them means
+        # anything to to_tsquery
+        query = "to_tsquery(%s::regconfig, %s)"
+        params = [settings.DATASET_SEARCH_CONFIG,
+                  " & ".join(word + ":*" for word in found)]
+        return datasets.extra(
+            tables=[POSTGRES_TABLE],
+            where=["{}.dataset_id = datasets_dataset.id".format(
+                POSTGRES_TABLE), "document @@ " + query],
+            params=params,
+        ).annotate(
+            # ts_rank is bigger for better matches, bm25 smaller. It's a
+            # real, as a double it makes it through the page cursors of
+            # main/listing.py without being rounded.
+            search_rank=RawSQL("-ts_rank(document, {})::float8".format(
+                query), params, output_field=FloatField()),
+        ).order_by("search_rank", "pk")
+
+    query = " AND ".join('"{}"*'.format(word) for word in found)
+    return datasets.extra(
+        tables=[SQLITE_TABLE],
+        where=["{}.rowid = datasets_dataset.id".format(SQLITE_TABLE),
+               "{} MATCH %s".format(SQLITE_TABLE)],
+        params=[query],
+    ).annotate(
+        search_rank=RawSQL("bm25({}, %s, %s, %s)".format(SQLITE_TABLE),
+                           list(WEIGHTS), output_field=FloatField()),
+    ).order_by("search_rank", "pk")
@@ -0,0 +1,160 @@
+"""
+What the portal knows about a dataset's file without loading it: how many
+features it has, where they are, what kind of geometries and properties they
+have, how big the file is and its sha1.
+
+harvest goes through the file once, the features are looked at one at a
+time as they come out of datasets/convert.py and the size and sha1 are
+worked out from the same chunks. It runs as a background job after a
+dataset's source changed (see invalidate_dataset_payload), after
+refresh_datasets downloaded a new version, and from the harvest_datasets
+command for the datasets that were added before there was harvesting.
+
+The results are written with a queryset update(), a save() would start
+another round of invalidating and harvesting. The cached pages that show
+them are bumped by hand instead (see datasets/pagecache.py).
+"""
+from django.apps import apps
+from django.utils import timezone
+
+from datasets.cache import fetch_payload, payload_cache
+from datasets.convert import ConversionError, features
+from datasets.pagecache import CATALOGUE, account_scope, bump
+from datasets.spatial import geometry_bbox
+from datasets.upstream import UpstreamError
+
+import hashlib
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# how a json value shows up in property_schema
+JSON_TYPES = ((bool, "boolean"), ((int, float), "number"), (str, "string"),
+              (list, "array"), (dict, "object"), (type(None), "null"))
+
+
+def _json_type(value):
+    # bool first, True is an int too
+    for types, name in JSON_TYPES:
+        if isinstance(value, types):
+            return name
+    return "string"
+
+
+class Summary:
+    """
+    Everything harvest finds out about one file, built up feature by
+    feature.
+    """
+
+    def __init__(self):
+        self.feature_count = 0
+        self.bbox = None
+        self.geometry_types = set()
+        self.property_schema = {}
+        self.byte_size = 0
+        self._sha1 = hashlib.sha1()
+
+    @property
+    def content_sha1(self):
+        return self._sha1.hexdigest()
+
+    def counted(self, chunks):
+        for chunk in chunks:
+            self.byte_size += len(chunk)
+            self._sha1.update(chunk)
+            yield chunk
+
+    def add(self, feature):
+        self.feature_count += 1
+        geometry = feature.get("geometry")
+        if geometry:
+            self.geometry_types.add(geometry.get("type"))
+            bbox = geometry_bbox(geometry)
+            if bbox is not None and self.bbox is None:
+                self.bbox = bbox
+            elif bbox is not None:
+                self.bbox = [min(self.bbox[0], bbox[0]),
+                             min(self.bbox[1], bbox[1]),
+                             max(self.bbox[2], bbox[2]),
+                             max(self.bbox[3], bbox[3])]
+        for name, value in (feature.get("properties") or {}).items():
+            types = self.property_schema.setdefault(name, [])
+            kind = _json_type(value)
+            if kind not in types:
+                types.append(kind)
+                types.sort()
+
+    def fields(self):
+        """
+        The Dataset fields to update.
+        """
+        west, south, east, north = self.bbox or (None, None, None, None)
+        return {"feature_count": self.feature_count,
+                "bbox_west": west, "bbox_south": south,
+                "bbox_east": east, "bbox_north": north,
+                "geometry_types": ",".join(sorted(self.geometry_types)),
+                "property_schema": self.property_schema,
+                "byte_size": self.byte_size,
+                "content_sha1": self.content_sha1}
+
+
+def summarise(ext, chunks):
+    """
+    The Summary of a file, raises ConversionError when it can't be read.
+    The size and sha1 are always of the whole file.
+    """
+    summary = Summary()
+    counted = summary.counted(chunks)
+    try:
+        for feature in features(ext, counted):
+            summary.add(feature)
+    finally:
+        for chunk in counted:
+            pass
+    return summary
+
+
+def harvest(dataset, cache=None, force=False):
+    """
+    Harvests the dataset's current file, unless it was harvested already
+    (going by the sha1 of the copy in the payload cache). Returns True when
+    the fields were updated.
+    """
+    cache = cache or payload_cache()
+    Dataset = apps.get_model("datasets", "Dataset")
+    try:
+        source = fetch_payload(dataset, cache)
+    except (UpstreamError, OSError) as e:
+        logger.warning("could not harvest dataset %s: %s", dataset.pk, e)
+        Dataset.objects.filter(pk=dataset.pk).update(
+            harvest_error=str(e)[:500])
+        return False
+
+    if (not force and source.meta.get("sha1") and
+            source.meta["sha1"] == dataset.content_sha1):
+        return False
+
+    try:
+        fields = summarise(dataset.ext, source.chunks()).fields()
+        fields["harvest_error"] = ""
+    except ConversionError as e:
+        fields = {"harvest_error": str(e)[:500]}
+    fields["harvested_at"] = timezone.now()
+    Dataset.objects.filter(pk=dataset.pk).update(**fields)
+    for name, value in fields.items():
+        setattr(dataset, name, value)
+    # the extent search on the portal goes by the bbox
+    bump(CATALOGUE, account_scope(dataset.account.account_slug))
+    return True
+
+
+def harvest_dataset(pk):
+    """
+    The background job.
+    """
+    Dataset = apps.get_model("datasets", "Dataset")
+    dataset = Dataset.objects.filter(pk=pk).first()
+    if dataset is not None:
+        harvest(dataset)
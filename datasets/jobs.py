@@ -0,0 +1,69 @@
+"""
+Work that shouldn't hold up a request, like building the simplified
+versions of a dataset after it was saved. There is no task queue behind the
+site, so this is a small pool of threads in the web process. Jobs are only
+started once the transaction that asked for them has been committed.
+
+With DATASET_BACKGROUND_JOBS = False the jobs run right away instead, in the
+thread that asked for them.
+"""
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_executor = None
+
+
+def _pool():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.DATASET_BACKGROUND_WORKERS,
+                thread_name_prefix="dataset-jobs")
+    return _executor
+
+
+def _run(func, args):
+    try:
+        func(*args)
+    except Exception:
+        logger.exception("background job %s failed", func.__name__)
+
+
+def _run_in_thread(func, args):
+    try:
+        _run(func, args)
+    finally:
+        # every thread gets its own database connection, give it back
+        close_old_connections()
+
+
+def run_in_background(func, *args):
+    """
+    Runs func(*args) in the pool once the current transaction is committed.
+    Errors are logged, nobody is waiting for the result.
+    """
+    if not settings.DATASET_BACKGROUND_JOBS:
+        transaction.on_commit(lambda: _run(func, args))
+        return
+    transaction.on_commit(lambda: _pool().submit(_run_in_thread, func, args))
+
+
+def start_in_background(func, *args):
+    """
+    Like run_in_background, for work that doesn't depend on what the current
+    transaction changed: it starts right away.
+    """
+    if not settings.DATASET_BACKGROUND_JOBS:
+        _run(func, args)
+        return
+    _pool().submit(_run_in_thread, func, args)
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from datasets.snapshot import export
+
+
+class Command(BaseCommand):
+    help = ("Writes the dataset and embed pages of every public dataset, "
+            "and a copy of its file, into a directory that can be served "
+            "without django, see datasets/snapshot.py. Only the datasets "
+            "that changed since the last run are exported again.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("directory")
+        parser.add_argument(
+            "--all", action="store_true",
+            help="export every dataset again, after the templates changed")
+
+    def handle(self, *args, **options):
+        def report(dataset, error):
+            if options["verbosity"] >= 2:
+                self.stdout.write("{} {}: {}".format(
+                    dataset.pk, dataset.title, error or "exported"))
+
+        counts = export(options["directory"], full=options["all"],
+                        report=report)
+        self.stdout.write("{exported} exported, {removed} removed, "
+                          "{failed} failed".format(**counts))
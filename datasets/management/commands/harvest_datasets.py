@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from datasets.harvest import harvest
+from datasets.models import Dataset
+
+
+class Command(BaseCommand):
+    help = ("Fills in the feature count, bounding box, geometry types, "
+            "property schema, size and sha1 of the datasets that weren't "
+            "harvested yet, see datasets/harvest.py.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all", action="store_true",
+            help="harvest every dataset again, even when its file didn't "
+                 "change")
+
+    def handle(self, *args, **options):
+        datasets = Dataset.objects.order_by("pk")
+        if not options["all"]:
+            datasets = datasets.filter(harvested_at__isnull=True)
+
+        harvested = 0
+        for dataset in datasets:
+            if harvest(dataset, force=options["all"]):
+                harvested += 1
+            if options["verbosity"] >= 2:
+                self.stdout.write("{} {}: {}".format(
+                    dataset.pk, dataset.title,
+                    dataset.harvest_error or dataset.feature_count))
+        self.stdout.write("{} harvested".format(harvested))
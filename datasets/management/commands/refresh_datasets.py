@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand
+from django.db.models import F
+
+from datasets.models import Dataset
+from datasets.refresh import refresh_all
+
+import time
+
+
+class Command(BaseCommand):
+    help = ("Downloads or revalidates the files of all datasets into the "
+            "payload cache, the most loaded ones first. With --loop it keeps "
+            "doing that, as a long running worker.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int, default=None,
+            help="downloads at the same time, DATASET_REFRESH_WORKERS if "
+                 "not given")
+        parser.add_argument(
+            "--ahead", type=int, default=None,
+            help="also refresh copies that go stale within this many "
+                 "seconds, DATASET_REFRESH_AHEAD if not given")
+        parser.add_argument(
+            "--limit", type=int, default=None,
+            help="only the first this many datasets")
+        parser.add_argument(
+            "--loop", type=int, default=None, metavar="SECONDS",
+            help="start another pass this many seconds after one is done")
+        parser.add_argument(
+            "--no-decay", action="store_true",
+            help="don't halve the access counts after a pass")
+
+    def handle(self, *args, **options):
+        while True:
+            self.run_pass(options)
+            if options["loop"] is None:
+                return
+            time.sleep(options["loop"])
+
+    def run_pass(self, options):
+        def report(dataset, result):
+            if options["verbosity"] >= 2:
+                self.stdout.write("{} {}: {}".format(
+                    dataset.pk, dataset.title, result))
+
+        results = refresh_all(options["workers"], options["ahead"],
+                              options["limit"], report)
+
+        # older loads count for less and less, so what is popular right now
+        # comes first
+        if not options["no_decay"]:
+            Dataset.objects.update(access_count=F("access_count") / 2)
+
+        totals = {}
+        for result in results.values():
+            totals[result] = totals.get(result, 0) + 1
+        self.stdout.write(", ".join(
+            "{} {}".format(count, result)
+            for result, count in sorted(totals.items())) or "no datasets")
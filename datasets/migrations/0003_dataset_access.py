@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasets', '0002_auto_20170706_1318'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataset',
+            name='access_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='dataset',
+            name='last_accessed',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasets', '0004_dataset_metadata'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='dataset',
+            index=models.Index(fields=['bbox_west', 'bbox_east'], name='dataset_bbox_x'),
+        ),
+        migrations.AddIndex(
+            model_name='dataset',
+            index=models.Index(fields=['bbox_south', 'bbox_north'], name='dataset_bbox_y'),
+        ),
+    ]
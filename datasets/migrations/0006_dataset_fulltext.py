@@ -0,0 +1,27 @@
+from django.db import migrations
+
+from datasets import fulltext
+
+
+def create_index(apps, schema_editor):
+    fulltext.create_index(schema_editor)
+    Dataset = apps.get_model("datasets", "Dataset")
+    datasets = Dataset.objects.using(schema_editor.connection.alias)
+    for dataset in datasets.select_related("account__user").prefetch_related(
+            "keywords"):
+        fulltext.index_dataset(dataset, using=schema_editor.connection)
+
+
+def drop_index(apps, schema_editor):
+    fulltext.drop_index(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasets', '0005_dataset_bbox_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasets', '0006_dataset_fulltext'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='dataset',
+            index=models.Index(fields=['title', 'id'], name='dataset_title'),
+        ),
+    ]
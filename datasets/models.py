@@ -1,12 +1,24 @@
+from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.urls import reverse
 from django.db import models
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.db.models.signals import pre_delete, pre_save
+from django.dispatch import receiver
 from django.utils.text import slugify
 
 from accounts.models import Account
-from keywords.models import Keyword
+from keywords.models import Keyword, count_datasets
 
-from cryptography.fernet import Fernet
+from datasets import autocomplete, pagecache
+from datasets.cache import payload_cache
+from datasets.fulltext import index_dataset, unindex_dataset
+from datasets.harvest import harvest_dataset
+from datasets.jobs import run_in_background
+from datasets.pagecache import CATALOGUE, account_scope
+from datasets.simplify import build_levels
+
+from cryptography.fernet import Fernet, InvalidToken
 
 import json
 import os
@@ -16,6 +28,20 @@ CRYPTO_KEY = os.environ.get("CRYPTO_KEY")
 cipher = Fernet(CRYPTO_KEY)
 
 
+def encrypted(value):
+    """
+    Encrypts value unless it already is one of our tokens. Fernet tokens
+    are different every time, so encrypting the stored credentials again
+    on every save would look like a new source to source_changed and
+    throw the cached file away.
+    """
+    try:
+        cipher.decrypt(value.encode("utf-8"))
+    except InvalidToken:
+        return cipher.encrypt(value.encode("utf-8")).decode("utf-8")
+    return value
+
+
 class Dataset(models.Model):
     """
     This is the webapplication's main model, it will be have to be
@@ -63,8 +89,42 @@ class Dataset(models.Model):
     ext = models.CharField(max_length=12, default="geojson",
                            blank=True, null=True)
 
+    # how often the file was loaded lately, so the refresh_datasets command
+    # knows which ones to keep warm first, see datasets/access.py
+    access_count = models.PositiveIntegerField(default=0, editable=False)
+    last_accessed = models.DateTimeField(null=True, blank=True,
+                                         editable=False)
+
+    # what's in the file, filled in by datasets/harvest.py after the
+    # dataset is saved. Empty until then, and when the file couldn't be
+    # read harvest_error says why
+    feature_count = models.PositiveIntegerField(null=True, blank=True,
+                                                editable=False)
+    bbox_west = models.FloatField(null=True, blank=True, editable=False)
+    bbox_south = models.FloatField(null=True, blank=True, editable=False)
+    bbox_east = models.FloatField(null=True, blank=True, editable=False)
+    bbox_north = models.FloatField(null=True, blank=True, editable=False)
+    geometry_types = models.CharField(max_length=200, blank=True, default="",
+                                      editable=False)
+    property_schema = models.JSONField(null=True, blank=True, editable=False)
+    byte_size = models.BigIntegerField(null=True, blank=True, editable=False)
+    content_sha1 = models.CharField(max_length=40, blank=True, default="",
+                                    editable=False)
+    harvested_at = models.DateTimeField(null=True, blank=True,
+                                        editable=False)
+    harvest_error = models.CharField(max_length=500, blank=True, default="",
+                                     editable=False)
+
     class Meta:
         unique_together = ("account", "title")
+        # for the map extent search, see datasets/search.py
+        indexes = [models.Index(fields=["bbox_west", "bbox_east"],
+                                name="dataset_bbox_x"),
+                   models.Index(fields=["bbox_south", "bbox_north"],
+                                name="dataset_bbox_y"),
+                   # the lists are paged by title, see main/listing.py
+                   models.Index(fields=["title", "id"],
+                                name="dataset_title")]
 
     def __str__(self):
         return self.title
@@ -89,17 +149,10 @@ class Dataset(models.Model):
         # encrypt the password and username
         # I'd like to do this with the owncloud stuff as well
         if self.dataset_password:
-            bytes_password = self.dataset_password.encode('utf-8')
-            encrypted_password = cipher.encrypt(bytes_password)
-            self.dataset_password = encrypted_password.decode('utf-8')
+            self.dataset_password = encrypted(self.dataset_password)
 
         if self.dataset_user:
-            bytes_user = self.dataset_user.encode('utf-8')
-            encrypted_user = cipher.encrypt(bytes_user)
-            self.dataset_user = encrypted_user.decode('utf-8')
-
-            self.dataset_user = cipher.encrypt(bytes_user)
-            self.dataset_user = self.dataset_user.decode('utf-8')
+            self.dataset_user = encrypted(self.dataset_user)
 
         self.dataset_slug = slugify(self.title)
         super(Dataset, self).save(*args, **kwargs)
@@ -109,3 +162,245 @@ class Dataset(models.Model):
                   "dataset_slug": self.dataset_slug}
 
         return reverse("datasets:dataset_detail", kwargs=kwargs)
+
+
+# the fields that decide what load_dataset gets back from upstream
+SOURCE_FIELDS = {"url", "owncloud", "owncloud_instance", "owncloud_path",
+                 "dataset_user", "dataset_password"}
+
+
+@receiver(pre_save, sender=Dataset)
+def remember_dataset_source(sender, instance, update_fields, **kwargs):
+    instance._stored_source = None
+    if instance._state.adding or (update_fields is not None and
+                                  not SOURCE_FIELDS & set(update_fields)):
+        return
+    instance._stored_source = Dataset.objects.filter(
+        pk=instance.pk).values(*SOURCE_FIELDS).first()
+
+
+def source_changed(instance, update_fields):
+    """
+    Whether the save changed any of the SOURCE_FIELDS in the database, an
+    edited title or description leaves the cached file alone.
+    """
+    if update_fields is not None and not SOURCE_FIELDS & set(update_fields):
+        return False
+    stored = getattr(instance, "_stored_source", None)
+    if stored is None:
+        return True
+    return any(stored[name] != getattr(instance, name)
+               for name in SOURCE_FIELDS
+               if update_fields is None or name in update_fields)
+
+
+@receiver(post_save, sender=Dataset)
+def invalidate_dataset_payload(sender, instance, update_fields, **kwargs):
+    if source_changed(instance, update_fields):
+        payload_cache().invalidate(instance.pk)
+        run_in_background(harvest_dataset, instance.pk)
+        # csv and tsv files are only points, there is nothing to simplify
+        if instance.ext not in ("csv", "tsv"):
+            run_in_background(build_levels, instance.pk)
+
+
+@receiver(post_delete, sender=Dataset)
+def remove_dataset_payload(sender, instance, **kwargs):
+    payload_cache().invalidate(instance.pk)
+
+
+# keeping the full text index (datasets/fulltext.py) up to date
+
+def reindex_datasets(datasets):
+    for dataset in datasets.select_related("account__user").prefetch_related(
+            "keywords"):
+        index_dataset(dataset)
+
+
+@receiver(post_save, sender=Dataset)
+def index_saved_dataset(sender, instance, **kwargs):
+    index_dataset(instance)
+
+
+@receiver(post_delete, sender=Dataset)
+def unindex_deleted_dataset(sender, instance, **kwargs):
+    unindex_dataset(instance.pk)
+
+
+@receiver(m2m_changed, sender=Dataset.keywords.through)
+def index_dataset_keywords(sender, instance, action, reverse, pk_set,
+                           **kwargs):
+    if reverse and action == "pre_clear":
+        # afterwards there's no telling which datasets had the keyword
+        instance._cleared_datasets = list(
+            instance.datasets.values_list("pk", flat=True))
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if not reverse:
+        index_dataset(instance)
+    elif action == "post_clear":
+        reindex_datasets(Dataset.objects.filter(
+            pk__in=instance._cleared_datasets))
+    else:
+        reindex_datasets(Dataset.objects.filter(pk__in=pk_set))
+
+
+@receiver(post_save, sender=Keyword)
+def index_renamed_keyword(sender, instance, created, **kwargs):
+    if not created:
+        reindex_datasets(instance.datasets.all())
+
+
+@receiver(pre_delete, sender=Keyword)
+def remember_keyword_datasets(sender, instance, **kwargs):
+    instance._deleted_from = list(
+        instance.datasets.values_list("pk", flat=True))
+
+
+@receiver(post_delete, sender=Keyword)
+def index_deleted_keyword(sender, instance, **kwargs):
+    reindex_datasets(Dataset.objects.filter(pk__in=instance._deleted_from))
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def index_renamed_user(sender, instance, created, update_fields, **kwargs):
+    # logging in saves the user too, only with update_fields=["last_login"]
+    if created or (update_fields is not None and
+                   "username" not in update_fields):
+        return
+    reindex_datasets(Dataset.objects.filter(account__user=instance))
+
+
+# anything that changes what the search box can suggest, see
+# datasets/autocomplete.py
+
+@receiver(post_save, sender=Dataset)
+@receiver(post_delete, sender=Dataset)
+@receiver(post_save, sender=Keyword)
+@receiver(post_delete, sender=Keyword)
+@receiver(post_delete, sender=Account)
+def invalidate_autocomplete(sender, **kwargs):
+    autocomplete.invalidate()
+
+
+@receiver(post_save, sender=Account)
+def invalidate_autocomplete_account(sender, instance, created, **kwargs):
+    # accounts are saved whenever their user is, that alone changes nothing
+    if created:
+        autocomplete.invalidate()
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def invalidate_autocomplete_user(sender, instance, created, update_fields,
+                                 **kwargs):
+    if created or (update_fields is not None and
+                   "username" not in update_fields):
+        return
+    autocomplete.invalidate()
+
+
+# Keyword.dataset_count
+
+@receiver(m2m_changed, sender=Dataset.keywords.through)
+def count_keyword_datasets(sender, instance, action, reverse, pk_set,
+                           **kwargs):
+    if action == "pre_clear" and not reverse:
+        instance._cleared_keywords = list(
+            instance.keywords.values_list("pk", flat=True))
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if reverse:
+        count_datasets(Keyword.objects.filter(pk=instance.pk))
+    elif action == "post_clear":
+        count_datasets(Keyword.objects.filter(
+            pk__in=instance._cleared_keywords))
+    else:
+        count_datasets(Keyword.objects.filter(pk__in=pk_set))
+
+
+@receiver(pre_delete, sender=Dataset)
+def remember_dataset_keywords(sender, instance, **kwargs):
+    instance._deleted_keywords = list(
+        instance.keywords.values_list("pk", flat=True))
+
+
+@receiver(post_delete, sender=Dataset)
+def count_deleted_dataset_keywords(sender, instance, **kwargs):
+    count_datasets(Keyword.objects.filter(pk__in=instance._deleted_keywords))
+
+
+# the cached pages, see datasets/pagecache.py
+
+def account_slugs(dataset_pks):
+    return set(Dataset.objects.filter(pk__in=dataset_pks).values_list(
+        "account__account_slug", flat=True))
+
+
+@receiver(post_save, sender=Dataset)
+@receiver(post_delete, sender=Dataset)
+def bump_dataset_pages(sender, instance, **kwargs):
+    pagecache.bump(CATALOGUE, account_scope(instance.account.account_slug))
+
+
+@receiver(m2m_changed, sender=Dataset.keywords.through)
+def bump_dataset_keyword_pages(sender, instance, action, reverse, pk_set,
+                               **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if not reverse:
+        slugs = [instance.account.account_slug]
+    elif action == "post_clear":
+        # index_dataset_keywords remembered them before the clear
+        slugs = account_slugs(instance._cleared_datasets)
+    else:
+        slugs = account_slugs(pk_set)
+    pagecache.bump(CATALOGUE)
+    pagecache.bump_accounts(slugs)
+
+
+@receiver(post_save, sender=Keyword)
+def bump_keyword_pages(sender, instance, created, **kwargs):
+    pagecache.bump(CATALOGUE)
+    if not created:
+        pagecache.bump_accounts(account_slugs(
+            instance.datasets.values_list("pk", flat=True)))
+
+
+@receiver(post_delete, sender=Keyword)
+def bump_deleted_keyword_pages(sender, instance, **kwargs):
+    pagecache.bump(CATALOGUE)
+    pagecache.bump_accounts(account_slugs(instance._deleted_from))
+
+
+@receiver(post_save, sender=Account)
+def bump_account_pages(sender, instance, created, **kwargs):
+    # like invalidate_autocomplete_account, renames are bump_renamed_user's
+    if created:
+        pagecache.bump(CATALOGUE)
+
+
+@receiver(post_delete, sender=Account)
+def bump_deleted_account_pages(sender, instance, **kwargs):
+    pagecache.bump(CATALOGUE, account_scope(instance.account_slug))
+
+
+@receiver(pre_save, sender=settings.AUTH_USER_MODEL)
+def remember_account_slug(sender, instance, update_fields, **kwargs):
+    if instance.pk is None or (update_fields is not None and
+                               "username" not in update_fields):
+        return
+    instance._old_account_slug = Account.objects.filter(
+        user=instance).values_list("account_slug", flat=True).first()
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def bump_renamed_user(sender, instance, created, update_fields, **kwargs):
+    if created or (update_fields is not None and
+                   "username" not in update_fields):
+        return
+    # the pages under the old name have to go too, or they'd still be
+    # served instead of a 404
+    pagecache.bump(CATALOGUE)
+    pagecache.bump_accounts({instance.account.account_slug,
+                             getattr(instance, "_old_account_slug", None)}
+                            - {None})
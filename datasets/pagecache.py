@@ -0,0 +1,154 @@
+"""
+Whole pages out of PAGE_CACHE (one of the CACHES), for the ones everybody
+looks at: the portal, the keyword pages and the dataset and embed pages.
+Most of what comes in are anonymous requests for the embedded maps, and
+those don't have to touch the database at all this way.
+
+Nothing is ever deleted from the cache. Every page is kept under the
+versions of what it shows, and the signal handlers in datasets/models.py
+give those a new version when something changes, so the next request
+doesn't find the old page any more. There are two kinds of versions:
+
+    "catalogue"         the portal and the keyword pages, anything that
+                        lists datasets
+    "account:<slug>"    the dataset and embed pages of that account
+
+Logged in users see their own name on every page, and the owner of a
+dataset gets the edit links, so every user has their own copies. The embed
+pages look the same for everybody and have only one. Only 200 answers to
+GET and HEAD are kept.
+
+public_page goes on top of that for the embed pages, those can be kept by
+the browsers and any CDN in between too.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.cache import set_response_etag
+
+from functools import wraps
+
+import hashlib
+import uuid
+
+
+CATALOGUE = "catalogue"
+
+
+def account_scope(account_slug):
+    return "account:{}".format(account_slug)
+
+
+def _version_key(scope):
+    return "page-version:{}".format(scope)
+
+
+def versions(scopes):
+    """
+    The current version of every scope, the ones that don't have one yet
+    get it now.
+    """
+    cache = caches[settings.PAGE_CACHE]
+    keys = [_version_key(scope) for scope in scopes]
+    found = cache.get_many(keys)
+    for key in keys:
+        if key not in found:
+            cache.add(key, uuid.uuid4().hex, None)
+            found[key] = cache.get(key)
+    return [found[key] for key in keys]
+
+
+def bump(*scopes):
+    """
+    Everything cached under these scopes is out of date.
+    """
+    if scopes and settings.PAGE_CACHE is not None:
+        caches[settings.PAGE_CACHE].set_many(
+            {_version_key(scope): uuid.uuid4().hex for scope in scopes},
+            None)
+
+
+def bump_accounts(slugs):
+    bump(*{account_scope(slug) for slug in slugs})
+
+
+def _viewer(request):
+    user = request.user
+    if not user.is_authenticated:
+        return "anonymous"
+    return "user:{}:{}".format(user.pk, user.get_username())
+
+
+def page_key(request, view_name, scopes, per_user=True):
+    # asking for request.user reads the session, and that alone adds
+    # Vary: Cookie to the answer
+    viewer = _viewer(request) if per_user else "anybody"
+    parts = [view_name, viewer, request.get_full_path()]
+    parts += versions(scopes)
+    digest = hashlib.md5("\n".join(parts).encode("utf-8")).hexdigest()
+    return "page:{}".format(digest)
+
+
+def cache_page(scopes, per_user=True):
+    """
+    Keeps the view's pages in PAGE_CACHE. scopes(**kwargs) gets the view's
+    url arguments and returns the scopes the page belongs to. With
+    per_user=False everybody gets the same copy, only for pages that never
+    look at request.user. The answer says whether it came from the cache in
+    X-Page-Cache.
+    """
+    def decorator(view):
+        view_name = "{}.{}".format(view.__module__, view.__name__)
+
+        @wraps(view)
+        def cached_view(request, *args, **kwargs):
+            if (settings.PAGE_CACHE is None or
+                    request.method not in ("GET", "HEAD")):
+                return view(request, *args, **kwargs)
+
+            cache = caches[settings.PAGE_CACHE]
+            key = page_key(request, view_name, scopes(**kwargs), per_user)
+            entry = cache.get(key)
+            if entry is not None:
+                content, headers = entry
+                response = HttpResponse(content)
+                for name, value in headers:
+                    response[name] = value
+                response["X-Page-Cache"] = "hit"
+                return response
+
+            response = view(request, *args, **kwargs)
+            if (response.status_code == 200 and not response.streaming and
+                    not response.cookies):
+                cache.set(key, (response.content, list(response.items())),
+                          settings.PAGE_CACHE_TIMEOUT)
+            response["X-Page-Cache"] = "miss"
+            return response
+        return cached_view
+    return decorator
+
+
+def public_page(view):
+    """
+    Lets browsers and CDNs keep the view's 200 answers for PUBLIC_PAGE_MAX_AGE
+    seconds, and after that go on showing them for up to
+    PUBLIC_PAGE_STALE_WHILE_REVALIDATE seconds while they ask again in the
+    background. The ETag is the md5 of the page, so asking again is a 304
+    unless something changed.
+    """
+    @wraps(view)
+    def public_view(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        if (response.status_code != 200 or response.streaming or
+                request.method not in ("GET", "HEAD")):
+            return response
+        set_response_etag(response)
+        patch_cache_control(
+            response, public=True, max_age=settings.PUBLIC_PAGE_MAX_AGE,
+            stale_while_revalidate=settings.PUBLIC_PAGE_STALE_WHILE_REVALIDATE)
+        patch_vary_headers(response, ("Accept-Encoding",))
+        return get_conditional_response(request, etag=response["ETag"],
+                                        response=response)
+    return public_view
@@ -0,0 +1,146 @@
+"""
+Keeping the payload cache warm, so that people opening a map get the copy
+we already have instead of waiting on upstream. This is what the
+refresh_datasets management command runs.
+
+Every pass goes through the datasets most loaded first (see
+datasets/access.py) and revalidates every copy that is stale or will be
+within `ahead` seconds. Copies are only replaced once the new one is
+complete, until then the old one keeps being served. Downloads run on a few
+threads, with at most DATASET_REFRESH_PER_HOST at a time going to the same
+server and DATASET_REFRESH_HOST_INTERVAL seconds between them, the data
+owners' servers shouldn't notice us more than a handful of visitors would.
+"""
+from django.conf import settings
+
+from datasets.cache import payload_cache, refresh_payload
+from datasets.harvest import harvest
+from datasets.models import Dataset
+from datasets.upstream import UpstreamError
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib import parse
+
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# what can happen to one dataset in a pass
+SKIPPED = "skipped"
+CHANGED = "changed"
+REVALIDATED = "revalidated"
+FAILED = "failed"
+
+
+class HostLimits:
+    """
+    At most per_host downloads from the same host at a time, and at least
+    interval seconds between two of them starting.
+    """
+
+    def __init__(self, per_host, interval):
+        self.per_host = per_host
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    @contextmanager
+    def slot(self, host):
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = (threading.Semaphore(self.per_host),
+                                     threading.Lock(), [0.0])
+            semaphore, spacing, started = self._hosts[host]
+
+        with semaphore:
+            with spacing:
+                wait = started[0] + self.interval - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                started[0] = time.time()
+            yield
+
+
+def dataset_host(dataset):
+    if dataset.owncloud:
+        return parse.urlsplit(dataset.owncloud_instance or "").netloc
+    return parse.urlsplit(dataset.url or "").netloc
+
+
+def needs_refresh(cached, ahead):
+    """
+    True when there's no copy, or it goes stale within ahead seconds.
+    """
+    if cached is None or not cached.fresh:
+        return True
+    age = time.time() - cached.meta.get("fetched_at", 0)
+    return age >= settings.DATASET_CACHE_TIMEOUT - ahead
+
+
+def refresh_dataset(dataset, cache, limits, ahead):
+    before = cache.get(dataset, stale=True)
+    if not needs_refresh(before, ahead):
+        return SKIPPED
+
+    try:
+        with limits.slot(dataset_host(dataset)):
+            refresh_payload(dataset, cache)
+    except (UpstreamError, OSError) as e:
+        # requests' connection errors are OSErrors too
+        logger.warning("could not refresh dataset %s: %s", dataset.pk, e)
+        return FAILED
+    except Exception:
+        # owncloud errors, credentials that can't be decrypted any more...
+        # one broken dataset mustn't stop the pass
+        logger.exception("could not refresh dataset %s", dataset.pk)
+        return FAILED
+
+    after = cache.get(dataset, stale=True)
+    if after is None:
+        return FAILED
+    if before is None or after.meta.get("sha1") != before.meta.get("sha1"):
+        return CHANGED
+    if after.meta.get("fetched_at", 0) > before.meta.get("fetched_at", 0):
+        return REVALIDATED
+    # upstream answered with an error and the old copy was kept
+    return FAILED
+
+
+def refresh_all(workers=None, ahead=None, limit=None, report=None):
+    """
+    One pass over the datasets, returns {pk: what happened}. report(dataset,
+    result) is called as each one is done. The ones that changed are
+    harvested again (datasets/harvest.py) at the end.
+    """
+    workers = workers or settings.DATASET_REFRESH_WORKERS
+    ahead = settings.DATASET_REFRESH_AHEAD if ahead is None else ahead
+    cache = payload_cache()
+    limits = HostLimits(settings.DATASET_REFRESH_PER_HOST,
+                        settings.DATASET_REFRESH_HOST_INTERVAL)
+
+    datasets = list(Dataset.objects.order_by(
+        "-access_count", "-last_accessed", "pk")[:limit])
+
+    def run(dataset):
+        result = refresh_dataset(dataset, cache, limits, ahead)
+        if report is not None:
+            report(dataset, result)
+        return result
+
+    # the threads only download, everything from the database was read
+    # above already
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(run, datasets))
+
+    for dataset, result in zip(datasets, results):
+        if result != CHANGED:
+            continue
+        try:
+            harvest(dataset, cache)
+        except Exception:
+            logger.exception("could not harvest dataset %s", dataset.pk)
+    return {dataset.pk: result for dataset, result in zip(datasets, results)}
@@ -0,0 +1,66 @@
+"""
+Finding datasets for the portal.
+
+By map extent: the bounding boxes harvest stored (datasets/harvest.py) are
+compared with the map view in the database. The bbox columns are indexed in
+pairs, west / east and south / north, which works the same on SQLite and
+PostgreSQL without needing an extension. Datasets that weren't harvested
+yet have no bbox and are never found this way.
+
+What comes back is ranked by how much the dataset's bbox and the map view
+have in common, the area they share over the area they cover together. A
+dataset about just this part of the map comes before one about the whole
+world that happens to include it.
+"""
+from django.db.models import Case, F, FloatField, Q, Value, When
+from django.db.models.functions import Greatest, Least
+
+
+# points have no area, they still need some to be ranked
+MIN_SIZE = 1e-9
+
+
+def _intersects(bbox):
+    west, south, east, north = bbox
+    return (Q(bbox_west__lte=east) & Q(bbox_east__gte=west) &
+            Q(bbox_south__lte=north) & Q(bbox_north__gte=south))
+
+
+def in_extent(datasets, bbox):
+    """
+    The datasets out of a queryset whose bbox intersects bbox.
+    """
+    return datasets.filter(_intersects(bbox))
+
+
+def _area(west, south, east, north):
+    return (Greatest(east - west, Value(MIN_SIZE)) *
+            Greatest(north - south, Value(MIN_SIZE)))
+
+
+def overlap(bbox):
+    """
+    Intersection over union of the dataset's bbox and bbox, 0 to 1, as an
+    expression for annotate().
+    """
+    west, south, east, north = [float(value) for value in bbox]
+    shared = _area(Greatest(F("bbox_west"), Value(west)),
+                   Greatest(F("bbox_south"), Value(south)),
+                   Least(F("bbox_east"), Value(east)),
+                   Least(F("bbox_north"), Value(north)))
+    own = _area(F("bbox_west"), F("bbox_south"),
+                F("bbox_east"), F("bbox_north"))
+    view = max(east - west, MIN_SIZE) * max(north - south, MIN_SIZE)
+    return Case(
+        When(_intersects(bbox), then=shared / (own + Value(view) - shared)),
+        default=Value(0.0), output_field=FloatField())
+
+
+def rank_by_overlap(datasets, bbox):
+    """
+    The datasets out of a queryset, the ones that fit bbox best first. The
+    order the queryset had decides between equals. It's all done by the
+    database, so a page of it only reads that page's rows.
+    """
+    return datasets.annotate(overlap=overlap(bbox)).order_by(
+        "-overlap", *(datasets.query.order_by or ("pk",)))
@@ -0,0 +1,266 @@
+"""
+Smaller versions of a dataset's lines and polygons for when the map is
+zoomed out. At zoom level z a pixel is about 360 / (256 * 2^z) degrees wide,
+so detail finer than DATASET_SIMPLIFY_PIXELS of those is thrown away with
+Douglas-Peucker, and the coordinates are rounded to match.
+
+There is one level for every zoom in DATASET_SIMPLIFY_ZOOMS, each kept as a
+"simplified.<zoom>" variant in the payload cache. They are built in the
+background after a dataset is saved (see datasets/models.py), or on the
+first request that needs one that isn't there yet. Points are left as they
+are.
+"""
+from django.apps import apps
+from django.conf import settings
+
+from datasets.cache import fetch_payload, get_derived, payload_cache
+from datasets.cache import store_derived
+from datasets.convert import GEOJSON_CONTENT_TYPE, features, geojson_chunks
+
+import json
+import math
+import tempfile
+
+
+def zoom_tolerance(zoom):
+    """
+    How many degrees can be left out at this zoom level without it showing.
+    """
+    return 360.0 / (256 * 2 ** zoom) * settings.DATASET_SIMPLIFY_PIXELS
+
+
+def variant_name(zoom):
+    return "simplified.{}".format(zoom)
+
+
+def level_for(zoom=None, tolerance=None):
+    """
+    The zoom of the coarsest level that is still detailed enough, either for
+    a map at zoom or for something that can live with tolerance degrees of
+    error. None means only the full file is good enough.
+    """
+    levels = sorted(settings.DATASET_SIMPLIFY_ZOOMS)
+    if zoom is not None:
+        for level in levels:
+            if level >= zoom:
+                return level
+        return None
+
+    for level in levels:
+        if zoom_tolerance(level) <= tolerance:
+            return level
+    return None
+
+
+def _distance(point, start, end):
+    """
+    From point to the segment between start and end, in degrees.
+    """
+    x, y = point[0], point[1]
+    x1, y1, x2, y2 = start[0], start[1], end[0], end[1]
+    dx, dy = x2 - x1, y2 - y1
+    if dx == 0 and dy == 0:
+        return math.hypot(x - x1, y - y1)
+    t = ((x - x1) * dx + (y - y1) * dy) / (dx * dx + dy * dy)
+    t = max(0.0, min(1.0, t))
+    return math.hypot(x - (x1 + t * dx), y - (y1 + t * dy))
+
+
+def douglas_peucker(points, tolerance):
+    """
+    The points of a line that have to stay for it to be within tolerance of
+    the original. The first and the last one always stay. Done with a stack
+    rather than recursion, some lines have a lot of points.
+    """
+    if len(points) < 3:
+        return list(points)
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        furthest, index = 0.0, None
+        for i in range(first + 1, last):
+            distance = _distance(points[i], points[first], points[last])
+            if distance > furthest:
+                furthest, index = distance, i
+        if index is not None and furthest > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def _round(points, decimals):
+    return [[round(value, decimals) for value in point] for point in points]
+
+
+def _ring(ring, tolerance, decimals):
+    """
+    A polygon ring needs at least four points (the last one is the first one
+    again), rings that shrink below that are too small to see.
+    """
+    simplified = _round(douglas_peucker(ring, tolerance), decimals)
+    if len(simplified) < 4:
+        return None
+    return simplified
+
+
+def _polygon(rings, tolerance, decimals):
+    if not rings:
+        return None
+    outer = _ring(rings[0], tolerance, decimals)
+    if outer is None:
+        return None
+    holes = [_ring(ring, tolerance, decimals) for ring in rings[1:]]
+    return [outer] + [hole for hole in holes if hole is not None]
+
+
+def simplify_geometry(geometry, tolerance, decimals):
+    """
+    A simplified copy of a geojson geometry, or None when nothing of it is
+    left at this tolerance.
+    """
+    if geometry is None:
+        return None
+    kind = geometry.get("type")
+    coordinates = geometry.get("coordinates")
+
+    if kind == "LineString":
+        return {"type": kind, "coordinates": _round(
+            douglas_peucker(coordinates or [], tolerance), decimals)}
+    if kind == "MultiLineString":
+        return {"type": kind, "coordinates": [
+            _round(douglas_peucker(line, tolerance), decimals)
+            for line in coordinates or []]}
+    if kind == "Polygon":
+        rings = _polygon(coordinates, tolerance, decimals)
+        if rings is None:
+            return None
+        return {"type": kind, "coordinates": rings}
+    if kind == "MultiPolygon":
+        polygons = [_polygon(polygon, tolerance, decimals)
+                    for polygon in coordinates or []]
+        polygons = [polygon for polygon in polygons if polygon is not None]
+        if not polygons:
+            return None
+        return {"type": kind, "coordinates": polygons}
+    if kind == "GeometryCollection":
+        geometries = [simplify_geometry(child, tolerance, decimals)
+                      for child in geometry.get("geometries") or []]
+        geometries = [child for child in geometries if child is not None]
+        if not geometries:
+            return None
+        return {"type": kind, "geometries": geometries}
+    return geometry
+
+
+def _decimals(tolerance):
+    # enough decimals to tell apart points a tenth of the tolerance apart
+    return max(0, int(math.ceil(-math.log10(tolerance))) + 1)
+
+
+def simplify_feature(feature, tolerance, decimals):
+    """
+    Features whose geometry disappears completely are kept with the full
+    one, a tiny lake should still be on the map as something.
+    """
+    simplified = simplify_geometry(feature.get("geometry"), tolerance,
+                                   decimals)
+    if simplified is None:
+        return feature
+    return dict(feature, geometry=simplified)
+
+
+def simplify_features(features, tolerance):
+    decimals = _decimals(tolerance)
+    for feature in features:
+        yield simplify_feature(feature, tolerance, decimals)
+
+
+def simplified_chunks(dataset, source, zoom):
+    return geojson_chunks(
+        simplify_features(features(dataset.ext, source.chunks()),
+                          zoom_tolerance(zoom)),
+        settings.DATASET_CHUNK_SIZE)
+
+
+def _written(f, chunk_size):
+    f.seek(0)
+    chunk = f.read(chunk_size)
+    while chunk:
+        yield chunk
+        chunk = f.read(chunk_size)
+
+
+def build_levels(pk):
+    """
+    The background job, builds every level of the dataset that isn't in the
+    cache yet. All of them come out of one pass over the features, each one
+    goes to a temporary file first. There's nothing to simplify in a file
+    with only points, so nothing is built for those, going by the harvested
+    geometry_types if the harvest already got to this version of the file.
+    """
+    Dataset = apps.get_model("datasets", "Dataset")
+    dataset = Dataset.objects.filter(pk=pk).first()
+    if dataset is None:
+        return
+
+    cache = payload_cache()
+    source = fetch_payload(dataset, cache)
+    harvested = (source.meta.get("sha1") and
+                 source.meta["sha1"] == dataset.content_sha1)
+    if harvested and _points_only(dataset.geometry_types.split(",")):
+        return
+    zooms = [zoom for zoom in settings.DATASET_SIMPLIFY_ZOOMS
+             if get_derived(cache, dataset, variant_name(zoom),
+                            source) is None]
+    if not zooms:
+        return
+
+    files = {zoom: tempfile.TemporaryFile() for zoom in zooms}
+    try:
+        for f in files.values():
+            f.write(b'{"type": "FeatureCollection", "features": [')
+        separator = b""
+        kinds = set()
+        for feature in features(dataset.ext, source.chunks()):
+            geometry = feature.get("geometry")
+            if geometry:
+                kinds.add(geometry.get("type"))
+            for zoom, f in files.items():
+                tolerance = zoom_tolerance(zoom)
+                simplified = simplify_feature(feature, tolerance,
+                                              _decimals(tolerance))
+                f.write(separator + json.dumps(simplified).encode("utf-8"))
+            separator = b", "
+        if _points_only(kinds):
+            return
+
+        for zoom, f in files.items():
+            f.write(b"]}")
+            chunks = store_derived(cache, dataset, variant_name(zoom), source,
+                                   _written(f, settings.DATASET_CHUNK_SIZE),
+                                   {"content_type": GEOJSON_CONTENT_TYPE})
+            for chunk in chunks:
+                pass
+    finally:
+        for f in files.values():
+            f.close()
+
+
+def only_points(dataset):
+    """
+    Whether there is nothing to simplify in the dataset's file: csv and tsv
+    files are only points, and so is anything the harvest found nothing
+    but points in.
+    """
+    if dataset.ext in ("csv", "tsv"):
+        return True
+    return bool(dataset.geometry_types) and _points_only(
+        dataset.geometry_types.split(","))
+
+
+def _points_only(kinds):
+    return set(kinds) <= {"", "Point", "MultiPoint"}
@@ -0,0 +1,125 @@
+"""
+When a dataset is embedded somewhere popular, lots of requests for it come
+in at the same time, and with an empty or stale cache every one of them
+would download the same file from upstream. With single flight only one of
+them does (the leader), the others wait for it to land and then read what
+it left in the payload cache.
+
+Within a process the waiting is done on a threading.Event. Between
+processes the leader holds a lock in DATASET_LOCK_CACHE (one of the CACHES
+that all of them share, cache.add is atomic there), and the others poll it
+until it's gone. Without one (None) every process flies on its own. The
+lock runs out on its own after DATASET_FLIGHT_TIMEOUT seconds, so a leader
+that dies doesn't block anybody for longer than that. Nobody ever waits
+longer than that either, whoever gives up just does the work itself.
+"""
+from django.conf import settings
+from django.core.cache import caches
+
+import threading
+import time
+import uuid
+
+
+POLL_INTERVAL = 0.1
+
+_lock = threading.Lock()
+_flights = {}
+
+
+class Flight:
+
+    def __init__(self, key, event, leader):
+        self.key = key
+        self.event = event
+        self.leader = leader
+        self.token = None
+        self.landed = False
+
+    def wait(self):
+        """
+        Blocks until the leader landed or DATASET_FLIGHT_TIMEOUT ran out.
+        Only for the ones that aren't the leader.
+        """
+        self.event.wait(settings.DATASET_FLIGHT_TIMEOUT)
+
+    def land(self):
+        """
+        The leader is done, successful or not. Safe to call more than once.
+        """
+        if not self.leader or self.landed:
+            return
+        self.landed = True
+        if self.token is not None:
+            lock = caches[settings.DATASET_LOCK_CACHE]
+            if lock.get(_lock_key(self.key)) == self.token:
+                lock.delete(_lock_key(self.key))
+        with _lock:
+            if _flights.get(self.key) is self.event:
+                del _flights[self.key]
+        self.event.set()
+
+    def hand_over(self):
+        """
+        A new Flight that takes over from this leader, for work that goes
+        on after it returned. land() on this one does nothing any more.
+        """
+        flight = Flight(self.key, self.event, self.leader)
+        flight.token = self.token
+        self.landed = True
+        return flight
+
+
+def _lock_key(key):
+    return "dataset-flight:{}".format(key)
+
+
+def take_off(key):
+    """
+    Returns a Flight for key. If flight.leader is True the caller does the
+    work and has to call flight.land() once it's done, otherwise it calls
+    flight.wait() and then looks in the cache for the result.
+    """
+    with _lock:
+        event = _flights.get(key)
+        if event is not None:
+            return Flight(key, event, leader=False)
+        event = threading.Event()
+        _flights[key] = event
+
+    flight = Flight(key, event, leader=True)
+    if settings.DATASET_LOCK_CACHE is None:
+        return flight
+    token = uuid.uuid4().hex
+    lock = caches[settings.DATASET_LOCK_CACHE]
+    if lock.add(_lock_key(key), token, settings.DATASET_FLIGHT_TIMEOUT):
+        flight.token = token
+        return flight
+
+    # another process is at it already, so this one waits for it and lets
+    # the others in this process wait on this one
+    deadline = time.time() + settings.DATASET_FLIGHT_TIMEOUT
+    while (lock.get(_lock_key(key)) is not None and
+           time.time() < deadline):
+        time.sleep(POLL_INTERVAL)
+    flight.land()
+    return Flight(key, event, leader=False)
+
+
+def forget():
+    """
+    Forgets every flight in this process, whoever is waiting on one stops.
+    """
+    with _lock:
+        events = list(_flights.values())
+        _flights.clear()
+    for event in events:
+        event.set()
+
+
+def solo(key):
+    """
+    A Flight that doesn't wait for anybody and nobody waits for.
+    """
+    return Flight(key, threading.Event(), leader=True)
+
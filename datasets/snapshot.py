@@ -0,0 +1,183 @@
+"""
+A static copy of the dataset and embed pages of every public dataset, with
+a copy of each dataset's file next to them, that nginx or an S3 bucket can
+serve without django. The files are laid out like the site's urls:
+
+    <account>/<dataset>/index.html          dataset_detail
+    <account>/<dataset>/embed/index.html    embed_dataset
+    <account>/<dataset>/payload.<ext>       the file, from the payload cache
+    snapshot.json                           what was exported, see below
+
+The pages load the copy of the file instead of going to upstream or
+/load_dataset/, so the map works with nothing behind it. That means the
+file of a public dataset with a password ends up in the directory too,
+which is no different from the portal handing it out through load_dataset.
+The links and {% static %} files still point at the site.
+
+snapshot.json has a fingerprint of everything the pages and the file are
+made from for every dataset exported, so the next run only exports the
+datasets that changed since (a new file shows up as a new content_sha1 once
+refresh_datasets has harvested it), and removes the ones that were deleted
+or aren't public any more. A dataset that couldn't be exported keeps its
+old copy and is tried again next time. After changing the templates
+export(full=True) does everything again.
+"""
+from django.template.loader import render_to_string
+
+from datasets.cache import fetch_payload, payload_cache
+from datasets.models import SOURCE_FIELDS, Dataset
+from datasets.upstream import UpstreamError
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = "snapshot.json"
+
+# what the pages show besides the account and the keywords
+PAGE_FIELDS = ("title", "author", "description", "dataset_slug", "ext",
+               "feature_count", "geometry_types", "byte_size",
+               "content_sha1")
+
+
+def fingerprint(dataset):
+    """
+    Changes whenever the dataset's exported pages or file would.
+    """
+    fields = sorted(PAGE_FIELDS + tuple(SOURCE_FIELDS))
+    parts = [getattr(dataset, name) for name in fields]
+    parts += [dataset.account.account_slug, str(dataset.account.user)]
+    parts += sorted([keyword.keyword, keyword.keyword_slug]
+                    for keyword in dataset.keywords.all())
+    encoded = json.dumps(parts, default=str).encode("utf-8")
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def _write(directory, path, chunks):
+    """
+    Writes the file next to where it goes and moves it there once it's
+    complete, so whoever serves the directory never sees half of it.
+    """
+    target = os.path.join(directory, *path.split("/"))
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(target))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.chmod(temporary, 0o644)
+        os.replace(temporary, target)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+
+def _remove(directory, paths):
+    """
+    Removes the files, and the directories that are left empty.
+    """
+    for path in paths:
+        target = os.path.join(directory, *path.split("/"))
+        if os.path.exists(target):
+            os.remove(target)
+        parent = os.path.dirname(target)
+        while parent != directory:
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+
+
+def export_dataset(directory, dataset, cache=None):
+    """
+    Exports the dataset's pages and file, returns the paths written.
+    Raises UpstreamError or OSError when the file can't be had.
+    """
+    base = "{}/{}".format(dataset.account.account_slug, dataset.dataset_slug)
+    payload = "payload.{}".format(dataset.ext or "geojson")
+    source = fetch_payload(dataset, cache or payload_cache())
+    _write(directory, "{}/{}".format(base, payload), source.chunks())
+
+    context = {"account": dataset.account,
+               "keyword_list": dataset.keywords.all(),
+               "dataset": dataset}
+    pages = {"{}/index.html".format(base): (
+                 "datasets/dataset_detail.html", payload),
+             "{}/embed/index.html".format(base): (
+                 "datasets/embed_dataset.html", "../" + payload)}
+    for path, (template_name, payload_url) in pages.items():
+        html = render_to_string(template_name,
+                                dict(context, payload_url=payload_url))
+        _write(directory, path, [html.encode("utf-8")])
+    return ["{}/{}".format(base, payload)] + sorted(pages)
+
+
+def _read_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def export(directory, full=False, cache=None, report=None):
+    """
+    Brings the snapshot in directory up to date. Returns how many datasets
+    were exported, removed and failed. report(dataset, error) is called
+    for every dataset that was exported or failed.
+    """
+    directory = os.path.abspath(directory)
+    os.makedirs(directory, exist_ok=True)
+    manifest = _read_manifest(directory)
+    exported = {}
+    stale = set()
+    counts = {"exported": 0, "removed": 0, "failed": 0}
+
+    datasets = (Dataset.objects.filter(public_access=True)
+                .select_related("account__user")
+                .prefetch_related("keywords").order_by("pk"))
+    for dataset in datasets:
+        key = str(dataset.pk)
+        old = manifest.get(key)
+        current = fingerprint(dataset)
+        if not full and old is not None and old["fingerprint"] == current:
+            exported[key] = old
+            continue
+
+        try:
+            paths = export_dataset(directory, dataset, cache)
+        except (UpstreamError, OSError) as e:
+            logger.warning("could not export dataset %s: %s", dataset.pk, e)
+            counts["failed"] += 1
+            if old is not None:
+                exported[key] = old
+            if report is not None:
+                report(dataset, e)
+            continue
+
+        if old is not None:
+            # the account or the dataset may have been renamed
+            stale.update(old["paths"])
+        exported[key] = {"fingerprint": current, "paths": paths}
+        counts["exported"] += 1
+        if report is not None:
+            report(dataset, None)
+
+    for key, old in manifest.items():
+        if key not in exported:
+            stale.update(old["paths"])
+            counts["removed"] += 1
+    # another dataset may have taken over the name in the meantime
+    for entry in exported.values():
+        stale.difference_update(entry["paths"])
+    _remove(directory, stale)
+
+    _write(directory, MANIFEST, [json.dumps(exported, indent=1,
+                                            sort_keys=True).encode("utf-8")])
+    return counts
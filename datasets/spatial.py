@@ -0,0 +1,645 @@
+"""
+Finding the features of a dataset that are in some part of the map, without
+sending the whole file to the browser first.
+
+The FeatureIndex is built once for every version of a dataset's file. It is
+two variants in the payload cache (datasets/cache.py):
+
+    "features" - every feature as one line of json
+    "index"    - the bounding box of every feature, where its line starts
+                 and a grid over the dataset that lists which features are
+                 in which cell, as flat arrays (see FeatureIndex)
+
+A query only looks at the cells it overlaps and then reads the lines of the
+features it found, nothing else of the file is touched.
+"""
+from django.conf import settings
+
+from datasets.cache import CachedPayload, fetch_payload, get_derived
+from datasets.cache import payload_cache, payload_flight, store_derived
+from datasets.convert import features
+
+from array import array
+from collections import OrderedDict
+
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import weakref
+
+
+# features that cover more cells than this are kept in one list that every
+# query looks at, rather than in every cell they touch
+LARGE_FEATURE_CELLS = 64
+
+_lock = threading.Lock()
+_loaded = OrderedDict()
+
+
+def _positions(geometry):
+    """
+    Every coordinate pair in a geojson geometry, however deep it's nested.
+    """
+    if geometry is None:
+        return
+    if geometry.get("type") == "GeometryCollection":
+        for child in geometry.get("geometries") or []:
+            for position in _positions(child):
+                yield position
+        return
+
+    stack = [geometry.get("coordinates")]
+    while stack:
+        item = stack.pop()
+        if not isinstance(item, list) or not item:
+            continue
+        if isinstance(item[0], (int, float)):
+            if len(item) >= 2:
+                yield item
+        else:
+            stack.extend(item)
+
+
+def geometry_bbox(geometry):
+    """
+    [minx, miny, maxx, maxy] of a geojson geometry, None if it has no
+    coordinates at all.
+    """
+    minx = miny = math.inf
+    maxx = maxy = -math.inf
+    for position in _positions(geometry):
+        x, y = position[0], position[1]
+        minx, maxx = min(minx, x), max(maxx, x)
+        miny, maxy = min(miny, y), max(maxy, y)
+    if minx == math.inf:
+        return None
+    return [minx, miny, maxx, maxy]
+
+
+def parse_bbox(value):
+    """
+    "minx,miny,maxx,maxy" from a query string, ValueError if it isn't one.
+    """
+    bbox = [float(part) for part in value.split(",")]
+    if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+        raise ValueError("bbox has to be minx,miny,maxx,maxy")
+    if not all(math.isfinite(part) for part in bbox):
+        raise ValueError("bbox has to be made of numbers")
+    return bbox
+
+
+def bbox_intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def tile_bbox(z, x, y):
+    """
+    The [minx, miny, maxx, maxy] in degrees of a web mercator tile, the same
+    z/x/y scheme Leaflet uses for its tile layers.
+    """
+    n = 2 ** z
+
+    def lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return [x / n * 360 - 180, lat(y + 1), (x + 1) / n * 360 - 180, lat(y)]
+
+
+def polygons_from_geojson(data):
+    """
+    The polygons of a geojson Polygon or MultiPolygon, or of a Feature
+    holding one, as a list of lists of rings. ValueError for anything else.
+    """
+    if isinstance(data, dict) and data.get("type") == "Feature":
+        data = data.get("geometry")
+    if not isinstance(data, dict):
+        raise ValueError("expected a geojson Polygon or MultiPolygon")
+
+    if data.get("type") == "Polygon":
+        polygons = [data.get("coordinates")]
+    elif data.get("type") == "MultiPolygon":
+        polygons = data.get("coordinates")
+    else:
+        raise ValueError("expected a geojson Polygon or MultiPolygon")
+
+    try:
+        polygons = [[[[float(p[0]), float(p[1])] for p in ring]
+                     for ring in polygon] for polygon in polygons]
+    except (TypeError, IndexError, ValueError):
+        raise ValueError("the polygon's coordinates are broken")
+    if not polygons or any(not polygon or len(polygon[0]) < 3
+                           for polygon in polygons):
+        raise ValueError("a polygon needs at least three points")
+    return polygons
+
+
+def _point_in_rings(x, y, rings):
+    """
+    Even-odd ray casting over the outer ring and the holes together, so a
+    point in a hole counts as outside.
+    """
+    inside = False
+    for ring in rings:
+        j = len(ring) - 1
+        for i in range(len(ring)):
+            xi, yi = ring[i]
+            xj, yj = ring[j]
+            if ((yi > y) != (yj > y) and
+                    x < (xj - xi) * (y - yi) / (yj - yi) + xi):
+                inside = not inside
+            j = i
+    return inside
+
+
+def _segments(rings):
+    for ring in rings:
+        for i in range(len(ring) - 1):
+            yield ring[i], ring[i + 1]
+
+
+def _crosses(a, b, c, d):
+    """
+    Whether segment ab and segment cd touch or cross.
+    """
+    def orientation(p, q, r):
+        value = (q[1] - p[1]) * (r[0] - q[0]) - (q[0] - p[0]) * (r[1] - q[1])
+        return (value > 0) - (value < 0)
+
+    def on_segment(p, q, r):
+        return (min(p[0], r[0]) <= q[0] <= max(p[0], r[0]) and
+                min(p[1], r[1]) <= q[1] <= max(p[1], r[1]))
+
+    o1, o2 = orientation(a, b, c), orientation(a, b, d)
+    o3, o4 = orientation(c, d, a), orientation(c, d, b)
+    if o1 != o2 and o3 != o4:
+        return True
+    return ((o1 == 0 and on_segment(a, c, b)) or
+            (o2 == 0 and on_segment(a, d, b)) or
+            (o3 == 0 and on_segment(c, a, d)) or
+            (o4 == 0 and on_segment(c, b, d)))
+
+
+def _parts(geometry):
+    """
+    The geometry split into ("point", position), ("line", positions) and
+    ("polygon", rings) parts.
+    """
+    if geometry is None:
+        return
+    kind = geometry.get("type")
+    coordinates = geometry.get("coordinates") or []
+    if kind == "Point":
+        yield "point", coordinates
+    elif kind == "MultiPoint":
+        for position in coordinates:
+            yield "point", position
+    elif kind == "LineString":
+        yield "line", coordinates
+    elif kind == "MultiLineString":
+        for line in coordinates:
+            yield "line", line
+    elif kind == "Polygon":
+        yield "polygon", coordinates
+    elif kind == "MultiPolygon":
+        for polygon in coordinates:
+            yield "polygon", polygon
+    elif kind == "GeometryCollection":
+        for child in geometry.get("geometries") or []:
+            for part in _parts(child):
+                yield part
+
+
+class PolygonFilter:
+    """
+    Exact tests of features against a (multi)polygon, with the polygon's
+    bounding boxes and edges worked out once up front.
+    """
+
+    def __init__(self, polygons):
+        self.polygons = polygons
+        self.bboxes = [geometry_bbox({"type": "Polygon",
+                                      "coordinates": polygon})
+                       for polygon in polygons]
+        self.edges = [list(_segments(polygon)) for polygon in polygons]
+        self.bbox = [min(box[0] for box in self.bboxes),
+                     min(box[1] for box in self.bboxes),
+                     max(box[2] for box in self.bboxes),
+                     max(box[3] for box in self.bboxes)]
+
+    def contains_point(self, x, y):
+        for bbox, polygon in zip(self.bboxes, self.polygons):
+            if (bbox[0] <= x <= bbox[2] and bbox[1] <= y <= bbox[3] and
+                    _point_in_rings(x, y, polygon)):
+                return True
+        return False
+
+    def _crosses_line(self, line):
+        for a, b in zip(line, line[1:]):
+            segment_bbox = [min(a[0], b[0]), min(a[1], b[1]),
+                            max(a[0], b[0]), max(a[1], b[1])]
+            for bbox, edges in zip(self.bboxes, self.edges):
+                if not bbox_intersects(bbox, segment_bbox):
+                    continue
+                if any(_crosses(a, b, c, d) for c, d in edges):
+                    return True
+        return False
+
+    def intersects(self, geometry):
+        for kind, part in _parts(geometry):
+            if kind == "point":
+                if len(part) >= 2 and self.contains_point(part[0], part[1]):
+                    return True
+                continue
+
+            rings = [part] if kind == "line" else part
+            if any(self.contains_point(p[0], p[1])
+                   for ring in rings for p in ring if len(p) >= 2):
+                return True
+            if any(self._crosses_line(ring) for ring in rings):
+                return True
+            # the whole filter polygon could be inside this polygon
+            if kind == "polygon" and rings and any(
+                    _point_in_rings(polygon[0][0][0], polygon[0][0][1],
+                                    rings)
+                    for polygon in self.polygons):
+                return True
+        return False
+
+    def filter(self, index, batch_size=1000):
+        """
+        The features of index that intersect the polygon. The grid throws out
+        everything that isn't near the polygon's bounding box, the rest is
+        read and tested batch_size features at a time.
+        """
+        candidates = index.query(self.bbox)
+        for start in range(0, len(candidates), batch_size):
+            batch = candidates[start:start + batch_size]
+            for feature in index.features(batch):
+                if self.intersects(feature.get("geometry")):
+                    yield feature
+
+
+class FeatureIndex:
+    """
+    Everything is kept in flat arrays rather than python objects, so an
+    index that was read back from the disk cache is just a memory map of
+    the file:
+
+        offsets - where the line of every feature starts, and one more for
+                  the end of the last one
+        bboxes  - minx, miny, maxx, maxy of every feature, NaN for features
+                  without a geometry
+        starts  - where the features of every cell start in members, the
+                  cells go row by row
+        members - the numbers of the features in each cell
+        large   - the features that are in too many cells for the grid
+    """
+
+    def __init__(self, index, lines):
+        self.bbox = index["bbox"]
+        self.columns = index["columns"]
+        self.rows = index["rows"]
+        self.offsets = index["offsets"]
+        self.bboxes = index["bboxes"]
+        self.starts = index["starts"]
+        self.members = index["members"]
+        self.large = index["large"]
+        self.lines = lines
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @staticmethod
+    def build(features):
+        """
+        One pass over the features. Returns the json lines of the features
+        as a generator, the index dict is filled in once that generator has
+        been read to the end.
+        """
+        index = {"bboxes": array("d"), "offsets": array("Q", [0])}
+
+        def lines():
+            for feature in features:
+                line = json.dumps(feature).encode("utf-8") + b"\n"
+                index["bboxes"].extend(
+                    geometry_bbox(feature.get("geometry")) or _NO_BBOX)
+                index["offsets"].append(index["offsets"][-1] + len(line))
+                yield line
+            _fill_grid(index)
+
+        return lines(), index
+
+    def bbox_of(self, number):
+        """
+        [minx, miny, maxx, maxy] of a feature, None if it has no geometry.
+        """
+        bbox = self.bboxes[number * 4:number * 4 + 4].tolist()
+        if math.isnan(bbox[0]):
+            return None
+        return bbox
+
+    def query(self, bbox):
+        """
+        The numbers of the features whose bounding box intersects bbox, in
+        the order they are in the file.
+        """
+        if self.bbox is None or not bbox_intersects(self.bbox, bbox):
+            return []
+        x1, y1, x2, y2 = _cell_range(self.bbox, self.columns, self.rows,
+                                     bbox)
+        found = set(self.large)
+        for row in range(y1, y2 + 1):
+            for column in range(x1, x2 + 1):
+                cell = row * self.columns + column
+                found.update(
+                    self.members[self.starts[cell]:self.starts[cell + 1]])
+        return sorted(number for number in found
+                      if bbox_intersects(self.bbox_of(number), bbox))
+
+    def features(self, numbers):
+        ranges = [(self.offsets[number],
+                   self.offsets[number + 1] - self.offsets[number])
+                  for number in numbers]
+        for number, line in zip(numbers, self.lines.read_ranges(ranges)):
+            feature = json.loads(line.decode("utf-8"))
+            feature.setdefault("id", number)
+            yield feature
+
+
+_NO_BBOX = [math.nan] * 4
+
+# the arrays of a FeatureIndex in the order they are stored, see
+# _index_chunks. The 8 byte ones come first so that all of them stay
+# aligned in a memory map.
+_ARRAYS = (("offsets", "Q"), ("bboxes", "d"), ("starts", "I"),
+           ("members", "I"), ("large", "I"))
+_MAGIC = b"DSINDEX1"
+
+
+def _cell_range(extent, columns, rows, bbox):
+    minx, miny, maxx, maxy = extent
+    width = (maxx - minx) / columns or 1
+    height = (maxy - miny) / rows or 1
+
+    def clamp(value, top):
+        return min(max(int(value), 0), top - 1)
+
+    return (clamp((bbox[0] - minx) / width, columns),
+            clamp((bbox[1] - miny) / height, rows),
+            clamp((bbox[2] - minx) / width, columns),
+            clamp((bbox[3] - miny) / height, rows))
+
+
+def _grid_cells(index):
+    """
+    (number, cells) for every feature with a geometry, cells is None for the
+    large ones.
+    """
+    columns = index["columns"]
+    bboxes = index["bboxes"]
+    for number in range(len(bboxes) // 4):
+        box = bboxes[number * 4:number * 4 + 4]
+        if math.isnan(box[0]):
+            continue
+        x1, y1, x2, y2 = _cell_range(index["bbox"], columns, index["rows"],
+                                     box)
+        if (x2 - x1 + 1) * (y2 - y1 + 1) > LARGE_FEATURE_CELLS:
+            yield number, None
+            continue
+        yield number, [row * columns + column
+                       for row in range(y1, y2 + 1)
+                       for column in range(x1, x2 + 1)]
+
+
+def _fill_grid(index):
+    """
+    Roughly DATASET_INDEX_CELL_FEATURES features per cell if they were
+    spread out evenly. The features are counted per cell first and then
+    put in place, so the cells never exist as python lists.
+    """
+    bboxes = index["bboxes"]
+    minx = miny = math.inf
+    maxx = maxy = -math.inf
+    count = 0
+    for number in range(len(bboxes) // 4):
+        if math.isnan(bboxes[number * 4]):
+            continue
+        count += 1
+        minx = min(minx, bboxes[number * 4])
+        miny = min(miny, bboxes[number * 4 + 1])
+        maxx = max(maxx, bboxes[number * 4 + 2])
+        maxy = max(maxy, bboxes[number * 4 + 3])
+    if not count:
+        index.update(bbox=None, columns=1, rows=1, starts=array("I", [0, 0]),
+                     members=array("I"), large=array("I"))
+        return
+
+    side = max(1, int(math.sqrt(
+        count / settings.DATASET_INDEX_CELL_FEATURES)))
+    index.update(bbox=[minx, miny, maxx, maxy], columns=side, rows=side,
+                 large=array("I"))
+
+    starts = array("I", [0]) * (side * side + 1)
+    for number, cells in _grid_cells(index):
+        if cells is None:
+            index["large"].append(number)
+            continue
+        for cell in cells:
+            starts[cell + 1] += 1
+    for cell in range(side * side):
+        starts[cell + 1] += starts[cell]
+
+    members = array("I", [0]) * starts[-1]
+    filled = starts[:-1]
+    for number, cells in _grid_cells(index):
+        for cell in cells or ():
+            members[filled[cell]] = number
+            filled[cell] += 1
+    index.update(starts=starts, members=members)
+
+
+def _index_chunks(index):
+    """
+    The index as it's stored: _MAGIC, the length of a json header with the
+    grid and the lengths of the arrays, the header padded to 8 bytes, and
+    the arrays one after the other.
+    """
+    header = {"bbox": index["bbox"], "columns": index["columns"],
+              "rows": index["rows"], "byteorder": sys.byteorder,
+              "features_sha1": index["features_sha1"],
+              "lengths": [len(index[name]) for name, typecode in _ARRAYS]}
+    encoded = json.dumps(header).encode("utf-8")
+    encoded += b" " * (-len(encoded) % 8)
+    yield _MAGIC + struct.pack("<Q", len(encoded)) + encoded
+    for name, typecode in _ARRAYS:
+        yield index[name].tobytes()
+
+
+def _parse_index(buffer):
+    """
+    The index dict from what _index_chunks wrote, the arrays are views into
+    buffer. None for anything this version didn't write.
+    """
+    if bytes(buffer[:8]) != _MAGIC or len(buffer) < 16:
+        return None
+    length, = struct.unpack("<Q", buffer[8:16])
+    try:
+        header = json.loads(bytes(buffer[16:16 + length]).decode("utf-8"))
+    except ValueError:
+        return None
+    if header.get("byteorder") != sys.byteorder:
+        return None
+
+    index = dict(header)
+    position = 16 + length
+    for (name, typecode), count in zip(_ARRAYS, header["lengths"]):
+        size = count * array(typecode).itemsize
+        if position + size > len(buffer):
+            return None
+        index[name] = buffer[position:position + size].cast(typecode)
+        position += size
+    return index
+
+
+def _buffer(payload):
+    """
+    The body of a cached payload as a memoryview, a memory map for the ones
+    on disk. None if the file was evicted in the meantime.
+    """
+    if payload.data is not None:
+        return memoryview(payload.data)
+    try:
+        with open(payload.path, "rb") as f:
+            return memoryview(mmap.mmap(f.fileno(), 0,
+                                        access=mmap.ACCESS_READ))
+    except (OSError, ValueError):
+        return None
+
+
+def load_index(dataset, cache=None, source=None):
+    """
+    The FeatureIndex for the current version of the dataset's file, built
+    and stored the first time it's needed. The last few that were used stay
+    in memory. Raises UpstreamError or ConversionError like fetch_payload and
+    datasets.convert do.
+    """
+    cache = cache or payload_cache()
+    source = source or fetch_payload(dataset, cache)
+    key = ("index", dataset.pk, source.meta.get("sha1"))
+
+    index = recall(key)
+    if index is not None and index.lines.exists():
+        return index
+
+    index = _read_index(cache, dataset, source)
+    if index is None:
+        flight = payload_flight(cache, dataset, "index")
+        if not flight.leader:
+            flight.wait()
+            index = _read_index(cache, dataset, source)
+    if index is None:
+        try:
+            index = _build_index(cache, dataset, source)
+        finally:
+            flight.land()
+    remember(key, index)
+    return index
+
+
+def recall(key):
+    """
+    Something that was built from a dataset's file and kept in memory with
+    remember, or None. The last item of key is the sha1 of the file.
+    """
+    if key[-1] is None:
+        return None
+    with _lock:
+        value = _loaded.get(key)
+        if value is not None:
+            _loaded.move_to_end(key)
+        return value
+
+
+def remember(key, value):
+    """
+    Only the last DATASET_INDEX_MEMORY things stay in memory.
+    """
+    if key[-1] is None:
+        return
+    with _lock:
+        _loaded[key] = value
+        while len(_loaded) > settings.DATASET_INDEX_MEMORY:
+            _loaded.popitem(last=False)
+
+
+def forget():
+    """
+    Drops everything that was kept in memory with remember.
+    """
+    with _lock:
+        _loaded.clear()
+
+
+def _read_index(cache, dataset, source):
+    stored = get_derived(cache, dataset, "index", source)
+    lines = get_derived(cache, dataset, "features", source)
+    if stored is None or lines is None:
+        return None
+    buffer = _buffer(stored)
+    index = _parse_index(buffer) if buffer is not None else None
+    if index is None or index["features_sha1"] != lines.meta["sha1"]:
+        return None
+    return FeatureIndex(index, lines)
+
+
+def _build_index(cache, dataset, source):
+    generated, index = FeatureIndex.build(
+        features(dataset.ext, source.chunks()))
+    lines = None
+    if source.meta.get("sha1"):
+        for chunk in store_derived(cache, dataset, "features", source,
+                                   generated, {}):
+            pass
+        lines = get_derived(cache, dataset, "features", source)
+
+    if lines is None:
+        # the file isn't cached, so the lines only live in a temporary file
+        # this time, it goes away with the index
+        if source.meta.get("sha1"):
+            generated, index = FeatureIndex.build(
+                features(dataset.ext, source.chunks()))
+        return _temporary_index(generated, index)
+
+    index["features_sha1"] = lines.meta["sha1"]
+    for chunk in store_derived(cache, dataset, "index", source,
+                               _index_chunks(index), {}):
+        pass
+    return FeatureIndex(index, lines)
+
+
+def _temporary_index(generated, index):
+    size = 0
+    with tempfile.NamedTemporaryFile(prefix="features-", suffix=".jsonl",
+                                     delete=False) as f:
+        try:
+            for line in generated:
+                f.write(line)
+                size += len(line)
+        except BaseException:
+            _remove(f.name)
+            raise
+    index = FeatureIndex(index, CachedPayload({}, size, path=f.name))
+    weakref.finalize(index, _remove, f.name)
+    return index
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,50 @@
+"""
+{% dataset_items dataset_list %} renders the buttons of the portal's
+dataset lists. Every dataset's bit of html is kept in DATASET_LIST_CACHE
+under the things it's made from, so a page of the list is one get_many
+and rendering only the datasets that are new or changed. A dataset that
+is saved gets a new key by itself, nothing has to be deleted.
+
+The datasets should come with select_related("account__user"), the link
+to the dataset page needs the account.
+"""
+from django import template
+from django.conf import settings
+from django.core.cache import caches
+from django.template.loader import get_template
+from django.utils.safestring import mark_safe
+
+import hashlib
+import json
+
+register = template.Library()
+
+ITEM_TEMPLATE = "datasets/dataset_list_item.html"
+
+
+def item_key(dataset):
+    parts = [dataset.pk, dataset.title, dataset.ext, dataset.url,
+             bool(dataset.dataset_password), dataset.dataset_slug,
+             dataset.account.account_slug]
+    digest = hashlib.md5(json.dumps(parts).encode("utf-8")).hexdigest()
+    return "dataset-item:{}".format(digest)
+
+
+@register.simple_tag
+def dataset_items(datasets):
+    item = get_template(ITEM_TEMPLATE)
+    if settings.DATASET_LIST_CACHE is None:
+        return mark_safe("".join(item.render({"dataset": dataset})
+                                 for dataset in datasets))
+
+    cache = caches[settings.DATASET_LIST_CACHE]
+    keys = [item_key(dataset) for dataset in datasets]
+    found = cache.get_many(keys)
+    rendered = {}
+    for key, dataset in zip(keys, datasets):
+        if key not in found and key not in rendered:
+            rendered[key] = item.render({"dataset": dataset})
+    if rendered:
+        cache.set_many(rendered, settings.PAGE_CACHE_TIMEOUT)
+    found.update(rendered)
+    return mark_safe("".join(found[key] for key in keys))
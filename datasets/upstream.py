@@ -0,0 +1,274 @@
+"""
+Getting a dataset's file from wherever it actually lives. Right now that is
+either a plain url (maybe behind basic auth) or an owncloud instance. The
+view in main/views.py should not have to care which one it is, it just asks
+for an open response and reads it in chunks.
+
+Connections are reused. Every process keeps one requests.Session per host
+and one logged in owncloud.Client per (instance, user), so a map load
+doesn't pay for a TLS handshake and an owncloud login every time.
+"""
+from django.conf import settings
+
+from requests.adapters import HTTPAdapter
+from urllib import parse
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import EmptyPoolError
+
+import hashlib
+import http.cookiejar
+import requests
+import owncloud
+import os
+import threading
+import time
+
+from cryptography.fernet import Fernet
+
+
+_lock = threading.Lock()
+_sessions = {}
+_owncloud_clients = {}
+
+
+def decrypt_credentials(dataset):
+    """
+    The username and password are stored encrypted by Dataset.save. Open
+    datasets don't have any, so this returns None for those.
+    """
+    if not dataset.dataset_user or not dataset.dataset_password:
+        return None
+
+    cipher_end = Fernet(os.environ.get("CRYPTO_KEY"))
+    user = cipher_end.decrypt(dataset.dataset_user.encode("utf-8"))
+    password = cipher_end.decrypt(dataset.dataset_password.encode("utf-8"))
+    return (user.decode("utf-8"), password.decode("utf-8"))
+
+
+class PoolTimeout(requests.ConnectionError):
+    """
+    No pooled connection to upstream came free within DATASET_POOL_TIMEOUT.
+    """
+
+
+class _WaitingPool(object):
+    """
+    requests never passes a pool_timeout on to urllib3, so with pool_block
+    a thread would wait forever for a connection once the pool is full.
+    """
+
+    def _get_conn(self, timeout=None):
+        if timeout is None:
+            timeout = settings.DATASET_POOL_TIMEOUT
+        return super(_WaitingPool, self)._get_conn(timeout=timeout)
+
+
+class _HTTPPool(_WaitingPool, HTTPConnectionPool):
+    pass
+
+
+class _HTTPSPool(_WaitingPool, HTTPSConnectionPool):
+    pass
+
+
+class PoolAdapter(HTTPAdapter):
+    """
+    At most DATASET_POOL_MAXSIZE connections per host, threads wait up to
+    DATASET_POOL_TIMEOUT seconds for a free one instead of opening more,
+    after that PoolTimeout is raised.
+    """
+
+    def __init__(self):
+        super(PoolAdapter, self).__init__(
+            pool_connections=1, pool_maxsize=settings.DATASET_POOL_MAXSIZE,
+            pool_block=True)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(PoolAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _HTTPPool,
+                                                   "https": _HTTPSPool}
+
+    def send(self, request, **kwargs):
+        try:
+            return super(PoolAdapter, self).send(request, **kwargs)
+        except EmptyPoolError as e:
+            raise PoolTimeout(e, request=request)
+
+
+def _mount_pool(session):
+    adapter = PoolAdapter()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+
+def host_session(url):
+    """
+    The shared requests.Session for the scheme and host of url.
+    """
+    parts = parse.urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    with _lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            # the session is shared between datasets with different logins,
+            # a cookie from one of them must never go out with another
+            session.cookies.set_policy(
+                http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            _mount_pool(session)
+            _sessions[key] = session
+    return session
+
+
+def owncloud_client(instance, user, password, fresh=False):
+    """
+    A logged in owncloud.Client for this instance and user. Clients are
+    logged in again after DATASET_OWNCLOUD_LOGIN_TIMEOUT seconds, when the
+    password changed, or when fresh is True (after a 401).
+    """
+    key = (instance, user)
+    password_hash = hashlib.sha1(password.encode("utf-8")).hexdigest()
+    with _lock:
+        entry = _owncloud_clients.get(key)
+    if entry is not None and not fresh:
+        oc, logged_in_at, known_hash = entry
+        age = time.time() - logged_in_at
+        if (known_hash == password_hash and
+                age < settings.DATASET_OWNCLOUD_LOGIN_TIMEOUT):
+            return oc
+
+    oc = owncloud.Client(instance)
+    oc.login(user, password)
+    _mount_pool(oc._session)
+    with _lock:
+        old = _owncloud_clients.get(key)
+        _owncloud_clients[key] = (oc, time.time(), password_hash)
+    if old is not None and old[0] is not oc:
+        old[0]._session.close()
+    return oc
+
+
+def close_connections():
+    """
+    Drops every pooled session and owncloud login in this process.
+    """
+    with _lock:
+        sessions = list(_sessions.values())
+        sessions += [entry[0]._session for entry in _owncloud_clients.values()]
+        _sessions.clear()
+        _owncloud_clients.clear()
+    for session in sessions:
+        session.close()
+
+
+def owncloud_file_url(oc, path):
+    """
+    pyocclient only hands back whole files, so build the webdav url the same
+    way Client.get_file_contents does and stream it with the client's session.
+    """
+    return oc._webdav_url + parse.quote(path)
+
+
+class UpstreamError(Exception):
+    """
+    Upstream answered with something other than the file.
+    """
+
+    def __init__(self, status_code):
+        super(UpstreamError, self).__init__(
+            "upstream answered {}".format(status_code))
+        self.status_code = status_code
+
+
+def conditional_headers(etag=None, last_modified=None):
+    """
+    The request headers that let upstream answer 304 Not Modified instead of
+    sending the whole file again.
+    """
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return headers
+
+
+def open_upstream(dataset, headers=None):
+    """
+    Returns a requests.Response opened with stream=True, nothing has been
+    read from it yet. Whoever calls this has to close it. headers are sent
+    along, owncloud's webdav understands the conditional ones too.
+    """
+    credentials = decrypt_credentials(dataset)
+    timeout = settings.DATASET_UPSTREAM_TIMEOUT
+
+    if not dataset.owncloud:
+        session = host_session(dataset.url)
+        return session.get(dataset.url, auth=credentials, headers=headers,
+                           stream=True, timeout=timeout)
+
+    oc = owncloud_client(dataset.owncloud_instance, *credentials)
+    url = owncloud_file_url(oc, dataset.owncloud_path)
+    upstream = oc._session.get(url, headers=headers, stream=True,
+                               timeout=timeout)
+    if upstream.status_code == 401:
+        # the owncloud session ran out on the server side, log in again
+        upstream.close()
+        oc = owncloud_client(dataset.owncloud_instance, *credentials,
+                             fresh=True)
+        upstream = oc._session.get(url, headers=headers, stream=True,
+                                   timeout=timeout)
+    return upstream
+
+
+def upstream_length(upstream):
+    """
+    The Content-Length can only be trusted if requests isn't decoding the body
+    on the way through, otherwise it's the length of the gzipped bytes.
+    """
+    encoding = upstream.headers.get("Content-Encoding", "identity")
+    length = upstream.headers.get("Content-Length")
+    if encoding.lower() != "identity" or not length or not length.isdigit():
+        return None
+    return int(length)
+
+
+def iter_upstream(upstream, chunk_size=None):
+    """
+    Yields the body a chunk at a time and makes sure the connection is given
+    back, even when the browser goes away halfway through.
+    """
+    chunk_size = chunk_size or settings.DATASET_CHUNK_SIZE
+    try:
+        for chunk in upstream.iter_content(chunk_size=chunk_size):
+            if chunk:
+                yield chunk
+    finally:
+        upstream.close()
+
+
+def read_small(chunks, limit):
+    """
+    Reads up to limit bytes from an iterator of chunks. If the whole file fit
+    it comes back as bytes, otherwise the bytes read so far are put back in
+    front of the rest of the stream and that iterator comes back instead.
+    """
+    head = []
+    size = 0
+    for chunk in chunks:
+        head.append(chunk)
+        size += len(chunk)
+        if size > limit:
+            return None, _resume(head, chunks)
+    return b"".join(head), None
+
+
+def _resume(head, chunks):
+    try:
+        for chunk in head:
+            yield chunk
+        for chunk in chunks:
+            yield chunk
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
@@ -5,6 +5,7 @@ from django.shortcuts import render, redirect, get_object_or_404
 from accounts.models import Account
 
 from datasets.models import Dataset
+from datasets.pagecache import account_scope, cache_page, public_page
 from datasets.forms import DatasetCreateForm
 from datasets.forms import DatasetUpdateForm
 from datasets.forms import DatasetUpdateAuthForm
@@ -12,6 +13,7 @@ from datasets.forms import DatasetUpdateAuthForm
 from keywords.models import Keyword
 
 
+@cache_page(lambda account_slug, dataset_slug: [account_scope(account_slug)])
 def dataset_detail(request, account_slug=None, dataset_slug=None):
     """
     In this view I bring in the account and the dataset, and I check to see
@@ -20,8 +22,10 @@ def dataset_detail(request, account_slug=None, dataset_slug=None):
     do this, I can just use a plain old XMLHttpRequest to get the data, which
     should be faster than getting it through the server.
     """
-    account = get_object_or_404(Account, account_slug=account_slug)
-    dataset = get_object_or_404(Dataset, dataset_slug=dataset_slug, account=account)
+    dataset = get_object_or_404(Dataset.objects.select_related("account__user"),
+                                dataset_slug=dataset_slug,
+                                account__account_slug=account_slug)
+    account = dataset.account
     keyword_list = dataset.keywords.all()
 
     context = {"account": account,
@@ -30,12 +34,11 @@ def dataset_detail(request, account_slug=None, dataset_slug=None):
     template_name = "datasets/dataset_detail.html"
     return render(request, template_name, context)
 
-def embed_dataset(request, account_slug=None, dataset_slug=None):
-    """
-    This is the page that will be embedded into the ZMT's staff pages.
-    """
-    account = get_object_or_404(Account, account_slug=account_slug)
-    dataset = get_object_or_404(Dataset, dataset_slug=dataset_slug, account=account)
+def _embed_response(request, account_slug, dataset_slug, frame_from):
+    dataset = get_object_or_404(Dataset.objects.select_related("account__user"),
+                                dataset_slug=dataset_slug,
+                                account__account_slug=account_slug)
+    account = dataset.account
     keyword_list = dataset.keywords.all()
 
     context = {"account": account,
@@ -49,32 +52,32 @@ def embed_dataset(request, account_slug=None, dataset_slug=None):
     response["Access-Control-Allow-Methods"] = "GET, OPTIONS"
     response["Access-Control-Max-Age"] = "43200"
     response["Access-Control-Allow-Headers"] = "X-Requested-With, Content-Type"
-    response["X-Frame-Options"] = "ALLOW-FROM https://www.leibniz-zmt.de/"
-    
+    response["X-Frame-Options"] = "ALLOW-FROM {}".format(frame_from)
+
     return response
 
+@public_page
+@cache_page(lambda account_slug, dataset_slug: [account_scope(account_slug)],
+            per_user=False)
+def embed_dataset(request, account_slug=None, dataset_slug=None):
+    """
+    This is the page that will be embedded into the ZMT's staff pages. It's
+    the same for everybody, so it's cached here and may be cached by the
+    browser and any CDN in between too, see datasets/pagecache.py.
+    """
+    return _embed_response(request, account_slug, dataset_slug,
+                           "https://www.leibniz-zmt.de/")
+
+@public_page
+@cache_page(lambda account_slug, dataset_slug: [account_scope(account_slug)],
+            per_user=False)
 def sanity_dataset(request, account_slug=None, dataset_slug=None):
     """
     This page is just here so that I know embedding works.
     """
-    account = get_object_or_404(Account, account_slug=account_slug)
-    dataset = get_object_or_404(Dataset, dataset_slug=dataset_slug, account=account)
-    keyword_list = dataset.keywords.all()
-
-    context = {"account": account,
-               "keyword_list": keyword_list,
-               "dataset": dataset}
-    template_name = "datasets/embed_dataset.html"
-    response = render(request, template_name, context)
-
-    # here's the important part
-    response["Access-Control-Allow-Origin"] = "*"
-    response["Access-Control-Allow-Methods"] = "GET, OPTIONS"
-    response["Access-Control-Max-Age"] = "43200"
-    response["Access-Control-Allow-Headers"] = "X-Requested-With, Content-Type"
-    response["X-Frame-Options"] = "ALLOW-FROM https://s3.eu-central-1.amazonaws.com/spatialdatahub-embed-test/"
-    
-    return response
+    return _embed_response(
+        request, account_slug, dataset_slug,
+        "https://s3.eu-central-1.amazonaws.com/spatialdatahub-embed-test/")
 
 @login_required
 def new_dataset(request, account_slug):
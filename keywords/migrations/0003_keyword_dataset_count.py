@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:37
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+
+
+def count_datasets(apps, schema_editor):
+    Keyword = apps.get_model("keywords", "Keyword")
+    counts = Keyword.objects.filter(pk=OuterRef("pk")).annotate(
+        count=Count("datasets")).values("count")
+    Keyword.objects.update(dataset_count=Subquery(counts))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('keywords', '0002_remove_keyword_datasets'),
+        ('datasets', '0002_auto_20170706_1318'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='keyword',
+            name='dataset_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_datasets, migrations.RunPython.noop),
+    ]
@@ -1,5 +1,6 @@
 from django.urls import reverse
 from django.db import models
+from django.db.models import Count, OuterRef, Subquery
 from django.utils.text import slugify
 
 #from datasets.models import Dataset
@@ -12,14 +13,34 @@ class Keyword(models.Model):
 #    datasets = models.ManyToManyField(Dataset, related_name='keywords')
     keyword_slug = models.SlugField(max_length=100, unique=True,
                                     blank=True, null=True)
+    # how many datasets have this keyword, kept up to date by the
+    # m2m_changed handler in datasets/models.py so the keyword list doesn't
+    # have to count them for every keyword
+    dataset_count = models.PositiveIntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.keyword
 
     def save(self, *args, **kwargs):
         self.keyword_slug = slugify(self.keyword)
+        if not self._state.adding and not args and \
+                kwargs.get("update_fields") is None:
+            # the dataset_count in here may be older than the one in the
+            # database, saving it would undo the counting
+            kwargs["update_fields"] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != "dataset_count"]
         super(Keyword, self).save(*args, **kwargs)
 
     def get_absolute_url(self):
         kwargs = {"keyword_slug": self.keyword_slug}
         return reverse("keywords:keyword_detail", kwargs=kwargs)
+
+
+def count_datasets(keywords):
+    """
+    Counts the datasets of a queryset of keywords again, in one UPDATE.
+    """
+    counts = Keyword.objects.filter(pk=OuterRef("pk")).annotate(
+        count=Count("datasets")).values("count")
+    keywords.update(dataset_count=Subquery(counts))
@@ -1,15 +1,22 @@
 from django.shortcuts import render
 from django.shortcuts import get_object_or_404
 
+from datasets.pagecache import CATALOGUE, cache_page
+
 from keywords.forms import KeywordCreateForm
 from keywords.models import Keyword
 
+from main.listing import dataset_listing
+
 
 def keyword_list(request):
     """
     This is a view that will show all the keywords.
     This view should also show the number of datasets for each keyword.
     Maybe that is a template problem.
+
+    It is Keyword.dataset_count now, counting them here was a query per
+    keyword.
     """
     k = Keyword.objects.all()
 
@@ -20,23 +27,24 @@ def keyword_list(request):
     else:
         keyword_list = k.order_by("keyword")
 
-    total_keywords = len(keyword_list)
+    total_keywords = keyword_list.count()
 
     context = {"keyword_list": keyword_list, "total_keywords": total_keywords}
     template_name = "keywords/keyword_list.html"
     return render(request, template_name, context)
 
+@cache_page(lambda keyword_slug: [CATALOGUE])
 def keyword_detail(request, keyword_slug=None):
     """I making sure that dataset list is only defined once"""
     keyword = get_object_or_404(Keyword, keyword_slug=keyword_slug)
-    d = keyword.datasets.all()
+    d = keyword.datasets.select_related("account__user")
 
     if "q" in request.GET:
         q = request.GET["q"]
-        dataset_list = d.filter(title__icontains=q).order_by("title")
+        dataset_list = d.filter(title__icontains=q)
     else:
         dataset_list = d
 
     template_name = "keywords/keyword_detail.html"
-    return render(request, template_name,
-                  context={"keyword": keyword, "dataset_list": dataset_list})
+    return dataset_listing(request, dataset_list, template_name,
+                           {"keyword": keyword})
@@ -0,0 +1,29 @@
+"""
+ASGI config for main project.
+
+It exposes the ASGI callable as a module-level variable named
+``application``. The dataset proxy in main/async_proxy.py sits in front of
+django, so slow upstream servers don't tie up worker threads. Everything
+else is django's WSGI application, run in DATASET_ASGI_THREADS threads per
+process. Run it with something like
+
+    gunicorn main.asgi:application -k uvicorn.workers.UvicornWorker
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
+"""
+
+import os
+
+from django.conf import settings
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "main.settings")
+
+django_application = get_wsgi_application()
+
+# the proxy imports models, so django has to be set up first
+from main.async_proxy import DatasetProxy, ThreadPoolWsgi  # noqa: E402
+
+application = DatasetProxy(ThreadPoolWsgi(django_application,
+                                          settings.DATASET_ASGI_THREADS))
@@ -0,0 +1,402 @@
+"""
+load_dataset for the ASGI server, see main/asgi.py.
+
+Only plain GET /load_dataset/<pk>/ requests that have to go upstream are
+answered here, everything else is handed on to django. That means the
+?bbox=, ?format=, ?zoom= and ?tolerance= queries (they need the whole file
+on our side anyway) and copies that are fresh in the payload cache (those
+are read from disk, which is quick). What's left is the slow part, waiting
+on somebody else's server, and that is done on the event loop with httpx.
+
+Django itself runs as the WSGI application in a pool of threads, see
+ThreadPoolWsgi, and not as django's ASGIHandler. That one runs every sync
+view in the same thread and reads streamed responses on the event loop.
+
+The file is downloaded into the payload cache by a Download (see
+datasets/downloads.py) as fast as upstream sends it, and the browser
+follows that download, compressed if it takes gzip or br (see
+datasets/compress.py). A browser that goes away doesn't stop the download.
+Errors and 304s, and everything when the cache is switched off, are
+streamed straight through.
+"""
+from django.urls import Resolver404, resolve
+from django.utils.http import parse_etags, parse_http_date_safe, quote_etag
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+
+from datasets.access import record_access
+from datasets.models import Dataset
+from datasets.async_upstream import open_upstream
+from datasets.cache import NoPayloadCache, payload_cache, payload_flight
+from datasets.compress import compressor, encoded_etag, negotiate
+from datasets.downloads import Download
+from datasets.upstream import conditional_headers, upstream_length
+
+from main import views
+
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncio
+import httpx
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# the downloads that go on after their browser was answered, so they aren't
+# garbage collected halfway
+_downloading = set()
+
+
+class DatasetProxy:
+    """
+    ASGI middleware around django's application.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        pk = _plain_load_dataset(scope)
+        if pk is None:
+            return await self.app(scope, receive, send)
+        await load_dataset(self.app, scope, receive, send, pk)
+
+
+class ThreadPoolWsgi(WsgiToAsgi):
+    """
+    A WSGI application as an ASGI one. Every request runs in one of threads
+    threads, like gunicorn's threads do for main/wsgi.py, and the response
+    is read there too, only the finished chunks are sent from the event
+    loop.
+    """
+
+    def __init__(self, wsgi_application, threads):
+        super().__init__(wsgi_application)
+        self.executor = ThreadPoolExecutor(threads,
+                                           thread_name_prefix="wsgi")
+
+    async def __call__(self, scope, receive, send):
+        await _ThreadPoolWsgiInstance(self.wsgi_application, self.executor)(
+            scope, receive, send)
+
+
+class _ThreadPoolWsgiInstance(WsgiToAsgiInstance):
+
+    def __init__(self, wsgi_application, executor):
+        super().__init__(wsgi_application)
+        self.executor = executor
+
+    async def run_wsgi_app(self, body):
+        await sync_to_async(self._run, thread_sensitive=False,
+                            executor=self.executor)(body)
+
+    def _run(self, body):
+        try:
+            environ = self.build_environ(self.scope, body)
+        except ValueError as e:
+            self.start_response("400 Bad Request",
+                                [("Content-Type", "text/plain")])
+            chunks = [str(e).encode("utf-8")]
+        else:
+            chunks = self.wsgi_application(environ, self.start_response)
+        try:
+            for chunk in chunks:
+                if not self.response_started:
+                    self.response_started = True
+                    self.sync_send(self.response_start)
+                if chunk:
+                    self.sync_send({"type": "http.response.body",
+                                    "body": chunk, "more_body": True})
+        finally:
+            # django sends request_finished and closes the database
+            # connection in here
+            if hasattr(chunks, "close"):
+                chunks.close()
+        if not self.response_started:
+            self.response_started = True
+            self.sync_send(self.response_start)
+        self.sync_send({"type": "http.response.body", "body": b""})
+
+
+def _plain_load_dataset(scope):
+    """
+    The pk when this is a request we answer here, None otherwise.
+    """
+    if (scope["type"] != "http" or scope["method"] != "GET" or
+            scope.get("query_string")):
+        return None
+    try:
+        match = resolve(scope["path"])
+    except Resolver404:
+        return None
+    if match.func is not views.load_dataset:
+        return None
+    return int(match.kwargs["pk"])
+
+
+def _request_headers(scope):
+    return {name.decode("latin-1").lower(): value.decode("latin-1")
+            for name, value in scope.get("headers", [])}
+
+
+async def load_dataset(app, scope, receive, send, pk):
+    dataset = await sync_to_async(Dataset.objects.filter(pk=pk).first)()
+    cache = payload_cache()
+    cached = None
+    if dataset is not None:
+        cached = await sync_to_async(cache.get, thread_sensitive=False)(
+            dataset, stale=True)
+    if dataset is None or (cached is not None and cached.fresh):
+        # the 404 page and cache hits are django's business
+        return await app(scope, receive, send)
+
+    flight = await sync_to_async(payload_flight, thread_sensitive=False)(
+        cache, dataset)
+    if not flight.leader:
+        # another request is downloading the file already, django follows
+        # that download or waits for it and answers from the cache
+        return await app(scope, receive, send)
+    await sync_to_async(record_access)(dataset.pk)
+    try:
+        await _from_upstream(scope, receive, send, dataset, cache, cached,
+                             flight)
+    finally:
+        flight.land()
+
+
+async def _from_upstream(scope, receive, send, dataset, cache, cached,
+                         flight):
+    request_headers = _request_headers(scope)
+    if cached is not None:
+        headers = conditional_headers(cached.meta.get("etag"),
+                                      cached.meta.get("last_modified"))
+    else:
+        headers = conditional_headers(
+            request_headers.get("if-none-match"),
+            request_headers.get("if-modified-since"))
+
+    try:
+        upstream = await open_upstream(dataset, headers)
+    except httpx.HTTPError as e:
+        if cached is not None:
+            return await _send_cached(send, request_headers, cached, "stale")
+        return await _send_error(send, 502, "could not reach upstream: {}"
+                                 .format(e))
+
+    status = upstream.status_code
+    etag = upstream.headers.get("ETag")
+    last_modified = upstream.headers.get("Last-Modified")
+
+    if cached is not None and (status == 304 or status >= 500):
+        await upstream.aclose()
+        if status == 304:
+            await sync_to_async(cache.revalidated, thread_sensitive=False)(
+                dataset, etag=etag, last_modified=last_modified)
+            return await _send_cached(send, request_headers, cached,
+                                      "revalidated")
+        return await _send_cached(send, request_headers, cached, "stale")
+
+    if status == 304:
+        await upstream.aclose()
+        await send({"type": "http.response.start", "status": 304,
+                    "headers": _validators(etag, last_modified)})
+        await send({"type": "http.response.body", "body": b""})
+        return
+
+    if status != 200 or isinstance(cache, NoPayloadCache):
+        try:
+            await _until_disconnect(receive, _stream(
+                send, request_headers, upstream, upstream.aiter_bytes()))
+        finally:
+            await upstream.aclose()
+        return
+
+    # the file goes into the cache as fast as upstream sends it, even if
+    # this browser is slow or goes away, it follows the download instead
+    download = await sync_to_async(Download, thread_sensitive=False)(
+        flight, cache, dataset, {
+            "content_type": upstream.headers.get("Content-Type",
+                                                 "application/octet-stream"),
+            "etag": etag,
+            "last_modified": last_modified}, upstream_length(upstream))
+    chunks = await sync_to_async(download.follow, thread_sensitive=False)()
+    task = asyncio.ensure_future(_download(upstream, download))
+    _downloading.add(task)
+    task.add_done_callback(_downloading.discard)
+    await _until_disconnect(receive, _stream(send, request_headers, upstream,
+                                             _followed(chunks)))
+
+
+async def _download(upstream, download):
+    write = sync_to_async(download.write, thread_sensitive=False)
+    try:
+        async for chunk in upstream.aiter_bytes():
+            await write(chunk)
+        await sync_to_async(download.finish, thread_sensitive=False)()
+    except asyncio.CancelledError as e:
+        download.abort(e)
+        raise
+    except Exception as e:
+        logger.warning("download %s broke off: %s", download.flight.key, e)
+        await sync_to_async(download.abort, thread_sensitive=False)(e)
+    finally:
+        await upstream.aclose()
+
+
+async def _followed(chunks):
+    """
+    A Download's follow() as an async iterator, the waiting for the next
+    chunk is done in a thread.
+    """
+    read = sync_to_async(next, thread_sensitive=False)
+    chunk = await read(chunks, None)
+    while chunk is not None:
+        yield chunk
+        chunk = await read(chunks, None)
+
+
+def _validators(etag, last_modified):
+    headers = []
+    if etag:
+        headers.append((b"etag", etag.encode("latin-1")))
+    if last_modified:
+        headers.append((b"last-modified", last_modified.encode("latin-1")))
+    return headers
+
+
+def _encoding_headers(encoding):
+    headers = [(b"vary", b"Accept-Encoding")]
+    if encoding is not None:
+        headers.append((b"content-encoding", encoding.encode("ascii")))
+    return headers
+
+
+async def _stream(send, request_headers, upstream, chunks):
+    """
+    Sends upstream's status and headers, and then chunks.
+    """
+    content_type = upstream.headers.get("Content-Type",
+                                        "application/octet-stream")
+    headers = [(b"content-type", content_type.encode("latin-1")),
+               (b"x-dataset-cache", b"miss")]
+    length = upstream_length(upstream)
+    encoding = None
+    if upstream.status_code == 200:
+        encoding = negotiate(request_headers.get("accept-encoding"), length)
+        headers += _validators(
+            encoded_etag(upstream.headers.get("ETag"), encoding),
+            upstream.headers.get("Last-Modified"))
+        headers += _encoding_headers(encoding)
+    if length is not None and encoding is None:
+        headers.append((b"content-length", str(length).encode("ascii")))
+    if encoding is not None:
+        # the file is cached as it is and compressed on the way out
+        compress, finish = compressor(encoding)
+    else:
+        compress = finish = None
+
+    await send({"type": "http.response.start",
+                "status": upstream.status_code, "headers": headers})
+    async for chunk in chunks:
+        if compress is not None:
+            chunk = compress(chunk)
+        await send({"type": "http.response.body", "body": chunk,
+                    "more_body": True})
+    await send({"type": "http.response.body",
+                "body": finish() if finish is not None else b""})
+
+
+async def _until_disconnect(receive, streaming):
+    """
+    Runs the streaming coroutine, and cancels it if the browser goes away
+    first.
+    """
+    async def disconnected():
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+
+    stream = asyncio.ensure_future(streaming)
+    watch = asyncio.ensure_future(disconnected())
+    try:
+        done, pending = await asyncio.wait(
+            {stream, watch}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in (stream, watch):
+            if not task.done():
+                task.cancel()
+    if stream in done:
+        stream.result()
+    else:
+        # let the cancelled download close its connection and clean up
+        await asyncio.gather(stream, return_exceptions=True)
+
+
+async def _send_cached(send, request_headers, cached, state):
+    """
+    Like main.views._cached_response, for the stale and revalidated copies
+    that are answered from here. Those are rare, they're compressed on the
+    way out instead of being kept compressed.
+    """
+    encoding = negotiate(request_headers.get("accept-encoding"), cached.size)
+    etag = encoded_etag(cached.meta.get("etag") or
+                        quote_etag(cached.meta["sha1"]), encoding)
+    headers = [(b"x-dataset-cache", state.encode("ascii"))]
+    headers += _validators(etag, cached.meta.get("last_modified"))
+    headers += _encoding_headers(encoding)
+
+    if _not_modified(request_headers, etag, cached.meta.get("last_modified")):
+        await send({"type": "http.response.start", "status": 304,
+                    "headers": headers})
+        await send({"type": "http.response.body", "body": b""})
+        return
+
+    headers.append((b"content-type", cached.content_type.encode("latin-1")))
+    if encoding is None:
+        headers.append((b"content-length",
+                        str(cached.size).encode("ascii")))
+        compress = None
+    else:
+        compress, finish = compressor(encoding)
+    await send({"type": "http.response.start", "status": 200,
+                "headers": headers})
+    chunks = cached.chunks()
+    read = sync_to_async(next, thread_sensitive=False)
+    chunk = await read(chunks, None)
+    while chunk is not None:
+        if compress is not None:
+            chunk = compress(chunk)
+        await send({"type": "http.response.body", "body": chunk,
+                    "more_body": True})
+        chunk = await read(chunks, None)
+    await send({"type": "http.response.body",
+                "body": finish() if compress is not None else b""})
+
+
+def _not_modified(request_headers, etag, last_modified):
+    """
+    What django.utils.cache.get_conditional_response decides for a GET:
+    If-None-Match with a weak comparison of the ETags, If-Modified-Since
+    only when there is no If-None-Match.
+    """
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = parse_etags(if_none_match)
+        if tags == ["*"]:
+            return True
+        return etag is not None and etag.strip("W/") in [
+            tag.strip("W/") for tag in tags]
+
+    since = parse_http_date_safe(request_headers.get("if-modified-since"))
+    modified = parse_http_date_safe(last_modified)
+    return since is not None and modified is not None and modified <= since
+
+
+async def _send_error(send, status, message):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"text/plain; charset=utf-8")]})
+    await send({"type": "http.response.body",
+                "body": message.encode("utf-8")})
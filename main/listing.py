@@ -0,0 +1,170 @@
+"""
+Pages for the long lists: the datasets on the portal, an account's and a
+keyword's page, and the accounts.
+
+Every list is paged by keyset. The cursor holds the sort values of the
+last row of a page, and the next page is the rows after those, so every
+page costs the same however far down the list it is and nothing is
+skipped or shown twice when rows are added in between. Lists by columns,
+like (title, id), ask for the rows after the cursor with a row value
+comparison, (title, id) > (%s, %s), which is a range scan of the index on
+those columns. Rows without a value in one of them (a NULL title) aren't
+listed, the forms never make those. Ranked lists (search results,
+datasets by how well they fit the map) are sorted by what the database
+works out for every row, there the cursor holds the rank too.
+
+Every list can also come as json with ?format=json, for the portal's
+infinite scrolling.
+"""
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connections
+from django.db.models import Q
+from django.http import HttpResponseBadRequest, JsonResponse
+from django.shortcuts import render
+
+from functools import reduce
+
+import base64
+import json
+import operator
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(
+        json.dumps(values).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor, length):
+    """
+    The values in a cursor, ValueError if it isn't one with length values.
+    """
+    try:
+        values = json.loads(
+            base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+    except (TypeError, ValueError, UnicodeError):
+        values = None
+    if (not isinstance(values, list) or len(values) != length or
+            not all(isinstance(value, (str, int, float)) and
+                    not isinstance(value, bool) for value in values)):
+        raise ValueError("cursor isn't one this list handed out")
+    return values
+
+
+def _column(model, field):
+    """
+    The field's column, None when it's an annotation.
+    """
+    try:
+        return (model._meta.pk if field == "pk"
+                else model._meta.get_field(field))
+    except FieldDoesNotExist:
+        return None
+
+
+def _row_after(queryset, fields, values):
+    """
+    (fields) > (values) as one row value comparison, for columns sorted
+    ascending.
+    """
+    quote = connections[queryset.db].ops.quote_name
+    table = quote(queryset.model._meta.db_table)
+    columns = ", ".join(
+        "{}.{}".format(table, quote(_column(queryset.model, field).column))
+        for field in fields)
+    return queryset.extra(
+        where=["({}) > ({})".format(columns, ", ".join(["%s"] * len(fields)))],
+        params=values)
+
+
+def _after(fields, values):
+    """
+    (fields) > (values) spelled out one field at a time, for the ranked
+    lists where some fields are sorted descending ("-overlap").
+    """
+    conditions = []
+    for i, (field, value) in enumerate(zip(fields, values)):
+        name = field.lstrip("-")
+        condition = Q(**{name + ("__lt" if field.startswith("-")
+                                 else "__gt"): value})
+        for earlier, earlier_value in zip(fields[:i], values[:i]):
+            condition &= Q(**{earlier.lstrip("-"): earlier_value})
+        conditions.append(condition)
+    return reduce(operator.or_, conditions)
+
+
+def keyset_page(queryset, fields, cursor=None, size=None):
+    """
+    One page of queryset sorted by fields, "-" in front for descending, the
+    last of them has to be unique. Returns the rows and the cursor of the
+    next page, None on the last one.
+    """
+    size = size or settings.LISTING_PAGE_SIZE
+    columns = [_column(queryset.model, field) for field in fields]
+    for field, column in zip(fields, columns):
+        if column is not None and column.null:
+            queryset = queryset.filter(**{field + "__isnull": False})
+    queryset = queryset.order_by(*fields)
+    if cursor:
+        values = decode_cursor(cursor, len(fields))
+        if None in columns or any(field.startswith("-") for field in fields):
+            queryset = queryset.filter(_after(fields, values))
+        else:
+            queryset = _row_after(queryset, fields, values)
+
+    rows = list(queryset[:size + 1])
+    if len(rows) <= size:
+        return rows, None
+    rows = rows[:size]
+    return rows, encode_cursor([getattr(rows[-1], field.lstrip("-"))
+                                for field in fields])
+
+
+def next_query(request, cursor):
+    """
+    The query string of the next page, with whatever else was asked for.
+    """
+    if cursor is None:
+        return None
+    query = request.GET.copy()
+    query["cursor"] = cursor
+    return query.urlencode()
+
+
+def wants_json(request):
+    return request.GET.get("format") == "json"
+
+
+def datasets_json(datasets, cursor):
+    """
+    A page of datasets for the portal's list. Like in the list itself the
+    url is left out for password protected datasets, those are loaded
+    through load_dataset.
+    """
+    results = []
+    for dataset in datasets:
+        result = {"id": dataset.pk, "title": dataset.title,
+                  "ext": dataset.ext, "page": dataset.get_absolute_url()}
+        if not dataset.dataset_password:
+            result["url"] = dataset.url
+        results.append(result)
+    return JsonResponse({"results": results, "next": cursor})
+
+
+def dataset_listing(request, datasets, template_name, context):
+    """
+    One page of datasets rendered into template_name as dataset_list, or as
+    json. datasets is a queryset, without an order it's listed by title.
+    """
+    cursor = request.GET.get("cursor")
+    fields = tuple(datasets.query.order_by) or ("title", "pk")
+    try:
+        page, next_cursor = keyset_page(datasets, fields, cursor)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    if wants_json(request):
+        return datasets_json(page, next_cursor)
+    context = dict(context, dataset_list=page, next_cursor=next_cursor,
+                   next_query=next_query(request, next_cursor))
+    return render(request, template_name, context)
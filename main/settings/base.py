@@ -73,6 +73,9 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'main.wsgi.application'
+ASGI_APPLICATION = 'main.asgi.application'
+
+DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
 
 AUTH_USER_MODEL = 'core.User'
 
@@ -156,3 +159,119 @@ EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD')
 DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL')
 
 EMAIL_USE_TLS = True
+
+
+# Dataset proxy (main.views.load_dataset)
+# Files bigger than the threshold, or without a Content-Length, are streamed
+# to the browser in chunks instead of being read into memory first.
+DATASET_STREAM_THRESHOLD = 5 * 1024 * 1024
+DATASET_CHUNK_SIZE = 64 * 1024
+DATASET_UPSTREAM_TIMEOUT = (5, 60)
+
+# Under ASGI (main/asgi.py) everything but the dataset proxy runs in this
+# many threads per process, like the NumThreads of the WSGI setup.
+DATASET_ASGI_THREADS = 20
+
+# Upstream connections are pooled per host, at most this many at a time per
+# process. A request waits DATASET_POOL_TIMEOUT seconds for a free one and is
+# answered 503 after that. Owncloud logins are reused for
+# DATASET_OWNCLOUD_LOGIN_TIMEOUT.
+DATASET_POOL_MAXSIZE = 10
+DATASET_POOL_TIMEOUT = 10
+DATASET_OWNCLOUD_LOGIN_TIMEOUT = 15 * 60
+
+# Copies of the upstream files, see datasets/cache.py. The backend is either
+# "disk", the name of one of the CACHES, or None to switch it off.
+DATASET_CACHE_BACKEND = "disk"
+DATASET_CACHE_DIR = os.path.join(BASE_DIR, "dataset_cache")
+DATASET_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+DATASET_CACHE_TIMEOUT = 60 * 60
+
+# The spatial index behind the tile and bbox queries, see datasets/spatial.py
+DATASET_INDEX_CELL_FEATURES = 16
+DATASET_INDEX_MEMORY = 8
+DATASET_TILE_MAX_ZOOM = 22
+
+# Simplified versions of line and polygon datasets, one for every zoom level
+# here, see datasets/simplify.py. They are built by background jobs
+# (datasets/jobs.py) after a dataset is saved, with
+# DATASET_BACKGROUND_JOBS = False those run right away instead.
+DATASET_SIMPLIFY_ZOOMS = (3, 6, 9, 12)
+DATASET_SIMPLIFY_PIXELS = 1
+DATASET_BACKGROUND_JOBS = True
+DATASET_BACKGROUND_WORKERS = 2
+
+# Server side point clustering, see datasets/clusters.py. The radius is in
+# pixels, like Leaflet.markercluster's maxClusterRadius.
+DATASET_CLUSTER_RADIUS = 40
+DATASET_CLUSTER_MAX_ZOOM = 16
+
+# Concurrent requests for the same file wait for the first one instead of
+# all going upstream, see datasets/singleflight.py. The lock between
+# processes lives in this one of the CACHES. It has to be one they all
+# share (see datasets/checks.py), so with None every process only waits
+# for its own requests, production.py sets it with memcached.
+DATASET_LOCK_CACHE = None
+DATASET_FLIGHT_TIMEOUT = 60
+
+# The refresh_datasets command, see datasets/refresh.py. Load counts are
+# written to the database at most every DATASET_ACCESS_FLUSH_INTERVAL
+# seconds.
+DATASET_REFRESH_WORKERS = 4
+DATASET_REFRESH_AHEAD = 10 * 60
+DATASET_REFRESH_PER_HOST = 2
+DATASET_REFRESH_HOST_INTERVAL = 1.0
+DATASET_ACCESS_FLUSH_INTERVAL = 60
+
+# The text search configuration the portal's full text index uses on
+# PostgreSQL, see datasets/fulltext.py. "simple" doesn't stem, the datasets
+# are in all sorts of languages.
+DATASET_SEARCH_CONFIG = "simple"
+
+# The search box suggestions, see datasets/autocomplete.py. Every process
+# keeps its own index and checks in DATASET_AUTOCOMPLETE_CACHE whether it's
+# still current. If that cache isn't shared between the processes (locmem)
+# the index is also built again every DATASET_AUTOCOMPLETE_MAX_AGE seconds.
+# Either way that's done by a background job, see DATASET_BACKGROUND_JOBS.
+DATASET_AUTOCOMPLETE_CACHE = "default"
+DATASET_AUTOCOMPLETE_MAX_AGE = 60
+DATASET_AUTOCOMPLETE_LIMIT = 10
+DATASET_AUTOCOMPLETE_MAX_LIMIT = 50
+
+# How many rows the long lists show at once, see main/listing.py
+LISTING_PAGE_SIZE = 50
+
+# Django's own default, spelled out since more and more lives in it. With
+# more than one process this has to be something they share, memcached or
+# redis.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    }
+}
+
+# Whole pages of the portal, keyword, dataset and embed views, see
+# datasets/pagecache.py. None switches it off. Changes show up right away
+# anyway, the timeout only clears out pages nobody asks for any more. It
+# has to be a cache all the processes share, the locmem one above isn't
+# (see datasets/checks.py), so it's only switched on in production.py.
+PAGE_CACHE = None
+PAGE_CACHE_TIMEOUT = 24 * 60 * 60
+
+# What browsers and CDNs are told about the embed pages, see public_page in
+# datasets/pagecache.py. Changes take up to PUBLIC_PAGE_MAX_AGE seconds to
+# show up on the pages that embed them.
+PUBLIC_PAGE_MAX_AGE = 5 * 60
+PUBLIC_PAGE_STALE_WHILE_REVALIDATE = 24 * 60 * 60
+
+# The bits of html of every dataset in the portal's lists, see
+# datasets/templatetags/dataset_list.py. None renders them every time.
+DATASET_LIST_CACHE = "default"
+
+# gzip or brotli for the dataset files, whichever the browser takes, see
+# datasets/compress.py. Files smaller than DATASET_COMPRESS_MIN_BYTES are
+# sent as they are.
+DATASET_COMPRESS = True
+DATASET_COMPRESS_MIN_BYTES = 1024
+DATASET_GZIP_LEVEL = 6
+DATASET_BROTLI_QUALITY = 5
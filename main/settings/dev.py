@@ -20,3 +20,7 @@ DEBUG = True
 #}
 
 
+
+# the templates change all the time while developing, and the tests would
+# get each other's bits of html
+DATASET_LIST_CACHE = None
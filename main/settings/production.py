@@ -36,3 +36,17 @@ if os.environ.get("ENVIRONMENT") == "PRODUCTION":
             "PORT": os.environ["DATABASE_PORT"],
         }
     }
+
+# There's more than one process (NumProcesses in .ebextensions), the caches
+# they use to tell each other about changes have to be shared. With
+# memcached the whole pages can be cached too, see datasets/pagecache.py,
+# and the downloads coalesced between processes, see datasets/singleflight.py.
+if os.environ.get("MEMCACHED_LOCATION"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.memcached.PyMemcacheCache",
+            "LOCATION": os.environ["MEMCACHED_LOCATION"].split(","),
+        }
+    }
+    PAGE_CACHE = "default"
+    DATASET_LOCK_CACHE = "default"
@@ -32,6 +32,22 @@ urlpatterns = [
         views.load_dataset,
         name='load_dataset'),
 
+    url(r'^within_polygon/(?P<pk>[0-9]+)/$',
+        views.within_polygon,
+        name='within_polygon'),
+
+    url(r'^tiles/(?P<pk>[0-9]+)/(?P<z>[0-9]+)/(?P<x>[0-9]+)/(?P<y>[0-9]+)/$',
+        views.dataset_tile,
+        name='dataset_tile'),
+
+    url(r'^clusters/(?P<pk>[0-9]+)/(?P<z>[0-9]+)/$',
+        views.dataset_clusters,
+        name='dataset_clusters'),
+
+    url(r'^autocomplete/$',
+        views.autocomplete,
+        name='autocomplete'),
+
     # should this be part of the accounts app, where I create an account?
     url(r'^register/',
         CreateView.as_view(
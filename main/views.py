@@ -1,70 +1,530 @@
+from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
-from django.db.models import Q
-from django.http import HttpResponse
-from django.shortcuts import render
+from django.http import Http404, HttpResponse, HttpResponseBadRequest
+from django.http import JsonResponse
+from django.http import HttpResponseNotModified
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response
+from django.utils.http import parse_http_date_safe, quote_etag
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 
 from datasets.models import Dataset
+from datasets.access import record_access
+from datasets.autocomplete import prefix_index
+from datasets.cache import fetch_payload, get_derived, payload_cache
+from datasets.cache import NoPayloadCache, payload_flight, store_derived
+from datasets.clusters import cluster_features, load_clusters
+from datasets.compress import compressed_chunks, encoded_etag, negotiate
+from datasets.compress import set_encoding, variant_for
+from datasets.convert import GEOJSON_CONTENT_TYPE, ConversionError
+from datasets.convert import geojson_chunks, to_geojson
+from datasets.downloads import Download, current_download, streamed
+from datasets.fulltext import search
+from datasets.pagecache import CATALOGUE, cache_page
+from datasets.search import in_extent, rank_by_overlap
+from datasets.spatial import PolygonFilter, load_index, parse_bbox
+from datasets.spatial import polygons_from_geojson, tile_bbox
+from datasets.simplify import level_for, only_points, simplified_chunks
+from datasets.simplify import variant_name
+from datasets.upstream import conditional_headers, iter_upstream
+from datasets.upstream import PoolTimeout, UpstreamError, open_upstream
+from datasets.upstream import read_small, upstream_length
 
-import requests
-import owncloud
-import json
-import os
+from main.listing import dataset_listing
 
-from cryptography.fernet import Fernet
+import json
 
 
 def load_dataset(request, pk):
     """
-    This needs to be fixed to run asynchronously, incase of a very large
-    dataset, actually... would that even matter?
+    Under ASGI (main/asgi.py) the requests that have to wait on upstream
+    don't get here, main/async_proxy.py answers those on the event loop.
 
     Maybe there's a better wy to do this whole secret crypto key thing, I
     still don't feel like it's secure enough
+
+    Small files are read whole like before. Once a file gets bigger than
+    DATASET_STREAM_THRESHOLD the rest of it is streamed through in chunks,
+    so a huge geojson never sits in memory all at once.
+
+    A copy of every file that came back ok is kept in the payload cache
+    (datasets/cache.py), the next request for it doesn't go upstream. Once
+    that copy is stale upstream is asked whether the file changed before it
+    is downloaded again, and the browser gets an ETag / Last-Modified so it
+    can do the same with us.
+
+    With ?format=geojson csv, tsv and kml files are converted on the server
+    first, see _converted_response. With ?bbox=minx,miny,maxx,maxy only the
+    features in that part of the map come back, as geojson. With ?zoom= or
+    ?tolerance= (in degrees) lines and polygons come back simplified, see
+    _simplified_response.
     """
-    CRYPTO_KEY = os.environ.get("CRYPTO_KEY")
-    cipher_end = Fernet(CRYPTO_KEY)
+    dataset = get_object_or_404(Dataset, pk=pk)
+    cache = payload_cache()
+    record_access(dataset.pk)
+
+    if "bbox" in request.GET:
+        return _bbox_response(request, dataset, cache)
+    if "zoom" in request.GET or "tolerance" in request.GET:
+        try:
+            level = _simplify_level(request)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+        # a file with only points comes back as it is
+        if level is not None and not only_points(dataset):
+            return _simplified_response(request, dataset, cache, level)
+    if request.GET.get("format") == "geojson" and dataset.ext != "geojson":
+        return _converted_response(request, dataset, cache)
 
-    # bring in the dataset by pk
-    dataset = Dataset.objects.get(pk=pk)
+    cached = cache.get(dataset, stale=True)
+    if cached is not None and cached.fresh:
+        return _cached_response(request, cached, "hit", dataset, cache)
 
-    # this would probably go better with a little loop or something
-    bytes_user = dataset.dataset_user.encode("utf-8")
-    bytes_password = dataset.dataset_password.encode("utf-8")
-    decrypted_user = cipher_end.decrypt(bytes_user).decode("utf-8")
-    decrypted_password = cipher_end.decrypt(bytes_password).decode("utf-8")
+    # only one request at a time goes upstream for the same file, the others
+    # follow its download (see datasets/downloads.py) or wait for it and
+    # are answered from the cache
+    flight = payload_flight(cache, dataset)
+    if not flight.leader:
+        download = current_download(flight.key)
+        chunks = download.follow() if download is not None else None
+        if chunks is not None:
+            return _download_response(request, download, chunks,
+                                      "coalesced")
+        flight.wait()
+        landed = cache.get(dataset)
+        if landed is not None:
+            return _cached_response(request, landed, "coalesced", dataset,
+                                    cache)
+    return _landing(flight, _upstream_response, request, dataset, cache,
+                    cached, flight)
 
-    # use owncloud stuff, if the owncloud thing is true
-    if dataset.owncloud:
-        # owncloud, instead of requests.
-        oc = owncloud.Client(dataset.owncloud_instance)
-        oc.login(decrypted_user, decrypted_password)
-        data = oc.get_file_contents(dataset.owncloud_path)
+
+def _upstream_response(request, dataset, cache, cached, flight):
+    # a stale copy is revalidated with its own validators, without a copy the
+    # browser's are passed on so that a 304 can go all the way through
+    if cached is not None:
+        headers = conditional_headers(cached.meta.get("etag"),
+                                      cached.meta.get("last_modified"))
     else:
-        data = requests.get(dataset.url,
-                            auth=(decrypted_user, decrypted_password)).content
+        headers = conditional_headers(
+            request.META.get("HTTP_IF_NONE_MATCH"),
+            request.META.get("HTTP_IF_MODIFIED_SINCE"))
+
+    try:
+        upstream = open_upstream(dataset, headers)
+    except PoolTimeout as e:
+        if cached is not None:
+            return _cached_response(request, cached, "stale", dataset, cache)
+        return _busy(e)
+    etag = upstream.headers.get("ETag")
+    last_modified = upstream.headers.get("Last-Modified")
+
+    if cached is not None and (upstream.status_code == 304 or
+                               upstream.status_code >= 500):
+        upstream.close()
+        if upstream.status_code == 304:
+            cache.revalidated(dataset, etag=etag, last_modified=last_modified)
+            return _cached_response(request, cached, "revalidated", dataset,
+                                    cache)
+        return _cached_response(request, cached, "stale", dataset, cache)
+
+    if upstream.status_code == 304:
+        upstream.close()
+        response = HttpResponseNotModified()
+        _set_validators(response, etag, last_modified)
+        return response
+
+    content_type = upstream.headers.get("Content-Type",
+                                        "application/octet-stream")
+    meta = {"content_type": content_type, "etag": etag,
+            "last_modified": last_modified}
+    chunks = iter_upstream(upstream)
+    length = upstream_length(upstream)
+    if (upstream.status_code == 200 and streamed(length) and
+            not isinstance(cache, NoPayloadCache)):
+        data, rest = read_small(chunks, settings.DATASET_STREAM_THRESHOLD)
+        if rest is not None:
+            # a big file goes into the cache as fast as upstream sends it,
+            # this browser and the others follow it on the way
+            download = Download(flight, cache, dataset, meta, length)
+            followed = download.follow()
+            download.start(rest)
+            return _download_response(request, download, followed, "miss")
+        chunks = iter([data])
+    if upstream.status_code == 200:
+        chunks = cache.store(dataset, chunks, meta)
+
+    encoding = None
+    if upstream.status_code == 200:
+        encoding = negotiate(request.META.get("HTTP_ACCEPT_ENCODING"),
+                             length)
+    if encoding is not None:
+        # the file is cached as it is and compressed on the way out
+        chunks = compressed_chunks(chunks, encoding)
+        length = None
+        etag = encoded_etag(etag, encoding)
+
+    response = _payload_response(chunks, content_type, length,
+                                 upstream.status_code)
+    if upstream.status_code == 200:
+        _set_validators(response, etag, last_modified)
+        set_encoding(response, encoding)
+    response["X-Dataset-Cache"] = "miss"
+    return response
+
+
+def _download_response(request, download, chunks, state):
+    """
+    The file while a Download is still writing it to the cache.
+    """
+    etag = download.meta.get("etag")
+    last_modified = download.meta.get("last_modified")
+    length = download.length
+    encoding = negotiate(request.META.get("HTTP_ACCEPT_ENCODING"), length)
+    if encoding is not None:
+        chunks = compressed_chunks(chunks, encoding)
+        length = None
+        etag = encoded_etag(etag, encoding)
+
+    response = StreamingHttpResponse(
+        chunks, content_type=download.meta["content_type"])
+    if length is not None:
+        response["Content-Length"] = length
+    _set_validators(response, etag, last_modified)
+    set_encoding(response, encoding)
+    response["X-Dataset-Cache"] = state
+    return response
+
+
+def _busy(e):
+    """
+    Every pooled connection to upstream is taken, the browser should try
+    again in a bit.
+    """
+    response = HttpResponse(str(e), status=503)
+    response["Retry-After"] = str(settings.DATASET_POOL_TIMEOUT)
+    return response
+
 
-    return HttpResponse(data)
+def _landing(flight, respond, *args):
+    """
+    Calls respond(*args) and lands the flight once the response was built,
+    unless a Download took it over.
+    """
+    try:
+        return respond(*args)
+    finally:
+        flight.land()
+
+
+def _converted_response(request, dataset, cache):
+    """
+    The converted file is kept as the "geojson" variant of the cached
+    payload, so the conversion only runs once for every version of the
+    source file.
+    """
+    def build(cache, source):
+        return to_geojson(dataset.ext, source.chunks(),
+                          settings.DATASET_CHUNK_SIZE)
+
+    return _derived_response(request, dataset, cache, "geojson", build)
+
+
+def _simplify_level(request):
+    if "zoom" in request.GET:
+        zoom = int(request.GET["zoom"])
+        if zoom < 0:
+            raise ValueError("zoom can't be negative")
+        return level_for(zoom=zoom)
+    tolerance = float(request.GET["tolerance"])
+    if not tolerance >= 0:
+        raise ValueError("tolerance has to be a positive number")
+    return level_for(tolerance=tolerance)
+
+
+def _simplified_response(request, dataset, cache, level):
+    """
+    The level is normally built already by the job that runs after the
+    dataset is saved, if it isn't it's built here and kept for next time.
+    """
+    def build(cache, source):
+        return simplified_chunks(dataset, source, level)
+
+    return _derived_response(request, dataset, cache, variant_name(level),
+                             build)
+
+
+def _bbox_response(request, dataset, cache):
+    """
+    Answered from the dataset's FeatureIndex, only the features that are
+    found are read. Nothing is cached here, every viewport is different.
+    """
+    try:
+        bbox = parse_bbox(request.GET["bbox"])
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    def build(cache, source):
+        index = load_index(dataset, cache, source)
+        return geojson_chunks(index.features(index.query(bbox)),
+                              settings.DATASET_CHUNK_SIZE)
+
+    return _derived_response(request, dataset, cache, None, build)
+
+
+@csrf_exempt
+@require_POST
+def within_polygon(request, pk):
+    """
+    The "Get data within a polygon" tool done on the server, for datasets
+    that are too big to load into the browser first. The body is a geojson
+    Polygon or MultiPolygon (or a Feature with one), what comes back is a
+    geojson FeatureCollection with the dataset's features that are inside it
+    or touch it. It's a POST only because of the size of the polygon, it
+    doesn't change anything, so it doesn't need the csrf token the (cached,
+    anonymous) portal pages don't have.
+    """
+    dataset = get_object_or_404(Dataset, pk=pk)
+    try:
+        polygon = PolygonFilter(polygons_from_geojson(
+            json.loads(request.body.decode("utf-8"))))
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    def build(cache, source):
+        index = load_index(dataset, cache, source)
+        return geojson_chunks(polygon.filter(index),
+                              settings.DATASET_CHUNK_SIZE)
+
+    return _derived_response(request, dataset, payload_cache(), None, build)
+
+
+def _derived_response(request, dataset, cache, variant, build):
+    """
+    Serves geojson that is built from the dataset's file, like the
+    converted csv or a single tile. build(cache, source) returns the chunks,
+    or None for an empty FeatureCollection. If variant is given the result
+    is kept in the payload cache under that name for as long as the source
+    file doesn't change, empty ones aren't worth a cache entry.
+    """
+    try:
+        source = fetch_payload(dataset, cache)
+        if variant is None:
+            return _build_response(request, dataset, cache, variant, source,
+                                   build)
+
+        cached = get_derived(cache, dataset, variant, source)
+        if cached is not None:
+            return _cached_response(request, cached, "hit", dataset, cache,
+                                    variant)
+        flight = payload_flight(cache, dataset, variant)
+        if not flight.leader:
+            flight.wait()
+            cached = get_derived(cache, dataset, variant, source)
+            if cached is not None:
+                return _cached_response(request, cached, "coalesced",
+                                        dataset, cache, variant)
+        return _landing(flight, _build_response, request, dataset, cache,
+                        variant, source, build)
+    except PoolTimeout as e:
+        return _busy(e)
+    except UpstreamError as e:
+        return HttpResponse(str(e), status=502)
+    except ConversionError as e:
+        return HttpResponse(str(e), status=422)
+
+
+def _build_response(request, dataset, cache, variant, source, build):
+    chunks = build(cache, source)
+    if chunks is None:
+        chunks = geojson_chunks([])
+    elif variant is not None:
+        chunks = store_derived(cache, dataset, variant, source, chunks,
+                               {"content_type": GEOJSON_CONTENT_TYPE})
+    encoding = negotiate(request.META.get("HTTP_ACCEPT_ENCODING"))
+    if encoding is not None:
+        chunks = compressed_chunks(chunks, encoding)
+    response = _payload_response(chunks, GEOJSON_CONTENT_TYPE, None, 200)
+    set_encoding(response, encoding)
+    response["X-Dataset-Cache"] = "miss"
+    return response
+
+
+def dataset_tile(request, pk, z, x, y):
+    """
+    One z/x/y tile of a dataset as geojson, with every feature whose
+    bounding box touches the tile, so a Leaflet tile layer only downloads
+    the part of a big dataset that is on the screen. Features keep their
+    number in the file as their id, the ones that are in more than one tile
+    can be told apart that way. Tiles are cut from the dataset's
+    FeatureIndex the first time they're asked for, and cached after that,
+    unless there's nothing in them (most tiles around a dataset are empty).
+    """
+    dataset = get_object_or_404(Dataset, pk=pk)
+    z, x, y = int(z), int(x), int(y)
+    if z > settings.DATASET_TILE_MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        raise Http404("There is no such tile")
+
+    def build(cache, source):
+        index = load_index(dataset, cache, source)
+        numbers = index.query(tile_bbox(z, x, y))
+        if not numbers:
+            return None
+        return geojson_chunks(index.features(numbers),
+                              settings.DATASET_CHUNK_SIZE)
+
+    variant = "tile.{}.{}.{}".format(z, x, y)
+    return _derived_response(request, dataset, payload_cache(), variant,
+                             build)
+
+
+def dataset_clusters(request, pk, z):
+    """
+    The points of a dataset clustered for zoom level z, for the "Cluster
+    Points Markers" button. Clusters are features with cluster: true and a
+    point_count, points that aren't in a cluster come back as they are in
+    the file. ?bbox=minx,miny,maxx,maxy limits it to what's on the screen.
+    """
+    dataset = get_object_or_404(Dataset, pk=pk)
+    zoom = int(z)
+    if zoom > settings.DATASET_TILE_MAX_ZOOM:
+        raise Http404("There is no such zoom level")
+    try:
+        bbox = parse_bbox(request.GET.get("bbox", "-180,-90,180,90"))
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    def build(cache, source):
+        index = load_index(dataset, cache, source)
+        levels = load_clusters(dataset, cache, source)
+        return geojson_chunks(cluster_features(index, levels, zoom, bbox),
+                              settings.DATASET_CHUNK_SIZE)
+
+    return _derived_response(request, dataset, payload_cache(), None, build)
+
+
+def _cached_response(request, cached, state, dataset, cache,
+                     variant="raw"):
+    """
+    Upstream's own validators are used when it sent any, so the browser's
+    copy stays valid whether or not it came through the cache. A compressed
+    copy gets its own ETag, see datasets/compress.py.
+    """
+    etag = cached.meta.get("etag") or quote_etag(cached.meta["sha1"])
+    last_modified = cached.meta.get("last_modified")
+    encoding = negotiate(request.META.get("HTTP_ACCEPT_ENCODING"),
+                         cached.size)
+    if encoding is not None:
+        etag = encoded_etag(etag, encoding)
+
+    response = get_conditional_response(
+        request, etag=etag, last_modified=parse_http_date_safe(last_modified))
+    if response is None and encoding is None:
+        response = _payload_response(cached.chunks(), cached.content_type,
+                                     cached.size, 200)
+    elif response is None:
+        response = _compressed_response(dataset, cache, variant, cached,
+                                        encoding)
+    _set_validators(response, etag, last_modified)
+    set_encoding(response, encoding)
+    response["X-Dataset-Cache"] = state
+    return response
+
+
+def _compressed_response(dataset, cache, variant, cached, encoding):
+    """
+    The compressed file is kept as another variant built from the cached
+    one, so it's compressed once for every version of the file and not for
+    every request.
+    """
+    name = variant_for(variant, encoding)
+    compressed = get_derived(cache, dataset, name, cached)
+    if compressed is not None:
+        return _payload_response(compressed.chunks(), cached.content_type,
+                                 compressed.size, 200)
+    chunks = store_derived(cache, dataset, name, cached,
+                           compressed_chunks(cached.chunks(), encoding),
+                           {"content_type": cached.content_type})
+    return _payload_response(chunks, cached.content_type, None, 200)
+
+
+def _set_validators(response, etag, last_modified):
+    if etag:
+        response["ETag"] = etag
+    if last_modified:
+        response["Last-Modified"] = last_modified
+
+
+def _payload_response(chunks, content_type, length, status):
+    data, chunks = read_small(chunks, settings.DATASET_STREAM_THRESHOLD)
+    if data is not None:
+        return HttpResponse(data, content_type=content_type, status=status)
+
+    response = StreamingHttpResponse(chunks, content_type=content_type,
+                                     status=status)
+    if length is not None:
+        response["Content-Length"] = length
+    return response
+
+
+def autocomplete(request):
+    """
+    Suggestions for the search box as json, see datasets/autocomplete.py.
+    ?q= is what was typed so far, ?limit= how many come back at once and
+    ?cursor= the "next" of the page before.
+    """
+    try:
+        limit = int(request.GET.get("limit",
+                                    settings.DATASET_AUTOCOMPLETE_LIMIT))
+        if not 0 < limit <= settings.DATASET_AUTOCOMPLETE_MAX_LIMIT:
+            raise ValueError("limit has to be between 1 and {}".format(
+                settings.DATASET_AUTOCOMPLETE_MAX_LIMIT))
+        suggestions, next_cursor = prefix_index().page(
+            request.GET.get("q", ""), request.GET.get("cursor"), limit)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    return JsonResponse({
+        "results": [{"type": entry.kind, "id": entry.pk, "text": entry.text,
+                     "url": entry.url} for entry in suggestions],
+        "next": next_cursor})
 
 
 # the search function on this page should be controlled by another view
 # and called with ajax
+@cache_page(lambda: [CATALOGUE])
 def portal(request):
     """
     I'm not ready to try and make this filter function ajax yet. That will
     have to wait a bit longer.
+
+    The search box goes through the full text index (datasets/fulltext.py),
+    best match first. With ?bbox=minx,miny,maxx,maxy only the datasets in
+    that part of the map are listed, the ones that fit it best first, see
+    datasets/search.py.
+
+    The list comes a page at a time, see main/listing.py.
     """
-    D = Dataset.objects.all()
+    D = Dataset.objects.select_related("account__user")
+
+    bbox = None
+    if request.GET.get("bbox"):
+        try:
+            bbox = parse_bbox(request.GET["bbox"])
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+        D = in_extent(D, bbox)
 
     if "q" in request.GET:
-        q = request.GET["q"]
-        dataset_list = D.filter(
-            Q(title__icontains=q) |
-            Q(account__user__username__icontains=q) |
-            Q(author__icontains=q) |
-            Q(keywords__keyword__icontains=q)
-        ).order_by("title").distinct()
+        dataset_list = search(D, request.GET["q"])
     else:
-        dataset_list = D.order_by("title")
+        dataset_list = D
+
+    if bbox is not None:
+        dataset_list = rank_by_overlap(dataset_list, bbox)
 
     template_name = "portal.html"
-    return render(request, template_name, {"dataset_list": dataset_list})
\ No newline at end of file
+    return dataset_listing(request, dataset_list, template_name,
+                           {"bbox": request.GET.get("bbox")})
\ No newline at end of file
@@ -31,3 +31,4 @@ pip install -r requirements.txt
 
 python manage.py migrate
 #gunicorn main.wsgi:application --bind 0.0.0.0:8000
+#gunicorn main.asgi:application -k uvicorn.workers.UvicornWorker --bind 0.0.0.0:8000
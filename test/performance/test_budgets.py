@@ -0,0 +1,165 @@
+"""
+How many queries and how much time every page may take with a catalogue
+the size we're heading for, so an N+1 in a template shows up as a failing
+test rather than as a slow site.
+
+These aren't part of test.unit_tests, filling the database takes a while.
+Run them with
+
+    python manage.py test test.performance --settings=main.settings.dev
+
+PERF_SCALE makes the catalogue smaller (0.1) or bigger (2), PERF_TIME_FACTOR
+gives slow machines more time. A table of what every page took is printed
+at the end.
+"""
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils.text import slugify
+
+from accounts.models import Account
+from datasets.models import Dataset
+from keywords.models import Keyword, count_datasets
+
+import os
+import sys
+import time
+
+User = get_user_model()
+
+SCALE = float(os.environ.get("PERF_SCALE", "1"))
+TIME_FACTOR = float(os.environ.get("PERF_TIME_FACTOR", "1"))
+
+ACCOUNTS = max(int(2000 * SCALE), 2)
+KEYWORDS = max(int(5000 * SCALE), 2)
+DATASETS = max(int(50000 * SCALE), 2)
+# every dataset gets this many keywords
+KEYWORDS_PER_DATASET = 3
+
+# name: (most queries, most seconds)
+BUDGETS = {
+    "portal": (1, 0.5),
+    "dataset_detail": (2, 0.5),
+    "embed_dataset": (1, 0.5),
+    "keyword_list": (2, 2.0),
+    "keyword_detail": (2, 0.5),
+    "account_detail": (3, 0.5),
+    "account_list": (1, 0.5),
+}
+
+
+class PerformanceBudgetTests(TestCase):
+
+    results = []
+
+    @classmethod
+    def setUpTestData(cls):
+        # bulk_create skips the signal handlers, nothing is harvested,
+        # indexed or counted on the way
+        User.objects.bulk_create(
+            [User(username="user{:05d}".format(i)) for i in range(ACCOUNTS)],
+            batch_size=1000)
+        users = list(User.objects.order_by("pk"))
+        Account.objects.bulk_create(
+            [Account(user=user, account_slug=slugify(user.username))
+             for user in users], batch_size=1000)
+        accounts = list(Account.objects.order_by("pk"))
+
+        Keyword.objects.bulk_create(
+            [Keyword(keyword="keyword {:05d}".format(i),
+                     keyword_slug="keyword-{:05d}".format(i))
+             for i in range(KEYWORDS)], batch_size=1000)
+        keywords = list(Keyword.objects.order_by("pk").values_list(
+            "pk", flat=True))
+
+        Dataset.objects.bulk_create(
+            [Dataset(account=accounts[i % len(accounts)],
+                     title="Dataset {:06d}".format(i),
+                     dataset_slug="dataset-{:06d}".format(i),
+                     author="author {}".format(i % 100),
+                     description="Seeded for the performance budgets",
+                     url="https://example.com/{}.geojson".format(i),
+                     ext="geojson")
+             for i in range(DATASETS)], batch_size=1000)
+        datasets = Dataset.objects.order_by("pk").values_list("pk", flat=True)
+
+        Through = Dataset.keywords.through
+        Through.objects.bulk_create(
+            [Through(dataset_id=pk, keyword_id=keywords[(pk * 7 + n) %
+                                                        len(keywords)])
+             for pk in datasets for n in range(KEYWORDS_PER_DATASET)],
+            batch_size=5000)
+        count_datasets(Keyword.objects.all())
+
+        dataset = Dataset.objects.select_related("account").order_by(
+            "pk").first()
+        cls.urls = {
+            "portal": reverse("portal"),
+            "dataset_detail": dataset.get_absolute_url(),
+            "embed_dataset": reverse(
+                "datasets:embed_dataset",
+                kwargs={"account_slug": dataset.account.account_slug,
+                        "dataset_slug": dataset.dataset_slug}),
+            "keyword_list": reverse("keywords:keyword_list"),
+            "keyword_detail": Keyword.objects.order_by("pk").first()
+            .get_absolute_url(),
+            "account_detail": dataset.account.get_absolute_url(),
+            "account_list": reverse("accounts:account_list"),
+        }
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        lines = ["", "{} datasets, {} keywords, {} accounts".format(
+            DATASETS, KEYWORDS, ACCOUNTS),
+            "{:<16} {:>8} {:>8} {:>10} {:>10}".format(
+                "view", "queries", "budget", "ms", "budget")]
+        for name, queries, seconds in sorted(cls.results):
+            most_queries, most_seconds = BUDGETS[name]
+            lines.append("{:<16} {:>8} {:>8} {:>10.1f} {:>10.0f}".format(
+                name, queries, most_queries, seconds * 1000,
+                most_seconds * TIME_FACTOR * 1000))
+        sys.stderr.write("\n".join(lines) + "\n")
+
+    def assertWithinBudget(self, name):
+        url = self.urls[name]
+        # the first request pays for imports and template loading
+        self.assertEqual(200, self.client.get(url).status_code)
+
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = self.client.get(url)
+            seconds = time.perf_counter() - started
+        self.assertEqual(200, response.status_code)
+        self.results.append((name, len(queries), seconds))
+
+        most_queries, most_seconds = BUDGETS[name]
+        self.assertLessEqual(
+            len(queries), most_queries, "{} ran {} queries:\n{}".format(
+                name, len(queries),
+                "\n".join(query["sql"] for query in queries)))
+        self.assertLessEqual(seconds, most_seconds * TIME_FACTOR,
+                             "{} took {:.3f}s".format(name, seconds))
+
+    def test_portal(self):
+        self.assertWithinBudget("portal")
+
+    def test_dataset_detail(self):
+        self.assertWithinBudget("dataset_detail")
+
+    def test_embed_dataset(self):
+        self.assertWithinBudget("embed_dataset")
+
+    def test_keyword_list(self):
+        self.assertWithinBudget("keyword_list")
+
+    def test_keyword_detail(self):
+        self.assertWithinBudget("keyword_detail")
+
+    def test_account_detail(self):
+        self.assertWithinBudget("account_detail")
+
+    def test_account_list(self):
+        self.assertWithinBudget("account_list")
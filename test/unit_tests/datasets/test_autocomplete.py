@@ -0,0 +1,162 @@
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from datasets.autocomplete import Entry, PrefixIndex, forget, prefix_index
+from datasets.models import Dataset
+
+from keywords.models import Keyword
+
+from unittest import mock
+
+import threading
+import time
+
+User = get_user_model()
+
+
+ENTRIES = [
+    Entry("dataset", 1, "Mangroves of Java", "/a/mangroves-of-java/"),
+    Entry("dataset", 1, "Pat", "/a/mangroves-of-java/"),
+    Entry("dataset", 2, "Coral reefs of Java", "/a/coral-reefs-of-java/"),
+    Entry("keyword", 3, "Mangrove", "/keywords/mangrove/"),
+    Entry("account", 4, "zmt_bremen", "/zmt_bremen/"),
+    Entry("dataset", 5, "Ökologie der Küste", "/a/okologie/"),
+]
+
+
+class PrefixIndexTests(SimpleTestCase):
+
+    def setUp(self):
+        self.index = PrefixIndex(ENTRIES)
+
+    def texts(self, q):
+        return [entry.text for key, entry in self.index.lookup(q)]
+
+    def test_words_are_matched_by_prefix(self):
+        self.assertEqual(["Mangroves of Java", "Mangrove"],
+                         self.texts("mangr"))
+
+    def test_every_word_has_to_match(self):
+        self.assertEqual(["Coral reefs of Java"], self.texts("java cor"))
+
+    def test_starting_the_same_way_comes_first(self):
+        index = PrefixIndex([Entry("dataset", 1, "Coral reefs of Java", "/"),
+                             Entry("dataset", 2, "Java Sea", "/")])
+        self.assertEqual(["Java Sea", "Coral reefs of Java"],
+                         [entry.text for key, entry in index.lookup("java")])
+
+    def test_accents_and_case_dont_matter(self):
+        self.assertEqual(["Ökologie der Küste"], self.texts("OKOL"))
+
+    def test_typos_are_found_by_trigrams(self):
+        self.assertIn("Mangroves of Java", self.texts("mangorves"))
+
+    def test_a_dataset_is_only_suggested_once(self):
+        index = PrefixIndex([Entry("dataset", 1, "Java", "/"),
+                             Entry("dataset", 1, "Javier", "/")])
+        self.assertEqual(1, len(index.lookup("jav")))
+
+    def test_nothing_typed_suggests_nothing(self):
+        self.assertEqual([], self.texts("  "))
+
+    def test_pages_follow_each_other(self):
+        entries = [Entry("keyword", i, "reef {}".format(i), "/")
+                   for i in range(25)]
+        index = PrefixIndex(entries)
+        seen = []
+        cursor = None
+        while True:
+            page, cursor = index.page("reef", cursor, limit=10)
+            seen += [entry.pk for entry in page]
+            if cursor is None:
+                break
+        self.assertEqual(sorted(range(25)), sorted(seen))
+        self.assertEqual(25, len(set(seen)))
+
+    def test_short_prefixes_page_like_the_rest(self):
+        entries = [Entry(kind, i, "{} {}".format(word, i), "/")
+                   for i in range(30)
+                   for kind, word in (("keyword", "reef"),
+                                      ("dataset", "red sea"),
+                                      ("account", "the reef"))]
+        index = PrefixIndex(entries)
+        with mock.patch.object(index, "_short", {}):
+            expected = index.page("re", limit=7)
+            expected_next = index.page("re", expected[1], limit=7)
+        first = index.page("Re", limit=7)
+        self.assertEqual(expected, first)
+        self.assertEqual(expected_next, index.page("re", first[1], limit=7))
+
+    def test_broken_cursor_is_a_value_error(self):
+        for cursor in ("not a cursor", "WyJhIiwgMCwgIngiLCAxXQ=="):
+            with self.assertRaises(ValueError):
+                self.index.page("java", cursor)
+
+
+@override_settings(DATASET_BACKGROUND_JOBS=False)
+class PrefixIndexFromDatabaseTests(TestCase):
+
+    def setUp(self):
+        forget()
+        self.u1 = User.objects.create_user(
+            username="zmt_bremen", password="test_password")
+        self.ds1 = Dataset.objects.create(
+            account=self.u1.account, author="Pat", title="Mangroves",
+            url="https://example.com/mangroves.geojson")
+        Keyword.objects.create(keyword="Mangrove forests")
+
+    def test_datasets_keywords_and_accounts_are_suggested(self):
+        kinds = [(entry.kind, entry.url) for key, entry in
+                 prefix_index().lookup("zmt")]
+        self.assertEqual([("account", "/zmt_bremen/")], kinds)
+        kinds = [entry.kind for key, entry in prefix_index().lookup("mangrove")]
+        self.assertEqual(["dataset", "keyword"], kinds)
+
+    def test_index_is_rebuilt_after_changes(self):
+        first = prefix_index()
+        self.assertIs(first, prefix_index())
+        self.ds1.title = "Seagrass"
+        self.ds1.save()
+        self.assertIsNot(first, prefix_index())
+        self.assertEqual(["Seagrass"], [entry.text for key, entry in
+                                        prefix_index().lookup("seag")])
+
+    def test_logging_in_doesnt_rebuild_the_index(self):
+        first = prefix_index()
+        self.client.login(username="zmt_bremen", password="test_password")
+        self.assertIs(first, prefix_index())
+
+    def test_unshared_cache_rebuilds_the_index_after_a_while(self):
+        first = prefix_index()
+        # another process changed the title, this one wasn't told
+        Dataset.objects.filter(pk=self.ds1.pk).update(title="Seagrass")
+        self.assertIs(first, prefix_index())
+        later = time.monotonic() + 61
+        with self.settings(DATASET_AUTOCOMPLETE_MAX_AGE=60), \
+                mock.patch("time.monotonic", return_value=later):
+            self.assertEqual(["Seagrass"], [entry.text for key, entry in
+                                            prefix_index().lookup("seag")])
+
+    @override_settings(DATASET_BACKGROUND_JOBS=True)
+    def test_old_index_is_served_while_the_new_one_is_built(self):
+        first = prefix_index()
+        self.ds1.title = "Seagrass"
+        self.ds1.save()
+        building = threading.Event()
+        go_on = threading.Event()
+        rebuilt = PrefixIndex([Entry("dataset", 1, "Seagrass", "/")])
+
+        def build():
+            building.set()
+            go_on.wait(5)
+            return rebuilt
+
+        with mock.patch.object(PrefixIndex, "build", side_effect=build):
+            self.assertIs(first, prefix_index())
+            self.assertTrue(building.wait(5))
+            self.assertIs(first, prefix_index())
+            go_on.set()
+            deadline = time.time() + 5
+            while prefix_index() is first and time.time() < deadline:
+                time.sleep(0.01)
+        self.assertIs(rebuilt, prefix_index())
@@ -0,0 +1,152 @@
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+
+from datasets.cache import BackendPayloadCache, DiskPayloadCache
+from datasets.cache import source_version
+from datasets.models import Dataset
+
+from unittest import mock
+
+import os
+import shutil
+import tempfile
+import time
+
+User = get_user_model()
+
+
+class DiskPayloadCacheTests(TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir, True)
+        self.cache = DiskPayloadCache(self.cache_dir, max_bytes=1000,
+                                      timeout=60)
+
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+
+        self.ds1 = Dataset.objects.create(
+            account=self.u1.account,
+            author="Google",
+            title="Google GeoJSON Example",
+            url="https://storage.googleapis.com/maps-devrel/google.json")
+
+        self.ds2 = Dataset.objects.create(
+            account=self.u1.account,
+            author="Pat",
+            title="Bienvenidos",
+            url="https://raw.githubusercontent.com/zmtdummy/" +
+                "GeoJsonData/master/bienvenidos.json")
+
+    def store(self, dataset, body):
+        meta = {"content_type": "application/json"}
+        return b"".join(self.cache.store(dataset, iter([body]), meta))
+
+    def test_stored_payload_can_be_read_back(self):
+        self.assertEqual(b"0123456789", self.store(self.ds1, b"0123456789"))
+        cached = self.cache.get(self.ds1)
+        self.assertEqual(b"0123456789", cached.read())
+        self.assertEqual(10, cached.size)
+        self.assertEqual("application/json", cached.content_type)
+
+    def test_payload_is_not_stored_when_the_download_stops_halfway(self):
+        chunks = self.cache.store(self.ds1, iter([b"01234", b"56789"]), {})
+        next(chunks)
+        chunks.close()
+        self.assertIsNone(self.cache.get(self.ds1))
+
+    def test_payload_bigger_than_the_cache_is_passed_through_only(self):
+        self.assertEqual(b"x" * 2000, self.store(self.ds1, b"x" * 2000))
+        self.assertIsNone(self.cache.get(self.ds1))
+
+    def test_expired_payload_is_ignored(self):
+        self.store(self.ds1, b"0123456789")
+        self.cache.timeout = 0
+        self.assertIsNone(self.cache.get(self.ds1))
+
+    def test_payload_for_another_source_version_is_ignored(self):
+        self.store(self.ds1, b"0123456789")
+        self.ds1.url = "https://example.com/other.json"
+        self.assertIsNone(self.cache.get(self.ds1))
+
+    def test_least_recently_used_payload_is_evicted_first(self):
+        ds3 = Dataset.objects.create(account=self.u1.account, title="Third",
+                                     url="https://example.com/third.json")
+        self.store(self.ds1, b"1" * 400)
+        self.store(self.ds2, b"2" * 400)
+
+        # make both look old, then use ds1 so ds2 is the one to go
+        old = time.time() - 100
+        for name in os.listdir(self.cache_dir):
+            os.utime(os.path.join(self.cache_dir, name), (old, old))
+        self.cache.get(self.ds1)
+
+        self.store(ds3, b"3" * 400)
+        self.assertIsNotNone(self.cache.get(self.ds1))
+        self.assertIsNone(self.cache.get(self.ds2))
+        self.assertIsNotNone(self.cache.get(ds3))
+
+    def test_directory_is_only_gone_through_when_it_is_full(self):
+        self.store(self.ds1, b"1" * 400)
+        with mock.patch("os.listdir", wraps=os.listdir) as listdir:
+            self.store(self.ds2, b"2" * 400)
+            self.assertFalse(listdir.called)
+            self.store(self.ds1, b"3" * 700)
+            self.assertTrue(listdir.called)
+        self.assertIsNotNone(self.cache.get(self.ds1))
+        self.assertIsNone(self.cache.get(self.ds2))
+
+    def test_stale_payload_is_only_returned_when_asked_for(self):
+        self.store(self.ds1, b"0123456789")
+        self.cache.timeout = 0
+        self.assertFalse(self.cache.get(self.ds1, stale=True).fresh)
+
+    def test_revalidated_payload_is_fresh_again(self):
+        self.store(self.ds1, b"0123456789")
+        self.cache.timeout = 0.5
+        with mock.patch("time.time", return_value=time.time() + 1):
+            self.assertIsNone(self.cache.get(self.ds1))
+            self.cache.revalidated(self.ds1, etag='"v2"')
+            cached = self.cache.get(self.ds1)
+        self.assertEqual('"v2"', cached.meta["etag"])
+        self.assertEqual(b"0123456789", cached.read())
+
+    def test_invalidate_removes_the_payload(self):
+        self.store(self.ds1, b"0123456789")
+        self.cache.invalidate(self.ds1.pk)
+        self.assertIsNone(self.cache.get(self.ds1))
+
+    def test_source_version_changes_with_the_credentials(self):
+        version = source_version(self.ds1)
+        self.ds1.dataset_password = "something else"
+        self.assertNotEqual(version, source_version(self.ds1))
+
+
+class BackendPayloadCacheTests(TestCase):
+
+    def setUp(self):
+        self.cache = BackendPayloadCache("default", max_bytes=100, timeout=60)
+        self.addCleanup(self.cache.cache.clear)
+
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+
+        self.ds1 = Dataset.objects.create(
+            account=self.u1.account,
+            author="Google",
+            title="Google GeoJSON Example",
+            url="https://storage.googleapis.com/maps-devrel/google.json")
+
+    def test_stored_payload_can_be_read_back(self):
+        b"".join(self.cache.store(self.ds1, iter([b"01234", b"56789"]), {}))
+        self.assertEqual(b"0123456789", self.cache.get(self.ds1).read())
+
+    def test_payload_bigger_than_max_bytes_is_not_stored(self):
+        b"".join(self.cache.store(self.ds1, iter([b"x" * 200]), {}))
+        self.assertIsNone(self.cache.get(self.ds1))
+
+    def test_payload_for_another_source_version_is_ignored(self):
+        b"".join(self.cache.store(self.ds1, iter([b"0123456789"]), {}))
+        self.ds1.owncloud_path = "/somewhere/else.json"
+        self.assertIsNone(self.cache.get(self.ds1))
@@ -0,0 +1,54 @@
+from django.test import SimpleTestCase, override_settings
+
+from datasets.clusters import ClusterLevels, cluster_features
+
+from test.unit_tests.datasets.test_spatial import build_index, point
+
+
+@override_settings(DATASET_CLUSTER_RADIUS=40, DATASET_CLUSTER_MAX_ZOOM=16)
+class ClusterLevelsTests(SimpleTestCase):
+
+    def setUp(self):
+        # two points 100m apart in Bremen and one in Sydney
+        self.index = build_index([point(8.8, 53.1, name="Bremen 1"),
+                                  point(8.8015, 53.1, name="Bremen 2"),
+                                  point(151.2, -33.9, name="Sydney")])
+        self.levels = ClusterLevels(ClusterLevels.build(self.index))
+
+    def features(self, zoom, bbox=(-180, -90, 180, 90)):
+        return list(cluster_features(self.index, self.levels, zoom, bbox))
+
+    def test_close_points_are_one_cluster_when_zoomed_out(self):
+        features = self.features(2)
+        self.assertEqual(2, len(features))
+        cluster = features[0]
+        self.assertEqual({"cluster": True, "point_count": 2},
+                         cluster["properties"])
+        self.assertAlmostEqual(8.80075,
+                               cluster["geometry"]["coordinates"][0])
+        self.assertEqual("Sydney", features[1]["properties"]["name"])
+
+    def test_points_come_apart_when_zoomed_in(self):
+        names = [feature["properties"]["name"]
+                 for feature in self.features(16)]
+        self.assertEqual(["Bremen 1", "Bremen 2", "Sydney"], names)
+
+    def test_levels_above_the_last_merge_are_not_stored(self):
+        self.assertLess(self.levels.max_zoom, 16)
+        self.assertIsNone(self.levels.query(self.levels.max_zoom + 1,
+                                            [-180, -90, 180, 90]))
+
+    def test_only_clusters_in_the_bbox_come_back(self):
+        features = self.features(2, (100, -50, 180, 0))
+        self.assertEqual(["Sydney"], [feature["properties"]["name"]
+                                      for feature in features])
+
+    def test_only_points_are_clustered(self):
+        line = {"type": "Feature", "properties": {},
+                "geometry": {"type": "LineString",
+                             "coordinates": [[0, 0], [1, 1]]}}
+        index = build_index([line, point(0.5, 0.5)])
+        levels = ClusterLevels(ClusterLevels.build(index))
+        self.assertEqual(1, len(list(cluster_features(
+            index, levels, 20, [-180, -90, 180, 90]))))
+        self.assertEqual({}, levels.levels)
@@ -0,0 +1,58 @@
+from django.test import SimpleTestCase, override_settings
+
+from datasets import compress
+from datasets.compress import compressed_chunks, encoded_etag, negotiate
+
+from unittest import mock
+
+import gzip
+
+
+class NegotiateTests(SimpleTestCase):
+
+    def test_gzip(self):
+        self.assertEqual("gzip", negotiate("gzip, deflate"))
+
+    def test_nothing_we_can_do(self):
+        self.assertIsNone(negotiate("deflate"))
+        self.assertIsNone(negotiate(""))
+        self.assertIsNone(negotiate(None))
+
+    def test_refused_encoding(self):
+        self.assertIsNone(negotiate("gzip;q=0"))
+        self.assertIsNone(negotiate("*;q=0, deflate"))
+
+    def test_anything_goes(self):
+        self.assertEqual("gzip", negotiate("*"))
+
+    def test_brotli_is_preferred_when_there_is_brotli(self):
+        with mock.patch.object(compress, "brotli", mock.Mock()):
+            self.assertEqual("br", negotiate("gzip, br"))
+            self.assertEqual("gzip", negotiate("gzip, br;q=0.5"))
+        with mock.patch.object(compress, "brotli", None):
+            self.assertEqual("gzip", negotiate("gzip, br"))
+
+    @override_settings(DATASET_COMPRESS_MIN_BYTES=1024)
+    def test_small_files_are_left_alone(self):
+        self.assertIsNone(negotiate("gzip", 1023))
+        self.assertEqual("gzip", negotiate("gzip", 1024))
+        self.assertEqual("gzip", negotiate("gzip", None))
+
+    @override_settings(DATASET_COMPRESS=False)
+    def test_switched_off(self):
+        self.assertIsNone(negotiate("gzip"))
+
+
+class CompressedChunksTests(SimpleTestCase):
+
+    def test_gzip(self):
+        chunks = [b'{"type": "FeatureCollection", ', b'"features": []}'] * 50
+        compressed = b"".join(compressed_chunks(iter(chunks), "gzip"))
+        self.assertEqual(b"".join(chunks), gzip.decompress(compressed))
+        self.assertLess(len(compressed), len(b"".join(chunks)))
+
+    def test_encoded_etag(self):
+        self.assertEqual('"v1-gzip"', encoded_etag('"v1"', "gzip"))
+        self.assertEqual('W/"v1-br"', encoded_etag('W/"v1"', "br"))
+        self.assertEqual('"v1"', encoded_etag('"v1"', None))
+        self.assertIsNone(encoded_etag(None, "gzip"))
@@ -0,0 +1,170 @@
+from django.test import SimpleTestCase
+
+from datasets.convert import ConversionError
+from datasets.convert import delimited_features, geojson_features
+from datasets.convert import kml_features
+from datasets.convert import find_coordinate_columns, to_geojson
+
+import json
+
+
+def in_chunks(data, size=7):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+KML = b"""<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2">
+  <Document>
+    <Placemark>
+      <name>Bremen</name>
+      <ExtendedData>
+        <Data name="institute"><value>ZMT</value></Data>
+      </ExtendedData>
+      <Point><coordinates>8.8,53.1,0</coordinates></Point>
+    </Placemark>
+    <Placemark>
+      <name>Reef</name>
+      <Polygon>
+        <outerBoundaryIs><LinearRing><coordinates>
+          0,0 1,0 1,1 0,1 0,0
+        </coordinates></LinearRing></outerBoundaryIs>
+      </Polygon>
+    </Placemark>
+  </Document>
+</kml>
+"""
+
+
+class DelimitedConversionTests(SimpleTestCase):
+
+    def test_coordinate_columns_are_found_by_name(self):
+        self.assertEqual((2, 1), find_coordinate_columns(
+            ["name", "Longitude", "Latitude"]))
+        self.assertEqual((0, 1), find_coordinate_columns(["lat", "lng"]))
+        self.assertEqual((1, 0), find_coordinate_columns(["X", "Y"]))
+
+    def test_missing_coordinate_columns_raise_conversion_error(self):
+        with self.assertRaises(ConversionError):
+            find_coordinate_columns(["name", "depth"])
+
+    def test_csv_rows_become_point_features(self):
+        data = b"name,lat,lon\nBremen,53.1,8.8\n\"Reef, north\",-10.5,142.3\n"
+        features = list(delimited_features(in_chunks(data)))
+        self.assertEqual(2, len(features))
+        self.assertEqual([8.8, 53.1], features[0]["geometry"]["coordinates"])
+        self.assertEqual({"name": "Reef, north"}, features[1]["properties"])
+
+    def test_tab_delimiter_is_detected(self):
+        data = b"latitude\tlongitude\tdepth\n53.1\t8.8\t12\n"
+        features = list(delimited_features(in_chunks(data)))
+        self.assertEqual([8.8, 53.1], features[0]["geometry"]["coordinates"])
+        self.assertEqual({"depth": "12"}, features[0]["properties"])
+
+    def test_rows_without_coordinates_are_skipped(self):
+        data = b"lat,lon\n53.1,8.8\n,\nnot,numbers\n1,2"
+        self.assertEqual(2, len(list(delimited_features(in_chunks(data)))))
+
+    def test_projected_coordinates_are_not_degrees(self):
+        with self.assertRaises(ConversionError):
+            find_coordinate_columns(["name", "northing", "easting"])
+        data = b"x,y\n8.8,53.1\n487000,5885000\n8.8,nan\n"
+        features = list(delimited_features(in_chunks(data)))
+        self.assertEqual(1, len(features))
+
+    def test_only_newlines_end_a_row(self):
+        data = b"name,lat,lon\r\nform\x0cfeed,53.1,8.8\r\nline\xe2\x80\xa8" \
+               b"separator,-10.5,142.3\n"
+        features = list(delimited_features(in_chunks(data, size=3)))
+        self.assertEqual(["form\x0cfeed", "line\u2028separator"],
+                         [feature["properties"]["name"]
+                          for feature in features])
+
+    def test_multibyte_characters_split_over_chunks(self):
+        data = "name,lat,lon\nTropenökologie,53.1,8.8\n".encode("utf-8")
+        features = list(delimited_features(in_chunks(data, size=3)))
+        self.assertEqual("Tropenökologie", features[0]["properties"]["name"])
+
+
+class KmlConversionTests(SimpleTestCase):
+
+    def test_placemarks_become_features(self):
+        features = list(kml_features(in_chunks(KML)))
+        self.assertEqual(2, len(features))
+        self.assertEqual({"name": "Bremen", "institute": "ZMT"},
+                         features[0]["properties"])
+        self.assertEqual({"type": "Point", "coordinates": [8.8, 53.1, 0.0]},
+                         features[0]["geometry"])
+        self.assertEqual("Polygon", features[1]["geometry"]["type"])
+        self.assertEqual(5, len(features[1]["geometry"]["coordinates"][0]))
+
+    def test_broken_kml_raises_conversion_error(self):
+        with self.assertRaises(ConversionError):
+            list(kml_features([b"<kml><Placemark>"]))
+
+
+class GeojsonFeaturesTests(SimpleTestCase):
+
+    def collection(self, count):
+        return {"type": "FeatureCollection", "features": [
+            {"type": "Feature", "properties": {"name": "station {}".format(i),
+                                               "depth": 12.25 * i},
+             "geometry": {"type": "Point", "coordinates": [8.8, 53.1]}}
+            for i in range(count)]}
+
+    def test_features_split_over_chunks(self):
+        data = self.collection(20)
+        encoded = json.dumps(data).encode("utf-8")
+        for size in (1, 7, 1000):
+            self.assertEqual(data["features"], list(
+                geojson_features(in_chunks(encoded, size))))
+
+    def test_features_come_out_before_the_file_is_read(self):
+        encoded = json.dumps(self.collection(100)).encode("utf-8")
+
+        def chunks():
+            yield encoded[:200]
+            raise AssertionError("read too far")
+
+        first = next(geojson_features(chunks()))
+        self.assertEqual("station 0", first["properties"]["name"])
+
+    def test_members_after_the_features(self):
+        encoded = (b'\xef\xbb\xbf{"features": [], "bbox": [1, 2, 3, 4], '
+                   b'"type": "FeatureCollection"}')
+        self.assertEqual([], list(geojson_features(in_chunks(encoded))))
+
+    def test_feature_and_geometry_files(self):
+        feature = {"type": "Feature", "properties": {"a": 1},
+                   "geometry": {"type": "Point", "coordinates": [1, 2]}}
+        self.assertEqual([feature], list(geojson_features(
+            [json.dumps(feature).encode("utf-8")])))
+        self.assertEqual([{"type": "Feature", "properties": {},
+                           "geometry": feature["geometry"]}],
+                         list(geojson_features(in_chunks(json.dumps(
+                             feature["geometry"]).encode("utf-8")))))
+
+    def test_broken_geojson_raises_conversion_error(self):
+        for broken in (b'[1, 2]', b'{"type": "FeatureCollection", '
+                       b'"features": [{"type": ', b'{"a": 1} {"b": 2}',
+                       b'{"features": [{}, ]}', b'\xff\xfe'):
+            with self.assertRaises(ConversionError):
+                list(geojson_features(in_chunks(broken)))
+
+
+class ToGeojsonTests(SimpleTestCase):
+
+    def test_output_is_a_feature_collection(self):
+        data = b"lat,lon\n" + b"53.1,8.8\n" * 100
+        output = b"".join(to_geojson("csv", in_chunks(data), chunk_size=50))
+        collection = json.loads(output.decode("utf-8"))
+        self.assertEqual("FeatureCollection", collection["type"])
+        self.assertEqual(100, len(collection["features"]))
+
+    def test_output_comes_in_chunks(self):
+        data = b"lat,lon\n" + b"53.1,8.8\n" * 100
+        chunks = list(to_geojson("csv", in_chunks(data), chunk_size=500))
+        self.assertGreater(len(chunks), 1)
+
+    def test_empty_file_is_an_empty_feature_collection(self):
+        output = b"".join(to_geojson("csv", []))
+        self.assertEqual([], json.loads(output.decode("utf-8"))["features"])
@@ -0,0 +1,70 @@
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.template import Context, Template
+from django.test import TestCase, override_settings
+
+from datasets.models import Dataset
+from datasets.templatetags.dataset_list import item_key
+
+from unittest import mock
+
+User = get_user_model()
+
+TEMPLATE = Template("{% load dataset_list %}{% dataset_items datasets %}")
+
+
+class DatasetItemsTests(TestCase):
+
+    def setUp(self):
+        caches["default"].clear()
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+        self.ds1 = Dataset.objects.create(
+            account=self.u1.account,
+            author="zmtdummy",
+            title="Harbours",
+            url="https://example.com/harbours.geojson")
+        self.ds2 = Dataset.objects.create(
+            account=self.u1.account,
+            author="zmtdummy",
+            title="Secret",
+            url="https://example.com/secret.geojson",
+            dataset_user="zmtdummy",
+            dataset_password="zmtBremen1991")
+
+    def render(self):
+        datasets = list(Dataset.objects.select_related(
+            "account__user").order_by("pk"))
+        with self.assertNumQueries(0):
+            return TEMPLATE.render(Context({"datasets": datasets}))
+
+    def test_items(self):
+        html = self.render()
+        self.assertIn('url="https://example.com/harbours.geojson"', html)
+        self.assertNotIn("secret.geojson", html)
+        self.assertIn('href="/test_user/secret/"', html)
+        self.assertLess(html.index("Harbours"), html.index("Secret"))
+
+    @override_settings(DATASET_LIST_CACHE="default")
+    def test_cached_items_are_the_same(self):
+        with override_settings(DATASET_LIST_CACHE=None):
+            uncached = self.render()
+        self.assertEqual(uncached, self.render())
+        self.assertEqual(uncached, self.render())
+
+    @override_settings(DATASET_LIST_CACHE="default")
+    def test_cached_items_are_not_rendered_again(self):
+        self.render()
+        with mock.patch("django.template.backends.django.Template.render") as render:
+            html = self.render()
+        render.assert_not_called()
+        self.assertIn("Harbours", html)
+
+    @override_settings(DATASET_LIST_CACHE="default")
+    def test_changed_dataset_gets_a_new_item(self):
+        self.render()
+        key = item_key(self.ds1)
+        self.ds1.url = "https://example.com/ports.geojson"
+        self.ds1.save()
+        self.assertNotEqual(key, item_key(self.ds1))
+        self.assertIn("ports.geojson", self.render())
@@ -0,0 +1,117 @@
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase
+
+from datasets.fulltext import SQLITE_TABLE, enabled, search
+from datasets.models import Dataset
+
+from keywords.models import Keyword
+
+User = get_user_model()
+
+
+class FullTextSearchTests(TestCase):
+
+    def setUp(self):
+        self.u1 = User.objects.create_user(
+            username="zmt_bremen", password="test_password")
+
+        self.ds1 = Dataset.objects.create(
+            account=self.u1.account,
+            author="Pat",
+            title="Mangroves of Java",
+            description="Mangrove forest cover along the coast",
+            url="https://example.com/mangroves.geojson")
+        self.ds2 = Dataset.objects.create(
+            account=self.u1.account,
+            author="Google",
+            title="Coral reefs",
+            description="Reefs, with a note on mangroves nearby",
+            url="https://example.com/reefs.geojson")
+
+        self.k1 = Keyword.objects.create(keyword="Ökologie")
+
+    def found(self, q):
+        return [dataset.title for dataset in search(Dataset.objects.all(), q)]
+
+    def test_index_is_there_on_sqlite(self):
+        self.assertTrue(enabled())
+
+    def test_index_is_only_looked_up_once(self):
+        enabled()
+        with self.assertNumQueries(0):
+            self.assertTrue(enabled())
+            self.assertTrue(enabled(connection))
+
+    def test_title_matches_rank_above_description_matches(self):
+        self.assertEqual(["Mangroves of Java", "Coral reefs"],
+                         self.found("mangroves"))
+
+    def test_words_match_prefixes(self):
+        self.assertEqual(["Coral reefs"], self.found("cor ree"))
+
+    def test_every_word_has_to_match(self):
+        self.assertEqual([], self.found("java google"))
+        self.assertEqual(["Coral reefs"], self.found("mangroves google"))
+
+    def test_description_is_searched(self):
+        self.assertEqual(["Mangroves of Java"], self.found("forest"))
+
+    def test_account_is_searched(self):
+        self.assertEqual(2, len(self.found("zmt_bremen")))
+
+    def test_punctuation_is_ignored(self):
+        self.assertEqual(["Coral reefs"], self.found('"coral" -*'))
+
+    def test_no_words_lists_everything(self):
+        self.assertEqual(["Coral reefs", "Mangroves of Java"],
+                         self.found(" "))
+
+    def test_ranking_and_paging_are_done_in_one_query(self):
+        found = search(Dataset.objects.all(), "mangroves")
+        with self.assertNumQueries(1):
+            page = list(found[1:2])
+        self.assertEqual([self.ds2], page)
+
+    def test_other_filters_still_apply(self):
+        found = search(Dataset.objects.filter(author="Google"), "mangroves")
+        self.assertEqual([self.ds2], list(found))
+
+    def test_updated_dataset_is_reindexed(self):
+        self.ds2.title = "Seagrass"
+        self.ds2.save()
+        self.assertEqual(["Seagrass"], self.found("seagrass"))
+        self.assertEqual([], self.found("coral"))
+
+    def test_deleted_dataset_is_gone_from_the_index(self):
+        pk = self.ds1.pk
+        self.ds1.delete()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT rowid FROM {} WHERE rowid = %s"
+                           .format(SQLITE_TABLE), [pk])
+            self.assertIsNone(cursor.fetchone())
+
+    def test_added_and_removed_keywords_are_indexed(self):
+        self.ds1.keywords.add(self.k1)
+        self.assertEqual(["Mangroves of Java"], self.found("okologie"))
+        self.ds1.keywords.remove(self.k1)
+        self.assertEqual([], self.found("okologie"))
+
+    def test_keywords_added_from_the_other_side_are_indexed(self):
+        self.k1.datasets.add(self.ds2)
+        self.assertEqual(["Coral reefs"], self.found("ökologie"))
+        self.k1.datasets.clear()
+        self.assertEqual([], self.found("ökologie"))
+
+    def test_renamed_and_deleted_keywords_are_reindexed(self):
+        self.ds1.keywords.add(self.k1)
+        self.k1.keyword = "Biologie"
+        self.k1.save()
+        self.assertEqual(["Mangroves of Java"], self.found("biologie"))
+        self.k1.delete()
+        self.assertEqual([], self.found("biologie"))
+
+    def test_renamed_user_is_reindexed(self):
+        self.u1.username = "leibniz"
+        self.u1.save()
+        self.assertEqual(2, len(self.found("leibniz")))
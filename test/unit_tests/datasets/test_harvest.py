@@ -0,0 +1,133 @@
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+
+from datasets.harvest import harvest, harvest_dataset, summarise
+from datasets.models import Dataset
+from datasets.refresh import refresh_all
+
+from test.unit_tests.main.test_views import GEOJSON
+from test.unit_tests.main.test_views import TemporaryPayloadCacheMixin
+from test.unit_tests.main.test_views import fake_upstream
+
+from unittest import mock
+
+import hashlib
+import io
+import json
+
+User = get_user_model()
+
+
+COLLECTION = json.dumps({"type": "FeatureCollection", "features": [
+    {"type": "Feature", "properties": {"name": "Bremen", "size": 3},
+     "geometry": {"type": "Point", "coordinates": [8.8, 53.1]}},
+    {"type": "Feature", "properties": {"name": None, "size": "big"},
+     "geometry": {"type": "LineString",
+                  "coordinates": [[-1.5, 40.0], [10.0, 54.5]]}},
+    {"type": "Feature", "properties": {"open": True}, "geometry": None},
+]}).encode("utf-8")
+
+
+class SummariseTests(SimpleTestCase):
+
+    def test_geojson_file(self):
+        fields = summarise("geojson", iter([COLLECTION[:50],
+                                            COLLECTION[50:]])).fields()
+        self.assertEqual(3, fields["feature_count"])
+        self.assertEqual([-1.5, 40.0, 10.0, 54.5],
+                         [fields["bbox_west"], fields["bbox_south"],
+                          fields["bbox_east"], fields["bbox_north"]])
+        self.assertEqual("LineString,Point", fields["geometry_types"])
+        self.assertEqual({"name": ["null", "string"],
+                          "size": ["number", "string"],
+                          "open": ["boolean"]}, fields["property_schema"])
+        self.assertEqual(len(COLLECTION), fields["byte_size"])
+        self.assertEqual(hashlib.sha1(COLLECTION).hexdigest(),
+                         fields["content_sha1"])
+
+    def test_csv_file(self):
+        body = b"name,lat,lon\nBremen,53.1,8.8\nHamburg,53.55,9.99\n"
+        fields = summarise("csv", iter([body])).fields()
+        self.assertEqual(2, fields["feature_count"])
+        self.assertEqual("Point", fields["geometry_types"])
+        self.assertEqual([8.8, 53.1, 9.99, 53.55],
+                         [fields["bbox_west"], fields["bbox_south"],
+                          fields["bbox_east"], fields["bbox_north"]])
+
+    def test_file_without_features_has_no_bbox(self):
+        fields = summarise("geojson", iter(
+            [b'{"type": "FeatureCollection", "features": []}'])).fields()
+        self.assertEqual(0, fields["feature_count"])
+        self.assertIsNone(fields["bbox_west"])
+
+
+class HarvestTests(TemporaryPayloadCacheMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+        self.ds1 = Dataset.objects.create(
+            account=self.u1.account, title="Harbours",
+            url="https://example.com/harbours.geojson")
+
+    def upstream(self, *responses):
+        return mock.patch("requests.Session.request", side_effect=responses)
+
+    def test_fields_are_filled_in(self):
+        with self.upstream(fake_upstream(COLLECTION)):
+            harvest_dataset(self.ds1.pk)
+        self.ds1.refresh_from_db()
+        self.assertEqual(3, self.ds1.feature_count)
+        self.assertEqual(10.0, self.ds1.bbox_east)
+        self.assertEqual(len(COLLECTION), self.ds1.byte_size)
+        self.assertEqual(hashlib.sha1(COLLECTION).hexdigest(),
+                         self.ds1.content_sha1)
+        self.assertIsNotNone(self.ds1.harvested_at)
+        self.assertEqual("", self.ds1.harvest_error)
+
+    def test_unchanged_file_is_not_harvested_again(self):
+        with self.upstream(fake_upstream(COLLECTION)):
+            self.assertTrue(harvest(self.ds1))
+            self.assertFalse(harvest(self.ds1))
+            self.assertTrue(harvest(self.ds1, force=True))
+
+    def test_broken_file_is_recorded(self):
+        with self.upstream(fake_upstream(b"{not json")):
+            harvest(self.ds1)
+        self.ds1.refresh_from_db()
+        self.assertIsNone(self.ds1.feature_count)
+        self.assertIn("could not read the geojson file",
+                      self.ds1.harvest_error)
+
+    def test_upstream_error_is_recorded(self):
+        with self.upstream(fake_upstream(b"", 404)):
+            self.assertFalse(harvest(self.ds1))
+        self.ds1.refresh_from_db()
+        self.assertEqual("upstream answered 404", self.ds1.harvest_error)
+
+    def test_saving_the_dataset_starts_the_harvest(self):
+        self.ds1.url = "https://example.com/moved.geojson"
+        with mock.patch("datasets.models.run_in_background") as run:
+            self.ds1.save()
+        run.assert_any_call(harvest_dataset, self.ds1.pk)
+
+    def test_harvesting_doesnt_invalidate_the_cache(self):
+        with self.upstream(fake_upstream(COLLECTION)) as request:
+            harvest(self.ds1)
+            harvest(self.ds1, force=True)
+        self.assertEqual(1, request.call_count)
+
+    def test_changed_files_are_harvested_by_refresh(self):
+        with self.upstream(fake_upstream(GEOJSON)):
+            refresh_all(workers=1)
+        self.ds1.refresh_from_db()
+        self.assertEqual(1, self.ds1.feature_count)
+
+    def test_command_only_harvests_new_datasets(self):
+        out = io.StringIO()
+        with self.upstream(fake_upstream(COLLECTION)):
+            call_command("harvest_datasets", stdout=out)
+            call_command("harvest_datasets", stdout=out)
+        self.assertEqual("1 harvested\n0 harvested\n", out.getvalue())
@@ -162,4 +162,14 @@ class DatasetModelTests(TestCase):
         decrypted_user = cipher_end.decrypt(bytes_user).decode("utf-8")
         self.assertEqual(decrypted_user, "zmtdummy")
 
+    def test_that_saving_again_does_not_encrypt_the_password_twice(self):
+        dataset = Dataset.objects.get(
+            dataset_slug="password-protected-dataset")
+        stored = dataset.dataset_password
+        dataset.save()
+        self.assertEqual(stored, dataset.dataset_password)
 
+        bytes_password = dataset.dataset_password.encode("utf-8")
+        cipher_end = Fernet(os.environ.get("CRYPTO_KEY"))
+        decrypted_password = cipher_end.decrypt(bytes_password).decode("utf-8")
+        self.assertEqual(decrypted_password, "zmtBremen1991")
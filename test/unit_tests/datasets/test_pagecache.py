@@ -0,0 +1,164 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from datasets.checks import check_page_cache
+from datasets.models import Dataset
+from datasets.pagecache import CATALOGUE, bump
+
+from keywords.models import Keyword
+
+User = get_user_model()
+
+
+@override_settings(PAGE_CACHE="default")
+class PageCacheTests(TestCase):
+
+    def setUp(self):
+        caches["default"].clear()
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+        self.u2 = User.objects.create_user(
+            username="other_user", password="test_password")
+
+        self.ds1 = Dataset.objects.create(
+            account=self.u1.account,
+            author="zmtdummy",
+            title="Harbours",
+            url="https://example.com/harbours.geojson")
+        self.ds2 = Dataset.objects.create(
+            account=self.u2.account,
+            author="zmtdummy",
+            title="Reefs",
+            url="https://example.com/reefs.geojson")
+
+        self.k1 = Keyword.objects.create(keyword="coast")
+        self.ds1.keywords.add(self.k1)
+
+        self.embed = reverse("datasets:embed_dataset", kwargs={
+            "account_slug": "test_user", "dataset_slug": "harbours"})
+        self.detail = reverse("datasets:dataset_detail", kwargs={
+            "account_slug": "test_user", "dataset_slug": "harbours"})
+
+    def test_anonymous_embed_comes_from_the_cache(self):
+        first = self.client.get(self.embed)
+        with self.assertNumQueries(0):
+            second = self.client.get(self.embed)
+        self.assertEqual("miss", first["X-Page-Cache"])
+        self.assertEqual("hit", second["X-Page-Cache"])
+        self.assertEqual(first.content, second.content)
+        self.assertEqual("*", second["Access-Control-Allow-Origin"])
+        self.assertEqual(first["Content-Type"], second["Content-Type"])
+
+    def test_saving_the_dataset_bumps_its_pages(self):
+        self.client.get(self.detail)
+        self.ds1.author = "somebody else"
+        self.ds1.save()
+        response = self.client.get(self.detail)
+        self.assertEqual("miss", response["X-Page-Cache"])
+        self.assertContains(response, "somebody else")
+
+    def test_other_accounts_datasets_leave_the_page_alone(self):
+        self.client.get(self.embed)
+        self.ds2.author = "somebody else"
+        self.ds2.save()
+        self.assertEqual("hit", self.client.get(self.embed)["X-Page-Cache"])
+
+    def test_keywords_bump_the_dataset_pages(self):
+        self.client.get(self.detail)
+        self.k1.keyword = "shore"
+        self.k1.save()
+        response = self.client.get(self.detail)
+        self.assertEqual("miss", response["X-Page-Cache"])
+        self.assertContains(response, "shore")
+
+        k2 = Keyword.objects.create(keyword="lagoon")
+        k2.datasets.add(self.ds1)
+        self.assertContains(self.client.get(self.detail), "lagoon")
+
+        self.k1.delete()
+        self.assertNotContains(self.client.get(self.detail), "shore")
+
+    def test_owner_gets_their_own_copy(self):
+        self.client.get(self.detail)
+        self.client.login(username="test_user", password="test_password")
+        response = self.client.get(self.detail)
+        self.assertEqual("miss", response["X-Page-Cache"])
+        update = reverse("datasets:dataset_update", kwargs={
+            "account_slug": "test_user", "dataset_slug": "harbours"})
+        self.assertContains(response, update)
+        self.client.logout()
+        self.assertNotContains(self.client.get(self.detail), update)
+
+    def test_logging_in_bumps_nothing(self):
+        self.client.get(self.detail)
+        self.client.login(username="test_user", password="test_password")
+        self.client.logout()
+        self.assertEqual("hit", self.client.get(self.detail)["X-Page-Cache"])
+
+    def test_renamed_user_pages_are_gone(self):
+        self.client.get(self.embed)
+        self.u1.username = "renamed_user"
+        self.u1.save()
+        self.assertEqual(404, self.client.get(self.embed).status_code)
+
+    def test_new_datasets_show_up_on_the_portal(self):
+        self.client.get(reverse("portal"))
+        Dataset.objects.create(account=self.u2.account, author="zmtdummy",
+                               title="Mangroves",
+                               url="https://example.com/mangroves.geojson")
+        response = self.client.get(reverse("portal"))
+        self.assertEqual("miss", response["X-Page-Cache"])
+        self.assertContains(response, "Mangroves")
+
+    def test_keyword_page_follows_its_datasets(self):
+        url = reverse("keywords:keyword_detail",
+                      kwargs={"keyword_slug": self.k1.keyword_slug})
+        self.assertContains(self.client.get(url), "Harbours")
+        self.ds1.keywords.remove(self.k1)
+        self.assertNotContains(self.client.get(url), "Harbours")
+
+    def test_query_strings_are_kept_apart(self):
+        self.client.get(reverse("portal"))
+        response = self.client.get(reverse("portal"), {"q": "reefs"})
+        self.assertEqual("miss", response["X-Page-Cache"])
+
+    def test_missing_pages_are_not_cached(self):
+        url = reverse("datasets:embed_dataset", kwargs={
+            "account_slug": "test_user", "dataset_slug": "nothing"})
+        self.client.get(url)
+        response = self.client.get(url)
+        self.assertEqual(404, response.status_code)
+        self.assertNotIn("X-Page-Cache", response)
+
+    def test_bump(self):
+        self.client.get(reverse("portal"))
+        bump(CATALOGUE)
+        self.assertEqual("miss",
+                         self.client.get(reverse("portal"))["X-Page-Cache"])
+
+    @override_settings(PAGE_CACHE=None)
+    def test_switched_off(self):
+        self.client.get(self.embed)
+        self.assertNotIn("X-Page-Cache", self.client.get(self.embed))
+
+
+class PageCacheCheckTests(SimpleTestCase):
+
+    def test_off_by_default(self):
+        self.assertIsNone(settings.PAGE_CACHE)
+        self.assertEqual([], check_page_cache(None))
+
+    @override_settings(PAGE_CACHE="default")
+    def test_locmem_is_refused(self):
+        errors = check_page_cache(None)
+        self.assertEqual(["datasets.E001"], [error.id for error in errors])
+
+    @override_settings(PAGE_CACHE="shared", CACHES={
+        "shared": {"BACKEND":
+                   "django.core.cache.backends.filebased.FileBasedCache",
+                   "LOCATION": "/tmp/page-cache-check"}})
+    def test_shared_cache_is_fine(self):
+        self.assertEqual([], check_page_cache(None))
@@ -0,0 +1,204 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase
+
+from datasets.access import flush, forget, record_access
+from datasets.cache import payload_cache
+from datasets.models import Dataset
+from datasets.refresh import CHANGED, FAILED, REVALIDATED, SKIPPED
+from datasets.refresh import HostLimits, dataset_host, refresh_all
+
+from test.unit_tests.main.test_views import GEOJSON
+from test.unit_tests.main.test_views import TemporaryPayloadCacheMixin
+from test.unit_tests.main.test_views import fake_upstream
+
+from unittest import mock
+
+import io
+import requests
+import threading
+import time
+
+User = get_user_model()
+
+
+class AccessCountTests(TestCase):
+
+    def setUp(self):
+        forget()
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+        self.ds1 = Dataset.objects.create(
+            account=self.u1.account, title="Harbours",
+            url="https://example.com/harbours.geojson")
+
+    def test_accesses_are_buffered_until_the_interval_is_up(self):
+        with self.settings(DATASET_ACCESS_FLUSH_INTERVAL=60):
+            record_access(self.ds1.pk)
+            record_access(self.ds1.pk)
+        self.ds1.refresh_from_db()
+        self.assertEqual(0, self.ds1.access_count)
+
+        flush()
+        self.ds1.refresh_from_db()
+        self.assertEqual(2, self.ds1.access_count)
+        self.assertIsNotNone(self.ds1.last_accessed)
+
+    def test_accesses_are_written_once_the_interval_is_up(self):
+        with self.settings(DATASET_ACCESS_FLUSH_INTERVAL=0):
+            record_access(self.ds1.pk)
+        self.ds1.refresh_from_db()
+        self.assertEqual(1, self.ds1.access_count)
+
+    def test_loading_a_dataset_counts_as_an_access(self):
+        with self.settings(DATASET_ACCESS_FLUSH_INTERVAL=0), \
+                mock.patch("requests.Session.request",
+                           return_value=fake_upstream(GEOJSON)):
+            self.client.get("/load_dataset/{}/".format(self.ds1.pk))
+        self.ds1.refresh_from_db()
+        self.assertEqual(1, self.ds1.access_count)
+
+
+class HostLimitsTests(TestCase):
+
+    def test_downloads_from_the_same_host_are_spaced_out(self):
+        limits = HostLimits(per_host=1, interval=0.2)
+        started = time.time()
+        for i in range(3):
+            with limits.slot("example.com"):
+                pass
+        self.assertGreaterEqual(time.time() - started, 0.4)
+
+    def test_other_hosts_dont_wait(self):
+        limits = HostLimits(per_host=1, interval=10)
+        started = time.time()
+        with limits.slot("example.com"):
+            with limits.slot("example.org"):
+                pass
+        self.assertLess(time.time() - started, 1)
+
+    def test_no_more_than_per_host_at_a_time(self):
+        limits = HostLimits(per_host=2, interval=0)
+        running = []
+        most = []
+        lock = threading.Lock()
+
+        def download():
+            with limits.slot("example.com"):
+                with lock:
+                    running.append(1)
+                    most.append(len(running))
+                time.sleep(0.05)
+                with lock:
+                    running.pop()
+
+        threads = [threading.Thread(target=download) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(2, max(most))
+
+    def test_host_of_an_owncloud_dataset_is_the_instance(self):
+        dataset = Dataset(owncloud=True,
+                          owncloud_instance="https://cloud.example.com",
+                          owncloud_path="data/harbours.geojson")
+        self.assertEqual("cloud.example.com", dataset_host(dataset))
+
+
+class RefreshDatasetsTests(TemporaryPayloadCacheMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+        self.ds1 = Dataset.objects.create(
+            account=self.u1.account, title="Harbours",
+            url="https://example.com/harbours.geojson")
+        self.ds2 = Dataset.objects.create(
+            account=self.u1.account, title="Rivers",
+            url="https://example.org/rivers.geojson")
+
+        limits = self.settings(DATASET_REFRESH_HOST_INTERVAL=0)
+        limits.enable()
+        self.addCleanup(limits.disable)
+
+    def upstream(self, *responses):
+        return mock.patch("requests.Session.request", side_effect=responses)
+
+    def test_missing_files_are_downloaded(self):
+        with self.upstream(fake_upstream(GEOJSON), fake_upstream(GEOJSON)):
+            results = refresh_all(workers=1)
+        self.assertEqual({self.ds1.pk: CHANGED, self.ds2.pk: CHANGED},
+                         results)
+        self.assertEqual(GEOJSON, payload_cache().get(self.ds2).read())
+
+    def test_fresh_copies_are_skipped(self):
+        with self.upstream(fake_upstream(GEOJSON), fake_upstream(GEOJSON)):
+            refresh_all(workers=1)
+        with self.upstream() as request:
+            results = refresh_all(workers=1, ahead=0)
+        self.assertEqual({SKIPPED}, set(results.values()))
+        self.assertFalse(request.called)
+
+    def test_copies_going_stale_soon_are_revalidated(self):
+        with self.upstream(fake_upstream(GEOJSON, headers={"ETag": '"v1"'}),
+                           fake_upstream(GEOJSON, headers={"ETag": '"v1"'})):
+            refresh_all(workers=1)
+        with self.upstream(fake_upstream(b"", 304), fake_upstream(b"", 304)) \
+                as request:
+            results = refresh_all(
+                workers=1, ahead=settings.DATASET_CACHE_TIMEOUT + 1)
+        self.assertEqual({REVALIDATED}, set(results.values()))
+        self.assertEqual('"v1"', request.call_args[1]["headers"]
+                         ["If-None-Match"])
+
+    def test_upstream_errors_keep_the_old_copy(self):
+        with self.upstream(fake_upstream(GEOJSON), fake_upstream(GEOJSON)):
+            refresh_all(workers=1)
+        with self.settings(DATASET_CACHE_TIMEOUT=0), \
+                self.upstream(fake_upstream(b"", 503),
+                              requests.ConnectionError("down")):
+            results = refresh_all(workers=1)
+        self.assertEqual({FAILED}, set(results.values()))
+        self.assertEqual(GEOJSON,
+                         payload_cache().get(self.ds1, stale=True).read())
+
+    def test_one_broken_dataset_doesnt_stop_the_pass(self):
+        with self.upstream(ValueError("broken"), fake_upstream(GEOJSON)), \
+                self.assertLogs("datasets.refresh", "ERROR"):
+            results = refresh_all(workers=1)
+        self.assertEqual([CHANGED, FAILED], sorted(results.values()))
+
+    def test_failed_harvest_doesnt_stop_the_pass(self):
+        with self.upstream(fake_upstream(GEOJSON), fake_upstream(GEOJSON)), \
+                mock.patch("datasets.refresh.harvest",
+                           side_effect=ValueError("broken")) as harvest, \
+                self.assertLogs("datasets.refresh", "ERROR"):
+            results = refresh_all(workers=1)
+        self.assertEqual({CHANGED}, set(results.values()))
+        self.assertEqual(2, harvest.call_count)
+
+    def test_most_loaded_datasets_go_first(self):
+        Dataset.objects.filter(pk=self.ds2.pk).update(access_count=10)
+        with self.upstream(fake_upstream(GEOJSON), fake_upstream(GEOJSON)) \
+                as request:
+            refresh_all(workers=1)
+        self.assertEqual(self.ds2.url, request.call_args_list[0][0][1])
+
+    def test_command_reports_and_halves_the_access_counts(self):
+        Dataset.objects.filter(pk=self.ds1.pk).update(access_count=10)
+        out = io.StringIO()
+        with self.upstream(fake_upstream(GEOJSON), fake_upstream(GEOJSON)):
+            call_command("refresh_datasets", workers=1, stdout=out)
+        self.assertEqual("2 changed", out.getvalue().strip())
+        self.ds1.refresh_from_db()
+        self.assertEqual(5, self.ds1.access_count)
+
+    def test_command_limit(self):
+        out = io.StringIO()
+        with self.upstream(fake_upstream(GEOJSON)):
+            call_command("refresh_datasets", limit=1, no_decay=True,
+                         stdout=out)
+        self.assertEqual("1 changed", out.getvalue().strip())
@@ -0,0 +1,90 @@
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+
+from datasets.models import Dataset
+from datasets.search import in_extent, overlap, rank_by_overlap
+
+User = get_user_model()
+
+
+class OverlapTests(TestCase):
+
+    def setUp(self):
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+
+    def extent(self, west, south, east, north, title="extent"):
+        dataset = Dataset.objects.create(
+            account=self.u1.account, title=title,
+            url="https://example.com/{}.geojson".format(title))
+        Dataset.objects.filter(pk=dataset.pk).update(
+            bbox_west=west, bbox_south=south,
+            bbox_east=east, bbox_north=north)
+        return dataset
+
+    def overlap(self, dataset, bbox):
+        return Dataset.objects.annotate(found=overlap(bbox)).get(
+            pk=dataset.pk).found
+
+    def test_same_bbox_is_a_full_overlap(self):
+        self.assertAlmostEqual(1.0, self.overlap(self.extent(0, 0, 10, 10),
+                                                 [0, 0, 10, 10]))
+
+    def test_half_overlap(self):
+        self.assertAlmostEqual(1 / 3.0, self.overlap(
+            self.extent(0, 0, 10, 10), [5, 0, 15, 10]))
+
+    def test_disjoint_bboxes_dont_overlap(self):
+        self.assertEqual(0.0, self.overlap(self.extent(0, 0, 1, 1),
+                                           [5, 5, 6, 6]))
+
+    def test_a_point_in_view_overlaps_a_little(self):
+        self.assertGreater(self.overlap(self.extent(1, 1, 1, 1),
+                                        [0, 0, 2, 2]), 0)
+
+    def test_regional_dataset_comes_before_the_whole_world(self):
+        world = self.extent(-180, -90, 180, 90, "world")
+        bremen = self.extent(8, 52, 10, 54, "bremen")
+        self.assertEqual([bremen, world], list(rank_by_overlap(
+            Dataset.objects.all(), [7, 51, 11, 55])))
+
+    def test_the_old_order_decides_between_equals(self):
+        b = self.extent(0, 0, 10, 10, "b")
+        a = self.extent(0, 0, 10, 10, "a")
+        ranked = rank_by_overlap(Dataset.objects.order_by("title"),
+                                 [0, 0, 10, 10])
+        self.assertEqual([a, b], list(ranked))
+        with self.assertNumQueries(1):
+            self.assertEqual([b], list(ranked.all()[1:2]))
+
+
+class InExtentTests(TestCase):
+
+    def setUp(self):
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+
+    def dataset(self, title, bbox):
+        dataset = Dataset.objects.create(
+            account=self.u1.account, title=title,
+            url="https://example.com/{}.geojson".format(title))
+        if bbox is not None:
+            Dataset.objects.filter(pk=dataset.pk).update(
+                bbox_west=bbox[0], bbox_south=bbox[1],
+                bbox_east=bbox[2], bbox_north=bbox[3])
+        return dataset
+
+    def titles(self, bbox):
+        return sorted(dataset.title for dataset in
+                      in_extent(Dataset.objects.all(), bbox))
+
+    def test_only_intersecting_datasets_are_found(self):
+        self.dataset("bremen", [8, 52, 10, 54])
+        self.dataset("sydney", [150, -34, 152, -33])
+        self.dataset("world", [-180, -90, 180, 90])
+        self.dataset("unharvested", None)
+        self.assertEqual(["bremen", "world"], self.titles([9, 53, 20, 60]))
+
+    def test_touching_bboxes_intersect(self):
+        self.dataset("bremen", [8, 52, 10, 54])
+        self.assertEqual(["bremen"], self.titles([10, 54, 11, 55]))
@@ -0,0 +1,81 @@
+from django.test import SimpleTestCase, override_settings
+
+from datasets.simplify import douglas_peucker, level_for, simplify_features
+from datasets.simplify import simplify_geometry, zoom_tolerance
+
+
+def feature(geometry):
+    return {"type": "Feature", "properties": {}, "geometry": geometry}
+
+
+class DouglasPeuckerTests(SimpleTestCase):
+
+    def test_straight_line_keeps_its_ends(self):
+        line = [[0, 0], [1, 0.001], [2, -0.001], [3, 0]]
+        self.assertEqual([[0, 0], [3, 0]], douglas_peucker(line, 0.01))
+
+    def test_corners_bigger_than_the_tolerance_stay(self):
+        line = [[0, 0], [1, 1], [2, 0], [3, 0.001], [4, 0]]
+        self.assertEqual([[0, 0], [1, 1], [2, 0], [4, 0]],
+                         douglas_peucker(line, 0.01))
+
+    def test_short_lines_are_left_alone(self):
+        self.assertEqual([[0, 0], [1, 1]],
+                         douglas_peucker([[0, 0], [1, 1]], 10))
+
+    def test_long_lines_dont_hit_the_recursion_limit(self):
+        line = [[i / 10.0, (i % 2) / 10.0] for i in range(1500)]
+        self.assertEqual(1500, len(douglas_peucker(line, 0.01)))
+
+
+class SimplifyGeometryTests(SimpleTestCase):
+
+    def test_points_are_not_touched(self):
+        point = {"type": "Point", "coordinates": [8.123456789, 53.1]}
+        self.assertEqual(point, simplify_geometry(point, 1, 0))
+
+    def test_coordinates_are_rounded(self):
+        line = {"type": "LineString",
+                "coordinates": [[8.123456, 53.1], [9.987654, 54.2]]}
+        self.assertEqual([[8.12, 53.1], [9.99, 54.2]],
+                         simplify_geometry(line, 0.01, 2)["coordinates"])
+
+    def test_holes_that_get_too_small_disappear(self):
+        polygon = {"type": "Polygon", "coordinates": [
+            [[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]],
+            [[5, 5], [5.01, 5], [5.01, 5.01], [5, 5]]]}
+        simplified = simplify_geometry(polygon, 0.1, 2)
+        self.assertEqual(1, len(simplified["coordinates"]))
+
+    def test_tiny_polygon_keeps_its_full_geometry(self):
+        polygon = {"type": "Polygon", "coordinates": [
+            [[0, 0], [0.001, 0], [0.001, 0.001], [0, 0.001], [0, 0]]]}
+        simplified = list(simplify_features([feature(polygon)], 1))
+        self.assertEqual(polygon, simplified[0]["geometry"])
+
+    def test_multipolygon_drops_parts_that_are_too_small(self):
+        big = [[[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]]]
+        small = [[[20, 20], [20.001, 20], [20.001, 20.001], [20, 20]]]
+        simplified = simplify_geometry(
+            {"type": "MultiPolygon", "coordinates": [big, small]}, 0.1, 1)
+        self.assertEqual([big], simplified["coordinates"])
+
+
+@override_settings(DATASET_SIMPLIFY_ZOOMS=(3, 6, 9), DATASET_SIMPLIFY_PIXELS=1)
+class LevelTests(SimpleTestCase):
+
+    def test_tolerance_halves_with_every_zoom_level(self):
+        self.assertAlmostEqual(zoom_tolerance(4) * 2, zoom_tolerance(3))
+
+    def test_zoom_gets_the_next_level_up(self):
+        self.assertEqual(3, level_for(zoom=0))
+        self.assertEqual(6, level_for(zoom=4))
+        self.assertEqual(6, level_for(zoom=6))
+
+    def test_zoomed_in_beyond_the_levels_gets_none(self):
+        self.assertIsNone(level_for(zoom=10))
+
+    def test_tolerance_gets_the_coarsest_level_that_is_good_enough(self):
+        self.assertEqual(3, level_for(tolerance=1))
+        self.assertEqual(6, level_for(tolerance=zoom_tolerance(6)))
+        self.assertIsNone(level_for(tolerance=0))
@@ -0,0 +1,171 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.test import SimpleTestCase, override_settings
+
+from datasets.cache import fetch_payload, payload_cache
+from datasets.checks import check_lock_cache
+from datasets.singleflight import forget, solo, take_off
+
+from test.unit_tests.main.test_views import fake_upstream
+
+from unittest import mock
+
+import threading
+import shutil
+import tempfile
+import time
+
+
+@override_settings(DATASET_LOCK_CACHE="default", DATASET_FLIGHT_TIMEOUT=5)
+class SingleFlightTests(SimpleTestCase):
+
+    def setUp(self):
+        caches["default"].clear()
+        forget()
+
+    def test_first_one_leads_and_the_others_follow(self):
+        leader = take_off("a")
+        follower = take_off("a")
+        self.assertTrue(leader.leader)
+        self.assertFalse(follower.leader)
+        leader.land()
+        self.assertTrue(take_off("a").leader)
+
+    def test_different_keys_dont_wait_for_each_other(self):
+        self.assertTrue(take_off("a").leader)
+        self.assertTrue(take_off("b").leader)
+
+    def test_followers_wait_until_the_leader_lands(self):
+        leader = take_off("a")
+        follower = take_off("a")
+        threading.Timer(0.2, leader.land).start()
+        started = time.time()
+        follower.wait()
+        self.assertGreaterEqual(time.time() - started, 0.15)
+        self.assertLess(time.time() - started, 5)
+
+    @override_settings(DATASET_FLIGHT_TIMEOUT=0.2)
+    def test_followers_give_up_after_the_timeout(self):
+        take_off("a")
+        started = time.time()
+        take_off("a").wait()
+        self.assertLess(time.time() - started, 1)
+
+    def test_landing_twice_is_fine(self):
+        leader = take_off("a")
+        leader.land()
+        again = take_off("a")
+        leader.land()
+        self.assertFalse(take_off("a").leader)
+        again.land()
+
+    def test_lock_of_another_process_is_waited_for(self):
+        caches["default"].add("dataset-flight:a", "someone else", 5)
+        threading.Timer(
+            0.2, caches["default"].delete, ["dataset-flight:a"]).start()
+        started = time.time()
+        flight = take_off("a")
+        self.assertGreaterEqual(time.time() - started, 0.15)
+        self.assertFalse(flight.leader)
+        self.assertTrue(take_off("a").leader)
+
+    def test_leader_only_removes_its_own_lock(self):
+        leader = take_off("a")
+        caches["default"].set("dataset-flight:a", "someone else", 5)
+        leader.land()
+        self.assertEqual("someone else",
+                         caches["default"].get("dataset-flight:a"))
+
+    def test_solo_flights_are_never_waited_for(self):
+        solo("a")
+        self.assertTrue(take_off("a").leader)
+
+    @override_settings(DATASET_LOCK_CACHE=None)
+    def test_without_a_lock_cache_only_this_process_waits(self):
+        caches["default"].add("dataset-flight:a", "someone else", 5)
+        leader = take_off("a")
+        self.assertTrue(leader.leader)
+        self.assertFalse(take_off("a").leader)
+        leader.land()
+        self.assertEqual("someone else",
+                         caches["default"].get("dataset-flight:a"))
+
+
+class LockCacheCheckTests(SimpleTestCase):
+
+    def test_off_by_default(self):
+        self.assertIsNone(settings.DATASET_LOCK_CACHE)
+        self.assertEqual([], check_lock_cache(None))
+
+    @override_settings(DATASET_LOCK_CACHE="default")
+    def test_locmem_is_refused(self):
+        errors = check_lock_cache(None)
+        self.assertEqual(["datasets.E002"], [error.id for error in errors])
+
+    @override_settings(DATASET_LOCK_CACHE="shared", CACHES={
+        "shared": {"BACKEND":
+                   "django.core.cache.backends.filebased.FileBasedCache",
+                   "LOCATION": "/tmp/lock-cache-check"}})
+    def test_shared_cache_is_fine(self):
+        self.assertEqual([], check_lock_cache(None))
+
+
+class Dataset:
+    """
+    Just enough of a Dataset for fetch_payload, the threads below can't see
+    the rows of the test transaction.
+    """
+    pk = 1
+    url = "https://example.com/stations.geojson"
+    owncloud = False
+    owncloud_instance = owncloud_path = None
+    dataset_user = dataset_password = ""
+
+
+@override_settings(DATASET_LOCK_CACHE="default", DATASET_FLIGHT_TIMEOUT=5)
+class FetchPayloadCoalescingTests(SimpleTestCase):
+
+    def setUp(self):
+        caches["default"].clear()
+        forget()
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, True)
+        cache_settings = self.settings(DATASET_CACHE_BACKEND="disk",
+                                       DATASET_CACHE_DIR=cache_dir)
+        cache_settings.enable()
+        self.addCleanup(cache_settings.disable)
+
+    def test_concurrent_fetches_go_upstream_once(self):
+        release = threading.Event()
+
+        def slow_upstream(*args, **kwargs):
+            release.wait(5)
+            return fake_upstream(b'{"type": "FeatureCollection"}')
+
+        results = []
+
+        def fetch():
+            results.append(fetch_payload(Dataset()).read())
+
+        with mock.patch("requests.Session.request",
+                        side_effect=slow_upstream) as request:
+            threads = [threading.Thread(target=fetch) for i in range(5)]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.2)
+            release.set()
+            for thread in threads:
+                thread.join(5)
+
+        self.assertEqual(1, request.call_count)
+        self.assertEqual([b'{"type": "FeatureCollection"}'] * 5, results)
+
+    def test_without_a_cache_nobody_waits(self):
+        with self.settings(DATASET_CACHE_BACKEND=None), \
+                mock.patch("requests.Session.request",
+                           side_effect=lambda *args, **kwargs:
+                           fake_upstream(b"{}")) as request:
+            fetch_payload(Dataset())
+            fetch_payload(Dataset())
+        self.assertEqual(2, request.call_count)
+        self.assertIsNone(payload_cache().get(Dataset()))
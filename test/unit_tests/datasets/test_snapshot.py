@@ -0,0 +1,138 @@
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase
+
+from datasets.models import Dataset
+from datasets.snapshot import MANIFEST, export
+
+from keywords.models import Keyword
+
+from test.unit_tests.main.test_views import GEOJSON
+from test.unit_tests.main.test_views import TemporaryPayloadCacheMixin
+from test.unit_tests.main.test_views import fake_upstream
+
+from unittest import mock
+
+import io
+import json
+import os
+import shutil
+import tempfile
+
+User = get_user_model()
+
+
+class SnapshotTests(TemporaryPayloadCacheMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+        self.ds1 = Dataset.objects.create(
+            account=self.u1.account,
+            author="zmtdummy",
+            title="Harbours",
+            url="https://example.com/harbours.geojson")
+        self.ds2 = Dataset.objects.create(
+            account=self.u1.account,
+            author="zmtdummy",
+            title="Secret",
+            url="https://example.com/secret.geojson",
+            public_access=False)
+
+    def upstream(self, status_code=200):
+        return mock.patch(
+            "requests.Session.request",
+            side_effect=lambda *args, **kwargs: fake_upstream(
+                GEOJSON, status_code,
+                {"Content-Type": "application/geo+json"}))
+
+    def path(self, *parts):
+        return os.path.join(self.directory, *parts)
+
+    def read(self, *parts):
+        with open(self.path(*parts), "rb") as f:
+            return f.read()
+
+    def test_public_datasets_are_exported(self):
+        with self.upstream():
+            counts = export(self.directory)
+        self.assertEqual({"exported": 1, "removed": 0, "failed": 0}, counts)
+        self.assertEqual(GEOJSON, self.read("test_user", "harbours",
+                                            "payload.geojson"))
+        self.assertIn(b"Harbours", self.read("test_user", "harbours",
+                                             "index.html"))
+        self.assertFalse(os.path.exists(self.path("test_user", "secret")))
+
+    def test_pages_load_the_copy(self):
+        with self.upstream():
+            export(self.directory)
+        self.assertIn(b'url="payload.geojson"',
+                      self.read("test_user", "harbours", "index.html"))
+        self.assertIn(b'url="../payload.geojson"',
+                      self.read("test_user", "harbours", "embed",
+                                "index.html"))
+
+    def test_unchanged_datasets_are_left_alone(self):
+        with self.upstream():
+            export(self.directory)
+        with self.upstream() as request:
+            counts = export(self.directory)
+        self.assertEqual(0, counts["exported"])
+        request.assert_not_called()
+
+    def test_changed_datasets_are_exported_again(self):
+        with self.upstream():
+            export(self.directory)
+        self.ds1.author = "somebody else"
+        self.ds1.save()
+        keyword = Keyword.objects.create(keyword="coast")
+        keyword.datasets.add(self.ds1)
+        with self.upstream():
+            counts = export(self.directory)
+        self.assertEqual(1, counts["exported"])
+        page = self.read("test_user", "harbours", "index.html")
+        self.assertIn(b"somebody else", page)
+        self.assertIn(b"coast", page)
+
+    def test_renamed_and_removed_datasets_are_cleaned_up(self):
+        with self.upstream():
+            export(self.directory)
+        self.ds1.title = "Ports"
+        self.ds1.save()
+        with self.upstream():
+            export(self.directory)
+        self.assertTrue(os.path.exists(self.path("test_user", "ports",
+                                                 "payload.geojson")))
+        self.assertFalse(os.path.exists(self.path("test_user", "harbours")))
+
+        self.ds1.public_access = False
+        self.ds1.save()
+        counts = export(self.directory)
+        self.assertEqual(1, counts["removed"])
+        self.assertFalse(os.path.exists(self.path("test_user")))
+        self.assertEqual({}, json.loads(self.read(MANIFEST)))
+
+    def test_failed_datasets_are_tried_again(self):
+        with self.upstream(status_code=500):
+            counts = export(self.directory)
+        self.assertEqual(1, counts["failed"])
+        self.assertFalse(os.path.exists(self.path("test_user", "harbours")))
+        with self.upstream():
+            counts = export(self.directory)
+        self.assertEqual(1, counts["exported"])
+
+    def test_full_export_does_everything_again(self):
+        with self.upstream():
+            export(self.directory)
+            counts = export(self.directory, full=True)
+        self.assertEqual(1, counts["exported"])
+
+    def test_command(self):
+        out = io.StringIO()
+        with self.upstream():
+            call_command("export_snapshot", self.directory, stdout=out)
+        self.assertIn("1 exported, 0 removed, 0 failed", out.getvalue())
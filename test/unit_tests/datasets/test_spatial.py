@@ -0,0 +1,184 @@
+from django.test import SimpleTestCase, override_settings
+
+from datasets.cache import CachedPayload
+from datasets.spatial import FeatureIndex, PolygonFilter, geometry_bbox
+from datasets.spatial import polygons_from_geojson, tile_bbox
+from datasets.spatial import _index_chunks, _parse_index, _temporary_index
+
+import gc
+import os
+
+
+def point(x, y, **properties):
+    return {"type": "Feature", "properties": properties,
+            "geometry": {"type": "Point", "coordinates": [x, y]}}
+
+
+def build_index(features):
+    lines, index = FeatureIndex.build(features)
+    body = b"".join(lines)
+    return FeatureIndex(index, CachedPayload({}, len(body), data=body))
+
+
+class GeometryTests(SimpleTestCase):
+
+    def test_bbox_of_a_point(self):
+        self.assertEqual([8.8, 53.1, 8.8, 53.1],
+                         geometry_bbox(point(8.8, 53.1)["geometry"]))
+
+    def test_bbox_of_a_polygon_with_a_hole(self):
+        polygon = {"type": "Polygon", "coordinates": [
+            [[0, 0], [4, 0], [4, 3], [0, 3], [0, 0]],
+            [[1, 1], [2, 1], [2, 2], [1, 1]]]}
+        self.assertEqual([0, 0, 4, 3], geometry_bbox(polygon))
+
+    def test_bbox_of_a_geometry_collection(self):
+        collection = {"type": "GeometryCollection", "geometries": [
+            {"type": "Point", "coordinates": [-5, 2]},
+            {"type": "LineString", "coordinates": [[1, 1], [3, 7]]}]}
+        self.assertEqual([-5, 1, 3, 7], geometry_bbox(collection))
+
+    def test_bbox_of_nothing_is_none(self):
+        self.assertIsNone(geometry_bbox(None))
+        self.assertIsNone(geometry_bbox({"type": "Point", "coordinates": []}))
+
+    def test_tile_bbox(self):
+        minx, miny, maxx, maxy = tile_bbox(0, 0, 0)
+        self.assertEqual((-180, 180), (minx, maxx))
+        self.assertAlmostEqual(-85.0511, miny, places=4)
+        self.assertAlmostEqual(85.0511, maxy, places=4)
+
+        minx, miny, maxx, maxy = tile_bbox(1, 1, 0)
+        self.assertEqual((0, 180), (minx, maxx))
+        self.assertEqual(0, miny)
+
+
+@override_settings(DATASET_INDEX_CELL_FEATURES=2)
+class FeatureIndexTests(SimpleTestCase):
+
+    def setUp(self):
+        self.features = [point(x, y, name="{},{}".format(x, y))
+                         for x in range(-50, 50, 5)
+                         for y in range(-50, 50, 5)]
+        self.index = build_index(self.features)
+
+    def brute_force(self, bbox):
+        return [number for number, feature in enumerate(self.features)
+                if bbox[0] <= feature["geometry"]["coordinates"][0] <= bbox[2]
+                and bbox[1] <= feature["geometry"]["coordinates"][1] <= bbox[3]]
+
+    def test_index_has_a_grid(self):
+        self.assertEqual(400, len(self.index))
+        self.assertGreater(self.index.columns, 1)
+        self.assertEqual([-50, -50, 45, 45], self.index.bbox)
+
+    def test_query_finds_the_same_features_as_a_full_scan(self):
+        for bbox in ([0, 0, 12, 12], [-100, -100, 100, 100],
+                     [-47, 3, -33, 8], [44, 44, 80, 80]):
+            self.assertEqual(self.brute_force(bbox), self.index.query(bbox))
+
+    def test_query_outside_the_dataset_finds_nothing(self):
+        self.assertEqual([], self.index.query([100, 100, 120, 120]))
+
+    def test_features_are_read_back_with_their_number_as_id(self):
+        numbers = self.index.query([0, 0, 0, 0])
+        features = list(self.index.features(numbers))
+        self.assertEqual("0,0", features[0]["properties"]["name"])
+        self.assertEqual(numbers[0], features[0]["id"])
+
+    def test_large_features_are_always_checked(self):
+        big = {"type": "Feature", "properties": {}, "geometry": {
+            "type": "Polygon",
+            "coordinates": [[[-50, -50], [45, -50], [45, 45], [-50, -50]]]}}
+        index = build_index(self.features + [big])
+        self.assertIn(400, index.large)
+        self.assertIn(400, index.query([1, 1, 2, 2]))
+
+    def test_features_without_geometry_are_skipped(self):
+        empty = {"type": "Feature", "properties": {}, "geometry": None}
+        index = build_index([empty, point(1, 1)])
+        self.assertEqual([1], index.query([0, 0, 2, 2]))
+
+    def test_stored_index_is_read_back_as_it_was(self):
+        lines, index = FeatureIndex.build(self.features)
+        body = b"".join(lines)
+        index["features_sha1"] = "abc"
+        stored = memoryview(b"".join(_index_chunks(index)))
+        read = FeatureIndex(_parse_index(stored),
+                            CachedPayload({}, len(body), data=body))
+        self.assertEqual(len(self.index), len(read))
+        self.assertEqual(self.index.bbox, read.bbox)
+        for bbox in ([0, 0, 12, 12], [-47, 3, -33, 8]):
+            self.assertEqual(self.brute_force(bbox), read.query(bbox))
+
+    def test_index_in_another_format_is_not_read(self):
+        self.assertIsNone(_parse_index(memoryview(b'{"bboxes": []}')))
+
+    def test_index_that_is_not_cached_lives_in_a_temporary_file(self):
+        lines, index = FeatureIndex.build(self.features[:3])
+        index = _temporary_index(lines, index)
+        path = index.lines.path
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual("-50,-45",
+                         next(index.features([1]))["properties"]["name"])
+        del index
+        gc.collect()
+        self.assertFalse(os.path.exists(path))
+
+
+class PolygonFilterTests(SimpleTestCase):
+
+    def setUp(self):
+        # a square from 0,0 to 10,10 with a hole from 4,4 to 6,6
+        self.square = PolygonFilter(polygons_from_geojson({
+            "type": "Polygon", "coordinates": [
+                [[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]],
+                [[4, 4], [6, 4], [6, 6], [4, 6], [4, 4]]]}))
+
+    def test_points(self):
+        self.assertTrue(self.square.intersects(point(1, 1)["geometry"]))
+        self.assertFalse(self.square.intersects(point(11, 1)["geometry"]))
+        self.assertFalse(self.square.intersects(point(5, 5)["geometry"]))
+
+    def test_line_crossing_the_polygon(self):
+        line = {"type": "LineString", "coordinates": [[-5, 2], [15, 2]]}
+        self.assertTrue(self.square.intersects(line))
+
+    def test_line_passing_by(self):
+        line = {"type": "LineString", "coordinates": [[-5, -2], [15, -2]]}
+        self.assertFalse(self.square.intersects(line))
+
+    def test_polygon_around_the_filter(self):
+        around = {"type": "Polygon", "coordinates": [
+            [[-20, -20], [20, -20], [20, 20], [-20, 20], [-20, -20]]]}
+        self.assertTrue(self.square.intersects(around))
+
+    def test_multipolygon_filter(self):
+        two = PolygonFilter(polygons_from_geojson({
+            "type": "Feature", "properties": {}, "geometry": {
+                "type": "MultiPolygon", "coordinates": [
+                    [[[0, 0], [1, 0], [1, 1], [0, 0]]],
+                    [[[5, 5], [6, 5], [6, 6], [5, 5]]]]}}))
+        self.assertTrue(two.intersects(point(5.9, 5.1)["geometry"]))
+        self.assertFalse(two.intersects(point(3, 3)["geometry"]))
+
+    def test_broken_polygons_raise_value_error(self):
+        for broken in ({"type": "Point", "coordinates": [1, 2]},
+                       {"type": "Polygon", "coordinates": [[[0, 0], [1]]]},
+                       {"type": "Polygon", "coordinates": [[[0, 0], [1, 1]]]},
+                       [1, 2, 3]):
+            with self.assertRaises(ValueError):
+                polygons_from_geojson(broken)
+
+    @override_settings(DATASET_INDEX_CELL_FEATURES=2)
+    def test_filter_matches_a_full_scan(self):
+        features = [point(x, y) for x in range(-3, 14) for y in range(-3, 14)]
+        index = build_index(features)
+        found = [feature["id"] for feature in
+                 self.square.filter(index, batch_size=7)]
+        expected = [number for number, feature in enumerate(features)
+                    if self.square.intersects(feature["geometry"])]
+        self.assertEqual(expected, found)
+        self.assertIn(features.index(point(1, 1)), found)
+        self.assertNotIn(features.index(point(5, 5)), found)
+        self.assertNotIn(features.index(point(12, 1)), found)
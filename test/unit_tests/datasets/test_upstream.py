@@ -0,0 +1,128 @@
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+
+from datasets import upstream
+from datasets.models import Dataset
+
+from test.unit_tests.main.test_views import fake_upstream
+
+from unittest import mock
+
+import http.client
+import requests
+import urllib.request
+
+User = get_user_model()
+
+
+class HostSessionTests(TestCase):
+
+    def setUp(self):
+        upstream.close_connections()
+        self.addCleanup(upstream.close_connections)
+
+    def test_same_host_shares_one_session(self):
+        self.assertIs(upstream.host_session("https://example.com/a.json"),
+                      upstream.host_session("https://example.com/b/c.kml"))
+
+    def test_different_hosts_get_different_sessions(self):
+        self.assertIsNot(upstream.host_session("https://example.com/a.json"),
+                         upstream.host_session("https://example.org/a.json"))
+
+    @override_settings(DATASET_POOL_MAXSIZE=3)
+    def test_session_connection_pool_is_limited(self):
+        session = upstream.host_session("https://example.com/a.json")
+        adapter = session.get_adapter("https://example.com/a.json")
+        self.assertEqual(3, adapter._pool_maxsize)
+        self.assertTrue(adapter._pool_block)
+
+    @override_settings(DATASET_POOL_MAXSIZE=1, DATASET_POOL_TIMEOUT=0.1)
+    def test_full_pool_is_only_waited_on_for_a_while(self):
+        session = upstream.host_session("https://example.com/a.json")
+        adapter = session.get_adapter("https://example.com/a.json")
+        request = requests.Request("GET", "https://example.com/a.json")
+        request = session.prepare_request(request)
+        pool = adapter.get_connection_with_tls_context(request, verify=True)
+        taken = pool._get_conn()
+        self.addCleanup(pool._put_conn, taken)
+        with self.assertRaises(upstream.PoolTimeout):
+            adapter.send(request, verify=True, timeout=1)
+
+    def test_session_does_not_keep_cookies(self):
+        session = upstream.host_session("https://example.com/a.json")
+        headers = http.client.HTTPMessage()
+        headers["Set-Cookie"] = "sessionid=secret; Path=/"
+        session.cookies.extract_cookies(
+            mock.Mock(info=lambda: headers),
+            urllib.request.Request("https://example.com/a.json"))
+        self.assertEqual(0, len(session.cookies))
+
+
+class OwncloudClientTests(TestCase):
+
+    def setUp(self):
+        upstream.close_connections()
+        self.addCleanup(upstream.close_connections)
+
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+
+        self.ds1 = Dataset.objects.create(
+            account=self.u1.account,
+            title="Owncloud Dataset",
+            owncloud=True,
+            owncloud_instance="https://owncloud.example.com",
+            owncloud_path="/data/reefs.geojson",
+            dataset_user="zmtdummy",
+            dataset_password="zmtBremen1991")
+
+        patcher = mock.patch("datasets.upstream.owncloud.Client",
+                             side_effect=self.new_client)
+        self.Client = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.responses = []
+
+    def new_client(self, instance):
+        oc = mock.Mock(_webdav_url=instance + "/remote.php/webdav")
+        oc._session = requests.Session()
+        oc._session.get = mock.Mock(
+            side_effect=lambda *args, **kwargs: self.responses.pop(0))
+        return oc
+
+    def test_owncloud_login_is_reused(self):
+        self.responses = [fake_upstream(b"one"), fake_upstream(b"two")]
+        upstream.open_upstream(self.ds1).close()
+        upstream.open_upstream(self.ds1).close()
+        self.assertEqual(1, self.Client.call_count)
+
+    def test_owncloud_file_is_requested_from_webdav(self):
+        self.responses = [fake_upstream(b"one")]
+        upstream.open_upstream(self.ds1).close()
+        oc = upstream.owncloud_client("https://owncloud.example.com",
+                                      "zmtdummy", "zmtBremen1991")
+        oc.login.assert_called_once_with("zmtdummy", "zmtBremen1991")
+        self.assertEqual(
+            "https://owncloud.example.com/remote.php/webdav/data/reefs.geojson",
+            oc._session.get.call_args[0][0])
+
+    def test_owncloud_logs_in_again_after_401(self):
+        self.responses = [fake_upstream(b"", status_code=401),
+                          fake_upstream(b"data")]
+        response = upstream.open_upstream(self.ds1)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(b"data", response.content)
+        self.assertEqual(2, self.Client.call_count)
+
+    @override_settings(DATASET_OWNCLOUD_LOGIN_TIMEOUT=0)
+    def test_owncloud_login_expires(self):
+        self.responses = [fake_upstream(b"one"), fake_upstream(b"two")]
+        upstream.open_upstream(self.ds1).close()
+        upstream.open_upstream(self.ds1).close()
+        self.assertEqual(2, self.Client.call_count)
+
+    def test_owncloud_logs_in_again_when_the_password_changed(self):
+        upstream.owncloud_client("https://owncloud.example.com",
+                                 "zmtdummy", "old password")
+        upstream.owncloud_client("https://owncloud.example.com",
+                                 "zmtdummy", "new password")
+        self.assertEqual(2, self.Client.call_count)
@@ -2,7 +2,8 @@ from django.contrib.auth import get_user_model
 from django.urls import reverse
 from django.http import HttpRequest
 from django.test import Client
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.core.cache import caches
 
 from accounts.models import Account
 
@@ -256,6 +257,69 @@ class EmbeddableDatasetViewTests(TestCase):
         self.assertEqual(response["X-Frame-Options"], "ALLOW-FROM https://www.leibniz-zmt.de/")  
 
 
+class EmbeddableDatasetCachingTests(TestCase):
+
+    def setUp(self):
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+        self.ds1 = Dataset.objects.create(
+            account=self.u1.account,
+            author="Google",
+            title="Google GeoJSON Example",
+            url="https://storage.googleapis.com/maps-devrel/google.json",
+            public_access=True)
+        self.url = "/test_user/google-geojson-example/embed/"
+
+    def test_embed_can_be_kept_by_browsers_and_cdns(self):
+        response = self.client.get(self.url)
+        self.assertIn("public", response["Cache-Control"])
+        self.assertIn("max-age=300", response["Cache-Control"])
+        self.assertIn("stale-while-revalidate=86400",
+                      response["Cache-Control"])
+        self.assertTrue(response.has_header("ETag"))
+
+    def test_embed_does_not_vary_on_the_cookie(self):
+        self.client.login(username="test_user", password="test_password")
+        response = self.client.get(self.url)
+        self.assertNotIn("Cookie", response["Vary"])
+        self.assertIn("Accept-Encoding", response["Vary"])
+
+    def test_embed_answers_conditional_requests_with_304(self):
+        etag = self.client.get(self.url)["ETag"]
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(etag, response["ETag"])
+        self.assertEqual(b"", response.content)
+
+    def test_changed_embed_gets_a_new_etag(self):
+        etag = self.client.get(self.url)["ETag"]
+        self.ds1.url = "https://example.com/google.json"
+        self.ds1.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response["ETag"])
+
+    @override_settings(PAGE_CACHE="default")
+    def test_cached_embed_answers_conditional_requests_with_304(self):
+        caches["default"].clear()
+        etag = self.client.get(self.url)["ETag"]
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+
+    def test_sanity_page_gets_the_same_headers(self):
+        response = self.client.get("/test_user/google-geojson-example/sanity/")
+        self.assertIn("public", response["Cache-Control"])
+        self.assertTrue(response.has_header("ETag"))
+        self.assertEqual(
+            "ALLOW-FROM https://s3.eu-central-1.amazonaws.com/"
+            "spatialdatahub-embed-test/", response["X-Frame-Options"])
+
+    def test_missing_embed_is_not_public(self):
+        response = self.client.get("/test_user/nothing/embed/")
+        self.assertEqual(404, response.status_code)
+        self.assertFalse(response.has_header("ETag"))
+
+
 class DatasetUpdateViewTests(TestCase):
 
     def setUp(self):
@@ -78,6 +78,52 @@ class KeywordModelTests(TestCase):
             kw2.datasets.add(self.ds1)
             kw2.save()
 
+class KeywordDatasetCountTests(TestCase):
+
+    def setUp(self):
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+        self.ds1 = Dataset.objects.create(
+            account=self.u1.account, title="Reefs",
+            url="https://example.com/reefs.geojson")
+        self.ds2 = Dataset.objects.create(
+            account=self.u1.account, title="Mangroves",
+            url="https://example.com/mangroves.geojson")
+        self.kw1 = Keyword.objects.create(keyword="biology")
+        self.kw2 = Keyword.objects.create(keyword="chemistry")
+
+    def count(self, keyword):
+        return Keyword.objects.get(pk=keyword.pk).dataset_count
+
+    def test_adding_from_either_side_counts(self):
+        self.kw1.datasets.add(self.ds1, self.ds2)
+        self.ds1.keywords.add(self.kw2)
+        self.assertEqual(2, self.count(self.kw1))
+        self.assertEqual(1, self.count(self.kw2))
+
+    def test_removing_and_clearing_counts(self):
+        self.kw1.datasets.add(self.ds1, self.ds2)
+        self.ds1.keywords.add(self.kw2)
+        self.kw1.datasets.remove(self.ds2)
+        self.assertEqual(1, self.count(self.kw1))
+        self.ds1.keywords.clear()
+        self.assertEqual(0, self.count(self.kw1))
+        self.assertEqual(0, self.count(self.kw2))
+
+    def test_deleting_a_dataset_counts(self):
+        self.kw1.datasets.add(self.ds1, self.ds2)
+        self.ds2.delete()
+        self.assertEqual(1, self.count(self.kw1))
+
+    def test_saving_an_old_copy_keeps_the_count(self):
+        self.kw1.datasets.add(self.ds1)
+        self.kw1.keyword = "marine biology"
+        self.kw1.save()
+        self.assertEqual(1, self.count(self.kw1))
+        self.assertEqual("marine-biology",
+                         Keyword.objects.get(pk=self.kw1.pk).keyword_slug)
+
+
 '''
 class KeywordViewTests(TestCase):
 
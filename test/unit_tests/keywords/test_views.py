@@ -0,0 +1,45 @@
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.urls import reverse
+
+from datasets.models import Dataset
+from keywords.models import Keyword
+
+User = get_user_model()
+
+
+class KeywordListViewTests(TestCase):
+
+    def setUp(self):
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+        self.ds1 = Dataset.objects.create(
+            account=self.u1.account, title="Reefs",
+            url="https://example.com/reefs.geojson")
+        self.ds2 = Dataset.objects.create(
+            account=self.u1.account, title="Mangroves",
+            url="https://example.com/mangroves.geojson")
+        self.kw1 = Keyword.objects.create(keyword="biology")
+        self.kw1.datasets.add(self.ds1, self.ds2)
+        Keyword.objects.create(keyword="chemistry")
+
+    def test_keyword_list_shows_the_dataset_counts(self):
+        response = self.client.get(reverse("keywords:keyword_list"))
+        self.assertContains(response, "biology: 2 datasets")
+        self.assertContains(response, "chemistry: 0 datasets")
+        self.assertEqual(2, response.context["total_keywords"])
+
+    def test_keyword_list_queries_dont_grow_with_the_keywords(self):
+        with self.assertNumQueries(2):
+            self.client.get(reverse("keywords:keyword_list"))
+        for i in range(20):
+            Keyword.objects.create(keyword="keyword {}".format(i)) \
+                .datasets.add(self.ds1)
+        with self.assertNumQueries(2):
+            self.client.get(reverse("keywords:keyword_list"))
+
+    def test_keyword_search(self):
+        response = self.client.get(reverse("keywords:keyword_list") +
+                                   "?q=chem")
+        self.assertNotContains(response, "biology")
+        self.assertEqual(1, response.context["total_keywords"])
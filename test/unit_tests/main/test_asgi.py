@@ -0,0 +1,335 @@
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+
+from asgiref.sync import async_to_sync
+
+from datasets.cache import payload_cache, payload_flight
+from datasets.downloads import Download
+from datasets.models import Dataset
+
+from main.async_proxy import DatasetProxy, ThreadPoolWsgi, _downloading
+
+from test.unit_tests.main.test_views import GEOJSON
+from test.unit_tests.main.test_views import TemporaryPayloadCacheMixin
+
+from unittest import mock
+
+import asyncio
+import gzip
+import httpx
+import threading
+import time
+
+User = get_user_model()
+
+
+async def django_app(scope, receive, send):
+    """
+    Stands in for django's application behind the proxy.
+    """
+    await send({"type": "http.response.start", "status": 200,
+                "headers": [(b"x-served-by", b"django")]})
+    await send({"type": "http.response.body", "body": b""})
+
+
+class Exchange:
+    """
+    One request through the ASGI app, with everything that was sent back.
+    """
+
+    def __init__(self, app, path, query_string=b"", headers=(),
+                 disconnect_after=None, run=True):
+        self.messages = []
+        self.body_sent = 0
+        self.disconnect_after = disconnect_after
+        self.scope = {"type": "http", "method": "GET", "path": path,
+                      "query_string": query_string,
+                      "headers": list(headers), "http_version": "1.1"}
+        if run:
+            async_to_sync(self.run)(app)
+
+    async def run(self, app):
+        self.loop_thread = threading.current_thread()
+        self.sent_enough = asyncio.Event()
+        self.requested = False
+        await app(self.scope, self.receive, self.send)
+        # the event loop goes away with this exchange, the downloads that
+        # outlive their browser are let finish first
+        await asyncio.gather(*_downloading)
+
+    async def receive(self):
+        if not self.requested:
+            self.requested = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        if self.disconnect_after is None:
+            await asyncio.Event().wait()
+        await self.sent_enough.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(self, message):
+        self.messages.append(message)
+        if message["type"] == "http.response.body" and message["body"]:
+            self.body_sent += 1
+            if self.body_sent == self.disconnect_after:
+                self.sent_enough.set()
+
+    @property
+    def status(self):
+        return self.messages[0]["status"]
+
+    @property
+    def headers(self):
+        return {name.decode("latin-1"): value.decode("latin-1")
+                for name, value in self.messages[0]["headers"]}
+
+    @property
+    def body(self):
+        return b"".join(message.get("body", b"")
+                        for message in self.messages[1:])
+
+
+def mock_upstream(handler):
+    """
+    Makes the proxy's httpx client answer with handler(request) instead of
+    going out to the internet.
+    """
+    return mock.patch("datasets.async_upstream.async_client",
+                      lambda: httpx.AsyncClient(
+                          transport=httpx.MockTransport(handler)))
+
+
+class DatasetProxyTests(TemporaryPayloadCacheMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+
+        self.ds1 = Dataset.objects.create(
+            account=self.u1.account,
+            author="zmtdummy",
+            title="Harbours",
+            url="https://example.com/harbours.geojson",
+            dataset_user="zmtdummy",
+            dataset_password="zmtBremen1991")
+
+        self.path = "/load_dataset/{}/".format(self.ds1.pk)
+        self.app = DatasetProxy(django_app)
+        self.requests = []
+
+    def upstream(self, status_code=200, body=GEOJSON, headers=None):
+        def handler(request):
+            self.requests.append(request)
+            return httpx.Response(status_code, content=body, headers=headers
+                                  or {"Content-Type": "application/geo+json",
+                                      "ETag": '"v1"'})
+        return mock_upstream(handler)
+
+    def test_file_is_streamed_from_upstream(self):
+        with self.upstream():
+            exchange = Exchange(self.app, self.path)
+        self.assertEqual(200, exchange.status)
+        self.assertEqual(GEOJSON, exchange.body)
+        self.assertEqual("miss", exchange.headers["x-dataset-cache"])
+        self.assertEqual('"v1"', exchange.headers["etag"])
+        self.assertEqual(str(len(GEOJSON)),
+                         exchange.headers["content-length"])
+
+    def test_credentials_are_sent_upstream(self):
+        with self.upstream():
+            Exchange(self.app, self.path)
+        self.assertEqual("Basic em10ZHVtbXk6em10QnJlbWVuMTk5MQ==",
+                         self.requests[0].headers["Authorization"])
+
+    def test_downloaded_file_is_cached_and_then_served_by_django(self):
+        with self.upstream():
+            Exchange(self.app, self.path)
+            exchange = Exchange(self.app, self.path)
+        self.assertEqual(1, len(self.requests))
+        self.assertEqual("django", exchange.headers["x-served-by"])
+        self.assertEqual(GEOJSON, payload_cache().get(self.ds1).read())
+
+    def test_queries_are_left_to_django(self):
+        with self.upstream():
+            exchange = Exchange(self.app, self.path, b"bbox=0,0,1,1")
+        self.assertEqual("django", exchange.headers["x-served-by"])
+        self.assertEqual([], self.requests)
+
+    def test_other_urls_are_left_to_django(self):
+        exchange = Exchange(self.app, "/portal/")
+        self.assertEqual("django", exchange.headers["x-served-by"])
+
+    def test_missing_dataset_is_left_to_django(self):
+        exchange = Exchange(self.app, "/load_dataset/9999/")
+        self.assertEqual("django", exchange.headers["x-served-by"])
+
+    def test_stale_copy_is_revalidated(self):
+        with self.upstream():
+            Exchange(self.app, self.path)
+        with self.settings(DATASET_CACHE_TIMEOUT=0), \
+                self.upstream(status_code=304, body=b"",
+                              headers={"ETag": '"v1"'}):
+            exchange = Exchange(self.app, self.path)
+        self.assertEqual('"v1"', self.requests[-1].headers["If-None-Match"])
+        self.assertEqual("revalidated", exchange.headers["x-dataset-cache"])
+        self.assertEqual(GEOJSON, exchange.body)
+
+    def test_revalidated_copy_answers_conditional_requests(self):
+        modified = "Wed, 21 Oct 2015 07:28:00 GMT"
+        headers = {"ETag": '"v1"', "Last-Modified": modified}
+        with self.upstream(headers=headers):
+            Exchange(self.app, self.path)
+        for conditional in ([(b"if-none-match", b'"v0", W/"v1"')],
+                            [(b"if-modified-since", modified.encode())]):
+            with self.settings(DATASET_CACHE_TIMEOUT=0), \
+                    self.upstream(status_code=304, body=b"",
+                                  headers=headers):
+                exchange = Exchange(self.app, self.path, headers=conditional)
+            self.assertEqual(304, exchange.status)
+
+        with self.settings(DATASET_CACHE_TIMEOUT=0), \
+                self.upstream(status_code=304, body=b"", headers=headers):
+            exchange = Exchange(self.app, self.path, headers=[
+                (b"if-none-match", b'"v0"'),
+                (b"if-modified-since", modified.encode())])
+        self.assertEqual(200, exchange.status)
+
+    def test_stale_copy_is_served_when_upstream_is_down(self):
+        with self.upstream():
+            Exchange(self.app, self.path)
+
+        def unreachable(request):
+            raise httpx.ConnectError("no route to host", request=request)
+
+        with self.settings(DATASET_CACHE_TIMEOUT=0), \
+                mock_upstream(unreachable):
+            exchange = Exchange(self.app, self.path)
+        self.assertEqual("stale", exchange.headers["x-dataset-cache"])
+        self.assertEqual(GEOJSON, exchange.body)
+
+    def test_unreachable_upstream_without_a_copy_is_502(self):
+        def unreachable(request):
+            raise httpx.ConnectError("no route to host", request=request)
+
+        with mock_upstream(unreachable):
+            exchange = Exchange(self.app, self.path)
+        self.assertEqual(502, exchange.status)
+
+    def test_upstream_errors_are_relayed_and_not_cached(self):
+        with self.upstream(status_code=404, body=b"gone"):
+            exchange = Exchange(self.app, self.path)
+        self.assertEqual(404, exchange.status)
+        self.assertIsNone(payload_cache().get(self.ds1))
+
+    def test_disconnect_does_not_stop_the_download(self):
+        closed = []
+
+        async def slow_body():
+            try:
+                yield GEOJSON[:10]
+                await asyncio.sleep(0.5)
+                yield GEOJSON[10:]
+            finally:
+                closed.append(True)
+
+        with self.upstream(body=slow_body()):
+            exchange = Exchange(self.app, self.path, disconnect_after=1)
+        self.assertEqual(GEOJSON[:10], exchange.body)
+        self.assertEqual([True], closed)
+        self.assertEqual(GEOJSON, payload_cache().get(self.ds1).read())
+
+    def test_flight_lands_once_the_file_is_cached(self):
+        waited = []
+
+        async def body():
+            yield GEOJSON[:10]
+            flight = payload_flight(payload_cache(), self.ds1)
+            waited.append(not flight.leader)
+            flight.land()
+            yield GEOJSON[10:]
+
+        with self.upstream(body=body()):
+            exchange = Exchange(self.app, self.path)
+        self.assertEqual(GEOJSON, exchange.body)
+        self.assertEqual([True], waited)
+        self.assertTrue(payload_flight(payload_cache(), self.ds1).leader)
+
+    def test_file_is_compressed_on_the_way_out(self):
+        with self.settings(DATASET_COMPRESS_MIN_BYTES=0), self.upstream():
+            exchange = Exchange(self.app, self.path,
+                                headers=[(b"accept-encoding", b"gzip")])
+        self.assertEqual("gzip", exchange.headers["content-encoding"])
+        self.assertEqual('"v1-gzip"', exchange.headers["etag"])
+        self.assertNotIn("content-length", exchange.headers)
+        self.assertEqual(GEOJSON, gzip.decompress(exchange.body))
+        self.assertEqual(GEOJSON, payload_cache().get(self.ds1).read())
+
+    def test_stale_copy_is_compressed_too(self):
+        with self.upstream():
+            Exchange(self.app, self.path)
+        with self.settings(DATASET_CACHE_TIMEOUT=0,
+                           DATASET_COMPRESS_MIN_BYTES=0), \
+                self.upstream(status_code=304, body=b"",
+                              headers={"ETag": '"v1"'}):
+            exchange = Exchange(self.app, self.path,
+                                headers=[(b"accept-encoding", b"gzip")])
+        self.assertEqual("revalidated", exchange.headers["x-dataset-cache"])
+        self.assertEqual("gzip", exchange.headers["content-encoding"])
+        self.assertEqual(GEOJSON, gzip.decompress(exchange.body))
+
+    def test_cache_is_written_outside_the_event_loop(self):
+        threads = []
+        write = Download.write
+
+        def spy(download, chunk):
+            threads.append(threading.current_thread())
+            return write(download, chunk)
+
+        with self.upstream(), mock.patch.object(Download, "write", spy):
+            exchange = Exchange(self.app, self.path)
+        self.assertEqual(GEOJSON, exchange.body)
+        self.assertTrue(threads)
+        self.assertNotIn(exchange.loop_thread, threads)
+
+
+class ThreadPoolWsgiTests(TestCase):
+
+    def test_requests_run_side_by_side_in_the_pool(self):
+        threads = []
+        closed = []
+
+        class Body(list):
+            def close(self):
+                closed.append(True)
+
+        def wsgi_app(environ, start_response):
+            threads.append(threading.current_thread())
+            time.sleep(0.3)
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            return Body([b"one ", b"two"])
+
+        app = ThreadPoolWsgi(wsgi_app, 2)
+        exchanges = []
+
+        async def both():
+            first = Exchange(app, "/a/", run=False)
+            second = Exchange(app, "/b/", run=False)
+            exchanges.extend([first, second])
+            await asyncio.gather(first.run(app), second.run(app))
+
+        started = time.time()
+        async_to_sync(both)()
+        self.assertLess(time.time() - started, 0.55)
+        self.assertEqual([b"one two"] * 2,
+                         [exchange.body for exchange in exchanges])
+        self.assertEqual(200, exchanges[0].status)
+        self.assertEqual([True, True], closed)
+        self.assertNotIn(exchanges[0].loop_thread, threads)
+
+
+class AsgiApplicationTests(TestCase):
+
+    def test_application_is_the_proxy_around_django(self):
+        from main.asgi import application
+        self.assertIsInstance(application, DatasetProxy)
+        self.assertIsInstance(application.app, ThreadPoolWsgi)
@@ -0,0 +1,199 @@
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from datasets.models import Dataset
+
+from keywords.models import Keyword
+
+from main.listing import decode_cursor, encode_cursor, keyset_page
+
+import json
+
+User = get_user_model()
+
+
+class KeysetPageTests(TestCase):
+
+    def setUp(self):
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+        for title in ("b", "a", "c", "a2", "d"):
+            Dataset.objects.create(account=self.u1.account, title=title,
+                                   url="https://example.com/x.geojson")
+        # titles can be empty in the database, those aren't listed
+        self.untitled = Dataset.objects.create(
+            account=self.u1.account, title="untitled",
+            url="https://example.com/x.geojson")
+        Dataset.objects.filter(pk=self.untitled.pk).update(title=None)
+
+    def titles(self, size):
+        seen = []
+        cursor = None
+        while True:
+            page, cursor = keyset_page(Dataset.objects.all(),
+                                       ("title", "pk"), cursor, size)
+            seen.append([dataset.title for dataset in page])
+            if cursor is None:
+                return seen
+
+    def test_pages_follow_each_other(self):
+        self.assertEqual([["a", "a2"], ["b", "c"], ["d"]], self.titles(2))
+
+    def test_last_page_has_no_cursor(self):
+        self.assertEqual([["a", "a2", "b", "c", "d"]], self.titles(5))
+
+    def test_rows_added_before_the_cursor_dont_shift_the_next_page(self):
+        page, cursor = keyset_page(Dataset.objects.all(), ("title", "pk"),
+                                   None, 3)
+        Dataset.objects.create(account=self.u1.account, title="a1",
+                               url="https://example.com/x.geojson")
+        page, cursor = keyset_page(Dataset.objects.all(), ("title", "pk"),
+                                   cursor, 3)
+        self.assertEqual(["c", "d"], [dataset.title for dataset in page])
+
+    def test_same_titles_are_told_apart_by_pk(self):
+        u2 = User.objects.create_user(username="other", password="password")
+        Dataset.objects.create(account=u2.account, title="b",
+                               url="https://example.com/x.geojson")
+        seen = sum(self.titles(1), [])
+        self.assertEqual(2, seen.count("b"))
+        self.assertEqual(6, len(seen))
+
+    def test_broken_cursor_is_a_value_error(self):
+        for cursor in ("abc", encode_cursor([1]), encode_cursor({"a": 1})):
+            with self.assertRaises(ValueError):
+                keyset_page(Dataset.objects.all(), ("title", "pk"), cursor)
+
+
+    def test_next_page_is_a_row_value_comparison(self):
+        page, cursor = keyset_page(Dataset.objects.all(), ("title", "pk"),
+                                   None, 2)
+        with CaptureQueriesContext(connection) as queries:
+            keyset_page(Dataset.objects.all(), ("title", "pk"), cursor, 2)
+        self.assertIn('("datasets_dataset"."title", "datasets_dataset"."id")'
+                      ' > (', queries[0]["sql"])
+
+    def test_descending_fields_page_too(self):
+        seen = []
+        cursor = None
+        while True:
+            page, cursor = keyset_page(Dataset.objects.all(),
+                                       ("-title", "pk"), cursor, 2)
+            seen += [dataset.title for dataset in page]
+            if cursor is None:
+                break
+        self.assertEqual(["d", "c", "b", "a2", "a"], seen)
+
+    def test_cursor_round_trip(self):
+        self.assertEqual(["a", 1], decode_cursor(encode_cursor(["a", 1]), 2))
+
+    def test_cursor_only_holds_plain_values(self):
+        for values in ([None, 1], [["a"], 1], [True, 1]):
+            with self.assertRaises(ValueError):
+                decode_cursor(encode_cursor(values), 2)
+
+
+@override_settings(LISTING_PAGE_SIZE=2)
+class PagedViewTests(TestCase):
+
+    def setUp(self):
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+        self.k1 = Keyword.objects.create(keyword="reef")
+        for title in ("Atoll", "Bay", "Cove"):
+            dataset = Dataset.objects.create(
+                account=self.u1.account, title=title,
+                url="https://example.com/{}.geojson".format(title))
+            dataset.keywords.add(self.k1)
+        Dataset.objects.create(
+            account=self.u1.account, title="Delta",
+            url="https://example.com/delta.geojson",
+            dataset_user="user", dataset_password="password")
+
+    def titles(self, response):
+        return [dataset.title for dataset in response.context["dataset_list"]]
+
+    def test_portal_is_paged(self):
+        response = self.client.get("/")
+        self.assertEqual(["Atoll", "Bay"], self.titles(response))
+        self.assertContains(response, 'id="dataset-scroll-next"')
+        response = self.client.get("/?cursor=" +
+                                   response.context["next_cursor"])
+        self.assertEqual(["Cove", "Delta"], self.titles(response))
+        self.assertIsNone(response.context["next_cursor"])
+
+    def test_next_page_keeps_the_search(self):
+        response = self.client.get("/?q=test")
+        self.assertIn("q=test", response.context["next_query"])
+
+    def test_portal_as_json(self):
+        data = json.loads(self.client.get("/?format=json").content
+                          .decode("utf-8"))
+        self.assertEqual(["Atoll", "Bay"],
+                         [result["title"] for result in data["results"]])
+        self.assertEqual("https://example.com/Atoll.geojson",
+                         data["results"][0]["url"])
+        data = json.loads(self.client.get(
+            "/?format=json&cursor=" + data["next"]).content.decode("utf-8"))
+        self.assertEqual(["Cove", "Delta"],
+                         [result["title"] for result in data["results"]])
+        self.assertNotIn("url", data["results"][1])
+        self.assertEqual("/test_user/delta/", data["results"][1]["page"])
+        self.assertIsNone(data["next"])
+
+    def test_account_detail_is_paged(self):
+        response = self.client.get("/test_user/")
+        self.assertEqual(["Atoll", "Bay"], self.titles(response))
+
+    def test_keyword_detail_is_paged(self):
+        response = self.client.get(self.k1.get_absolute_url())
+        self.assertEqual(["Atoll", "Bay"], self.titles(response))
+        response = self.client.get(self.k1.get_absolute_url() + "?cursor=" +
+                                   response.context["next_cursor"])
+        self.assertEqual(["Cove"], self.titles(response))
+
+    def test_account_list_is_paged(self):
+        for name in ("anna", "bert"):
+            User.objects.create_user(username=name, password="password")
+        response = self.client.get("/accounts/")
+        self.assertEqual(["anna", "bert"],
+                         [str(account) for account in
+                          response.context["account_list"]])
+        response = self.client.get("/accounts/?" +
+                                   response.context["next_query"])
+        self.assertEqual(["test_user"],
+                         [str(account) for account in
+                          response.context["account_list"]])
+
+    def test_search_results_are_paged_by_rank(self):
+        for title in ("Lagoon", "Lagoon lagoon", "Lagoon lagoon lagoon"):
+            Dataset.objects.create(
+                account=self.u1.account, title=title,
+                url="https://example.com/x.geojson")
+        seen = []
+        query = "q=lagoon"
+        while query is not None:
+            response = self.client.get("/?" + query)
+            seen.append(self.titles(response))
+            query = response.context["next_query"]
+        self.assertEqual(2, len(seen))
+        self.assertEqual(["Lagoon", "Lagoon lagoon", "Lagoon lagoon lagoon"],
+                         sorted(sum(seen, [])))
+
+    def test_datasets_in_view_are_paged_by_overlap(self):
+        for i, (west, east) in enumerate(((0, 10), (0, 5), (0, 2), (0, 1))):
+            Dataset.objects.filter(title=("Atoll", "Bay", "Cove",
+                                          "Delta")[i]).update(
+                bbox_west=west, bbox_south=0, bbox_east=east, bbox_north=10)
+        response = self.client.get("/?bbox=0,0,5,10")
+        self.assertEqual(["Bay", "Atoll"], self.titles(response))
+        response = self.client.get("/?" + response.context["next_query"])
+        self.assertEqual(["Cove", "Delta"], self.titles(response))
+        self.assertIsNone(response.context["next_cursor"])
+
+    def test_broken_cursor_is_a_bad_request(self):
+        for url in ("/?cursor=x", "/test_user/?cursor=x",
+                    "/accounts/?cursor=x"):
+            self.assertEqual(400, self.client.get(url).status_code)
@@ -1,17 +1,74 @@
 from django.contrib.auth import get_user_model
+from django.core.cache import caches
 from django.http import HttpRequest
-from django.test import TestCase
+from django.test import Client, TestCase, override_settings
 from django.urls import reverse
 
 from accounts.models import Account
 
+from datasets.access import forget as forget_access
+from datasets.autocomplete import forget as forget_autocomplete
+from datasets.cache import fetch_payload, payload_cache, payload_flight
+from datasets.cache import source_version
+from datasets.clusters import ClusterLevels
+from datasets.convert import features
+from datasets.downloads import current_download
 from datasets.models import Dataset
+from datasets.simplify import build_levels
+from datasets.singleflight import forget as forget_flights, solo
+from datasets.spatial import FeatureIndex, forget
+from datasets.upstream import PoolTimeout
 
-from main.views import portal
+from main.views import load_index, portal, to_geojson
+
+from requests.structures import CaseInsensitiveDict
+from unittest import mock
+
+import gzip
+import hashlib
+import io
+import json
+import requests
+import shutil
+import tempfile
+import threading
 
 User = get_user_model()
 
 
+def fake_upstream(body, status_code=200, headers=None):
+    """
+    A real requests.Response that reads from memory, so the views can be
+    tested without going out to the internet.
+    """
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers = CaseInsensitiveDict(headers or {})
+    response.raw = io.BytesIO(body)
+    return response
+
+
+class TemporaryPayloadCacheMixin:
+    """
+    Every test gets its own empty payload cache directory, and nothing that
+    was built from the payloads of another test, or is still waiting for
+    one, is left in memory.
+    """
+
+    def setUp(self):
+        super().setUp()
+        forget()
+        forget_flights()
+        forget_access()
+        caches["default"].clear()
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, True)
+        cache_settings = self.settings(DATASET_CACHE_BACKEND="disk",
+                                       DATASET_CACHE_DIR=cache_dir)
+        cache_settings.enable()
+        self.addCleanup(cache_settings.disable)
+
+
 class AboutViewTests(TestCase):
     """
     This view is actually simply a TemplateView implemented in the urls section
@@ -134,13 +191,104 @@ class PortalViewTests(TestCase):
                          response.content.decode("utf-8"))
 
 
-class LoadDatasetTests(TestCase):
+class PortalExtentSearchTests(TestCase):
+
+    def setUp(self):
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+
+        self.ds1 = Dataset.objects.create(
+            account=self.u1.account, title="Weser Harbours",
+            url="https://example.com/harbours.geojson")
+        self.ds2 = Dataset.objects.create(
+            account=self.u1.account, title="World Ports",
+            url="https://example.com/ports.geojson")
+        self.ds3 = Dataset.objects.create(
+            account=self.u1.account, title="Sydney Harbour",
+            url="https://example.com/sydney.geojson")
+        for dataset, bbox in ((self.ds1, (8, 53, 9, 54)),
+                              (self.ds2, (-180, -90, 180, 90)),
+                              (self.ds3, (150, -34, 152, -33))):
+            Dataset.objects.filter(pk=dataset.pk).update(
+                bbox_west=bbox[0], bbox_south=bbox[1],
+                bbox_east=bbox[2], bbox_north=bbox[3])
+
+    def test_datasets_in_view_are_listed_best_fit_first(self):
+        response = self.client.get("/?bbox=7,52,10,55")
+        self.assertEqual(["Weser Harbours", "World Ports"],
+                         [dataset.title for dataset in
+                          response.context["dataset_list"]])
+
+    def test_extent_and_text_search_together(self):
+        response = self.client.get("/?bbox=7,52,10,55&q=port")
+        self.assertEqual(["World Ports"],
+                         [dataset.title for dataset in
+                          response.context["dataset_list"]])
+        self.assertIn('name="bbox" type="hidden" value="7,52,10,55"',
+                      response.content.decode("utf-8"))
+
+    def test_empty_bbox_is_no_filter(self):
+        response = self.client.get("/?bbox=")
+        self.assertEqual(3, len(response.context["dataset_list"]))
+
+    def test_broken_bbox_is_a_bad_request(self):
+        response = self.client.get("/?bbox=1,2,3")
+        self.assertEqual(400, response.status_code)
+
+
+class AutocompleteTests(TestCase):
+
+    def setUp(self):
+        forget_autocomplete()
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+        for i in range(12):
+            Dataset.objects.create(
+                account=self.u1.account, title="Reef survey {}".format(i),
+                url="https://example.com/reef{}.geojson".format(i))
+
+    def test_suggestions_come_back_as_json(self):
+        response = self.client.get("/autocomplete/?q=reef+survey+1&limit=3")
+        data = json.loads(response.content.decode("utf-8"))
+        self.assertEqual("application/json", response["Content-Type"])
+        self.assertEqual(["Reef survey 1", "Reef survey 10",
+                          "Reef survey 11"],
+                         [result["text"] for result in data["results"]])
+        self.assertEqual("dataset", data["results"][0]["type"])
+        self.assertEqual("/test_user/reef-survey-1/",
+                         data["results"][0]["url"])
+
+    def test_next_page_goes_on_where_the_first_stopped(self):
+        first = json.loads(self.client.get(
+            "/autocomplete/?q=reef").content.decode("utf-8"))
+        second = json.loads(self.client.get(
+            "/autocomplete/?q=reef&cursor=" + first["next"])
+            .content.decode("utf-8"))
+        self.assertEqual(10, len(first["results"]))
+        self.assertEqual(2, len(second["results"]))
+        self.assertIsNone(second["next"])
+        self.assertEqual(12, len({result["id"] for result in
+                                  first["results"] + second["results"]}))
+
+    def test_broken_limit_or_cursor_is_a_bad_request(self):
+        for query in ("limit=0", "limit=x", "limit=1000", "cursor=abc"):
+            response = self.client.get("/autocomplete/?q=reef&" + query)
+            self.assertEqual(400, response.status_code)
+
+    def test_search_box_knows_where_to_ask(self):
+        response = self.client.get(reverse("portal"))
+        self.assertIn('data-autocomplete="/autocomplete/"',
+                      response.content.decode("utf-8"))
+
+
+class LoadDatasetTests(TemporaryPayloadCacheMixin, TestCase):
     """
     This is what I really need to be testing. It's a bit more complex than
     the other code. It is now NOT USED for non-protected datasets.
     """
 
     def setUp(self):
+        super().setUp()
         self.u1 = User.objects.create_user(
             username="test_user", password="test_password")
 
@@ -178,3 +326,946 @@ class LoadDatasetTests(TestCase):
 
 
     # There needs to be one for owncloud now
+
+
+GEOJSON = (b'{"type": "FeatureCollection", "features": [{"type": "Feature", '
+           b'"properties": {}, "geometry": {"type": "Point", '
+           b'"coordinates": [8.8, 53.1]}}]}')
+
+
+class LoadDatasetStreamingTests(TemporaryPayloadCacheMixin, TestCase):
+    """
+    Same dataset as above, but the upstream server is faked.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+
+        self.ds2 = Dataset.objects.create(
+            account=self.u1.account,
+            author="zmtdummy",
+            title="Password Protected Dataset",
+            url="https://example.com/password_protected_dataset.json",
+            dataset_user="zmtdummy",
+            dataset_password="zmtBremen1991",
+            public_access=False)
+
+        self.url = reverse("load_dataset", kwargs={"pk": self.ds2.pk})
+
+    def upstream(self, body, headers):
+        return mock.patch("requests.Session.request",
+                          return_value=fake_upstream(body, headers=headers))
+
+    def test_load_dataset_sends_decrypted_credentials_upstream(self):
+        with self.upstream(GEOJSON, {}) as request:
+            self.client.get(self.url)
+        self.assertEqual(("zmtdummy", "zmtBremen1991"),
+                         request.call_args[1]["auth"])
+
+    def test_small_dataset_is_returned_whole(self):
+        headers = {"Content-Type": "application/geo+json",
+                   "Content-Length": str(len(GEOJSON))}
+        with self.upstream(GEOJSON, headers):
+            response = self.client.get(self.url)
+        self.assertFalse(response.streaming)
+        self.assertEqual(GEOJSON, response.content)
+        self.assertEqual("application/geo+json", response["Content-Type"])
+
+    @override_settings(DATASET_STREAM_THRESHOLD=10, DATASET_CHUNK_SIZE=16)
+    def test_large_dataset_is_streamed_in_chunks(self):
+        headers = {"Content-Type": "application/geo+json",
+                   "Content-Length": str(len(GEOJSON))}
+        with self.upstream(GEOJSON, headers):
+            response = self.client.get(self.url)
+        chunks = list(response.streaming_content)
+        self.assertTrue(response.streaming)
+        self.assertTrue(all(len(chunk) <= 16 for chunk in chunks))
+        self.assertEqual(GEOJSON, b"".join(chunks))
+        self.assertEqual(str(len(GEOJSON)), response["Content-Length"])
+
+    @override_settings(DATASET_STREAM_THRESHOLD=10, DATASET_CHUNK_SIZE=16)
+    def test_dataset_without_content_length_is_streamed(self):
+        with self.upstream(GEOJSON, {"Content-Encoding": "gzip"}):
+            response = self.client.get(self.url)
+        self.assertTrue(response.streaming)
+        self.assertFalse(response.has_header("Content-Length"))
+        self.assertEqual(GEOJSON, b"".join(response.streaming_content))
+
+    def test_small_dataset_without_content_length_is_returned_whole(self):
+        with self.upstream(GEOJSON, {}):
+            response = self.client.get(self.url)
+        self.assertFalse(response.streaming)
+        self.assertEqual(GEOJSON, response.content)
+
+    def test_load_dataset_404s_for_missing_dataset(self):
+        response = self.client.get(reverse("load_dataset",
+                                   kwargs={"pk": self.ds2.pk + 1}))
+        self.assertEqual(404, response.status_code)
+
+
+class LoadDatasetCacheTests(TemporaryPayloadCacheMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+
+        self.ds2 = Dataset.objects.create(
+            account=self.u1.account,
+            author="zmtdummy",
+            title="Password Protected Dataset",
+            url="https://example.com/password_protected_dataset.json",
+            dataset_user="zmtdummy",
+            dataset_password="zmtBremen1991",
+            public_access=False)
+
+        self.url = reverse("load_dataset", kwargs={"pk": self.ds2.pk})
+
+    def upstream(self, body=GEOJSON, status_code=200):
+        return mock.patch(
+            "requests.Session.request",
+            side_effect=lambda *args, **kwargs: fake_upstream(
+                body, status_code=status_code,
+                headers={"Content-Type": "application/geo+json"}))
+
+    def test_second_request_is_served_from_the_cache(self):
+        with self.upstream() as request:
+            first = self.client.get(self.url)
+            second = self.client.get(self.url)
+        self.assertEqual(1, request.call_count)
+        self.assertEqual("miss", first["X-Dataset-Cache"])
+        self.assertEqual("hit", second["X-Dataset-Cache"])
+        self.assertEqual(GEOJSON, second.content)
+        self.assertEqual("application/geo+json", second["Content-Type"])
+
+    @override_settings(DATASET_STREAM_THRESHOLD=10)
+    def test_streamed_dataset_is_cached_once_it_was_read_completely(self):
+        with self.upstream() as request:
+            b"".join(self.client.get(self.url).streaming_content)
+            response = self.client.get(self.url)
+        self.assertEqual(1, request.call_count)
+        self.assertEqual(GEOJSON, b"".join(response.streaming_content))
+        self.assertEqual(str(len(GEOJSON)), response["Content-Length"])
+
+    def test_upstream_errors_are_not_cached(self):
+        with self.upstream(b"nope", status_code=500) as request:
+            self.client.get(self.url)
+            response = self.client.get(self.url)
+        self.assertEqual(2, request.call_count)
+        self.assertEqual(500, response.status_code)
+
+    def test_changing_the_url_invalidates_the_cache(self):
+        with self.upstream() as request:
+            self.client.get(self.url)
+            self.ds2.url = "https://example.com/another_dataset.json"
+            self.ds2.save(update_fields=["url"])
+            response = self.client.get(self.url)
+        self.assertEqual(2, request.call_count)
+        self.assertEqual("miss", response["X-Dataset-Cache"])
+
+    def test_changing_the_description_keeps_the_cache(self):
+        with self.upstream() as request:
+            self.client.get(self.url)
+            self.ds2.description = "still the same file"
+            self.ds2.save(update_fields=["description"])
+            self.client.get(self.url)
+        self.assertEqual(1, request.call_count)
+
+    def test_full_save_without_source_changes_keeps_the_cache(self):
+        dataset = Dataset.objects.create(
+            account=self.u1.account,
+            author="zmtdummy",
+            title="Open Dataset",
+            url="https://example.com/open_dataset.json")
+        url = reverse("load_dataset", kwargs={"pk": dataset.pk})
+        with self.upstream() as request, \
+                mock.patch("datasets.models.run_in_background") as run:
+            self.client.get(url)
+            dataset.description = "still the same file"
+            dataset.save()
+            self.client.get(url)
+            self.assertEqual(1, request.call_count)
+            run.assert_not_called()
+
+            dataset.url = "https://example.com/moved_dataset.json"
+            dataset.save()
+            response = self.client.get(url)
+        self.assertEqual(2, request.call_count)
+        self.assertEqual("miss", response["X-Dataset-Cache"])
+
+    def test_full_save_keeps_the_cache_of_a_protected_dataset(self):
+        with self.upstream() as request:
+            self.client.get(self.url)
+            self.ds2.description = "still the same file"
+            self.ds2.save()
+            self.client.get(self.url)
+            self.assertEqual(1, request.call_count)
+
+            self.ds2.dataset_password = "something else"
+            self.ds2.save()
+            response = self.client.get(self.url)
+        self.assertEqual(2, request.call_count)
+        self.assertEqual("miss", response["X-Dataset-Cache"])
+
+    def test_full_connection_pool_is_service_unavailable(self):
+        busy = PoolTimeout("pool is full")
+        with mock.patch("requests.Session.request", side_effect=busy):
+            response = self.client.get(self.url)
+        self.assertEqual(503, response.status_code)
+        self.assertIn("Retry-After", response)
+
+    def test_full_connection_pool_serves_the_stale_copy(self):
+        with self.upstream():
+            self.client.get(self.url)
+        busy = PoolTimeout("pool is full")
+        with self.settings(DATASET_CACHE_TIMEOUT=0), \
+                mock.patch("requests.Session.request", side_effect=busy):
+            response = self.client.get(self.url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("stale", response["X-Dataset-Cache"])
+
+    @override_settings(DATASET_CACHE_BACKEND=None)
+    def test_cache_can_be_switched_off(self):
+        with self.upstream() as request:
+            self.client.get(self.url)
+            self.client.get(self.url)
+        self.assertEqual(2, request.call_count)
+
+
+class LoadDatasetConditionalTests(TemporaryPayloadCacheMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+
+        self.ds2 = Dataset.objects.create(
+            account=self.u1.account,
+            author="zmtdummy",
+            title="Password Protected Dataset",
+            url="https://example.com/password_protected_dataset.json",
+            dataset_user="zmtdummy",
+            dataset_password="zmtBremen1991",
+            public_access=False)
+
+        self.url = reverse("load_dataset", kwargs={"pk": self.ds2.pk})
+        self.headers = {"Content-Type": "application/geo+json",
+                        "ETag": '"v1"',
+                        "Last-Modified": "Wed, 01 Aug 2018 10:00:00 GMT"}
+
+    def upstream(self, body=GEOJSON, status_code=200):
+        return mock.patch(
+            "requests.Session.request",
+            side_effect=lambda *args, **kwargs: fake_upstream(
+                body, status_code=status_code, headers=self.headers))
+
+    def test_upstream_validators_are_relayed(self):
+        with self.upstream():
+            response = self.client.get(self.url)
+        self.assertEqual('"v1"', response["ETag"])
+        self.assertEqual("Wed, 01 Aug 2018 10:00:00 GMT",
+                         response["Last-Modified"])
+
+    def test_matching_if_none_match_gets_304_from_the_cache(self):
+        with self.upstream():
+            self.client.get(self.url)
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH='"v1"')
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(b"", response.content)
+
+    def test_if_modified_since_gets_304_from_the_cache(self):
+        with self.upstream():
+            self.client.get(self.url)
+            response = self.client.get(
+                self.url,
+                HTTP_IF_MODIFIED_SINCE="Thu, 02 Aug 2018 10:00:00 GMT")
+        self.assertEqual(304, response.status_code)
+
+    def test_cached_payload_without_upstream_etag_gets_a_content_hash(self):
+        del self.headers["ETag"]
+        with self.upstream():
+            self.client.get(self.url)
+            etag = self.client.get(self.url)["ETag"]
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+
+    def test_stale_payload_is_revalidated_upstream(self):
+        with self.upstream():
+            self.client.get(self.url)
+        with self.settings(DATASET_CACHE_TIMEOUT=0), \
+                self.upstream(b"", status_code=304) as request:
+            response = self.client.get(self.url)
+        self.assertEqual('"v1"',
+                         request.call_args[1]["headers"]["If-None-Match"])
+        self.assertEqual("revalidated", response["X-Dataset-Cache"])
+        self.assertEqual(GEOJSON, response.content)
+
+    def test_stale_payload_is_served_when_upstream_is_down(self):
+        with self.upstream():
+            self.client.get(self.url)
+        with self.settings(DATASET_CACHE_TIMEOUT=0), \
+                self.upstream(b"oops", status_code=503):
+            response = self.client.get(self.url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("stale", response["X-Dataset-Cache"])
+        self.assertEqual(GEOJSON, response.content)
+
+    @override_settings(DATASET_CACHE_BACKEND=None)
+    def test_browser_validators_are_passed_upstream_without_a_cache(self):
+        with self.upstream(b"", status_code=304) as request:
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH='"v1"')
+        self.assertEqual('"v1"',
+                         request.call_args[1]["headers"]["If-None-Match"])
+        self.assertEqual(304, response.status_code)
+        self.assertEqual('"v1"', response["ETag"])
+
+
+class LoadDatasetConversionTests(TemporaryPayloadCacheMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+
+        self.ds1 = Dataset.objects.create(
+            account=self.u1.account,
+            author="zmtdummy",
+            title="Stations",
+            url="https://example.com/stations.csv")
+
+        self.url = reverse("load_dataset", kwargs={"pk": self.ds1.pk})
+        self.csv = b"station,lat,lon\nBremen,53.1,8.8\nSylt,54.9,8.3\n"
+
+    def upstream(self, body):
+        return mock.patch(
+            "requests.Session.request",
+            side_effect=lambda *args, **kwargs: fake_upstream(
+                body, headers={"Content-Type": "text/csv"}))
+
+    def test_csv_is_converted_to_geojson(self):
+        with self.upstream(self.csv):
+            response = self.client.get(self.url + "?format=geojson")
+        self.assertEqual("application/geo+json", response["Content-Type"])
+        collection = json.loads(response.content.decode("utf-8"))
+        self.assertEqual(2, len(collection["features"]))
+        self.assertEqual({"station": "Sylt"},
+                         collection["features"][1]["properties"])
+
+    def test_converted_file_is_cached(self):
+        with self.upstream(self.csv) as request, \
+                mock.patch("main.views.to_geojson",
+                           wraps=to_geojson) as convert:
+            first = self.client.get(self.url + "?format=geojson")
+            second = self.client.get(self.url + "?format=geojson")
+        self.assertEqual(1, request.call_count)
+        self.assertEqual(1, convert.call_count)
+        self.assertEqual("hit", second["X-Dataset-Cache"])
+        self.assertEqual(first.content, second.content)
+
+    def test_conversion_is_redone_when_the_source_changed(self):
+        with self.upstream(self.csv):
+            self.client.get(self.url + "?format=geojson")
+        with self.settings(DATASET_CACHE_TIMEOUT=0), \
+                self.upstream(self.csv + b"Helgoland,54.2,7.9\n"):
+            response = self.client.get(self.url + "?format=geojson")
+        collection = json.loads(response.content.decode("utf-8"))
+        self.assertEqual(3, len(collection["features"]))
+
+    def test_raw_file_is_still_available(self):
+        with self.upstream(self.csv):
+            response = self.client.get(self.url)
+        self.assertEqual(self.csv, response.content)
+
+    def test_file_that_cannot_be_converted_gives_422(self):
+        with self.upstream(b"name,depth\nBremen,12\n"):
+            response = self.client.get(self.url + "?format=geojson")
+        self.assertEqual(422, response.status_code)
+
+    def test_upstream_error_gives_502(self):
+        with mock.patch("requests.Session.request",
+                        return_value=fake_upstream(b"", status_code=404)):
+            response = self.client.get(self.url + "?format=geojson")
+        self.assertEqual(502, response.status_code)
+
+
+class DatasetTileTests(TemporaryPayloadCacheMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+
+        self.ds1 = Dataset.objects.create(
+            account=self.u1.account,
+            author="zmtdummy",
+            title="Stations",
+            url="https://example.com/stations.csv")
+
+        self.csv = (b"station,lat,lon\n"
+                    b"Bremen,53.1,8.8\n"
+                    b"Sydney,-33.9,151.2\n"
+                    b"Rio,-22.9,-43.2\n")
+
+    def tile(self, z, x, y):
+        return self.client.get(reverse(
+            "dataset_tile",
+            kwargs={"pk": self.ds1.pk, "z": z, "x": x, "y": y}))
+
+    def upstream(self):
+        return mock.patch(
+            "requests.Session.request",
+            side_effect=lambda *args, **kwargs: fake_upstream(
+                self.csv, headers={"Content-Type": "text/csv"}))
+
+    def stations(self, response):
+        collection = json.loads(response.content.decode("utf-8"))
+        return [feature["properties"]["station"]
+                for feature in collection["features"]]
+
+    def test_tile_url_resolves(self):
+        self.assertEqual("/tiles/1/2/3/4/", reverse(
+            "dataset_tile", kwargs={"pk": 1, "z": 2, "x": 3, "y": 4}))
+
+    def test_world_tile_has_every_feature(self):
+        with self.upstream():
+            response = self.tile(0, 0, 0)
+        self.assertEqual("application/geo+json", response["Content-Type"])
+        self.assertEqual(["Bremen", "Sydney", "Rio"], self.stations(response))
+
+    def test_tile_only_has_its_own_features(self):
+        with self.upstream():
+            self.assertEqual(["Bremen"], self.stations(self.tile(1, 1, 0)))
+            self.assertEqual(["Sydney"], self.stations(self.tile(1, 1, 1)))
+            self.assertEqual(["Rio"], self.stations(self.tile(1, 0, 1)))
+            self.assertEqual([], self.stations(self.tile(1, 0, 0)))
+
+    def test_tiles_are_cached(self):
+        with self.upstream() as request, \
+                mock.patch("main.views.load_index",
+                           wraps=load_index) as index:
+            self.tile(1, 1, 0)
+            response = self.tile(1, 1, 0)
+            self.tile(1, 0, 1)
+        self.assertEqual(1, request.call_count)
+        self.assertEqual(2, index.call_count)
+        self.assertEqual("hit", response["X-Dataset-Cache"])
+
+    def test_empty_tiles_are_not_cached(self):
+        with self.upstream():
+            self.tile(1, 0, 0)
+            self.tile(8, 0, 0)
+        cache = payload_cache()
+        self.assertIsNone(cache.get(self.ds1, "tile.1.0.0", stale=True))
+        self.assertIsNone(cache.get(self.ds1, "tile.8.0.0", stale=True))
+        self.assertIsNotNone(cache.get(self.ds1, "index", stale=True))
+
+    def test_tile_outside_the_zoom_level_is_404(self):
+        self.assertEqual(404, self.tile(1, 2, 0).status_code)
+
+
+class LoadDatasetBboxTests(TemporaryPayloadCacheMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+
+        self.ds1 = Dataset.objects.create(
+            account=self.u1.account,
+            author="zmtdummy",
+            title="Harbours",
+            url="https://example.com/harbours.geojson")
+
+        self.url = reverse("load_dataset", kwargs={"pk": self.ds1.pk})
+        self.geojson = json.dumps({"type": "FeatureCollection", "features": [
+            {"type": "Feature", "properties": {"name": "Bremerhaven"},
+             "geometry": {"type": "Point", "coordinates": [8.58, 53.54]}},
+            {"type": "Feature", "properties": {"name": "Hamburg"},
+             "geometry": {"type": "Point", "coordinates": [9.97, 53.54]}},
+            {"type": "Feature", "properties": {"name": "Weser"},
+             "geometry": {"type": "LineString",
+                          "coordinates": [[8.5, 53.6], [8.8, 53.1]]}},
+        ]}).encode("utf-8")
+
+    def upstream(self):
+        return mock.patch(
+            "requests.Session.request",
+            side_effect=lambda *args, **kwargs: fake_upstream(
+                self.geojson,
+                headers={"Content-Type": "application/geo+json"}))
+
+    def names(self, response):
+        collection = json.loads(response.content.decode("utf-8"))
+        return [feature["properties"]["name"]
+                for feature in collection["features"]]
+
+    def test_only_features_in_the_bbox_come_back(self):
+        with self.upstream():
+            response = self.client.get(self.url + "?bbox=8.5,53.5,8.7,53.6")
+        self.assertEqual(["Bremerhaven", "Weser"], self.names(response))
+
+    def test_every_feature_in_a_big_bbox(self):
+        with self.upstream():
+            response = self.client.get(self.url + "?bbox=-180,-90,180,90")
+        self.assertEqual(["Bremerhaven", "Hamburg", "Weser"],
+                         self.names(response))
+
+    def test_index_is_only_built_once(self):
+        with self.upstream() as request, \
+                mock.patch("datasets.spatial.FeatureIndex.build",
+                           wraps=FeatureIndex.build) as build:
+            self.client.get(self.url + "?bbox=8.5,53.5,8.7,53.6")
+            self.client.get(self.url + "?bbox=9,53,10,54")
+        self.assertEqual(1, request.call_count)
+        self.assertEqual(1, build.call_count)
+
+    def test_index_is_read_back_from_the_cache(self):
+        with self.upstream():
+            self.client.get(self.url + "?bbox=8.5,53.5,8.7,53.6")
+        forget()
+        with self.upstream(), \
+                mock.patch("datasets.spatial.FeatureIndex.build",
+                           wraps=FeatureIndex.build) as build:
+            response = self.client.get(self.url + "?bbox=8.5,53.5,8.7,53.6")
+        self.assertFalse(build.called)
+        self.assertEqual(["Bremerhaven", "Weser"], self.names(response))
+
+    def test_broken_bbox_is_a_bad_request(self):
+        for bbox in ("1,2,3", "a,b,c,d", "10,0,0,10", "nan,0,1,1"):
+            response = self.client.get(self.url + "?bbox=" + bbox)
+            self.assertEqual(400, response.status_code)
+
+
+class WithinPolygonTests(TemporaryPayloadCacheMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+
+        self.ds1 = Dataset.objects.create(
+            account=self.u1.account,
+            author="zmtdummy",
+            title="Stations",
+            url="https://example.com/stations.csv")
+
+        self.url = reverse("within_polygon", kwargs={"pk": self.ds1.pk})
+        self.csv = (b"station,lat,lon\n"
+                    b"Bremen,53.1,8.8\n"
+                    b"Bremerhaven,53.5,8.6\n"
+                    b"Sydney,-33.9,151.2\n")
+        self.polygon = {"type": "Polygon", "coordinates": [
+            [[8, 53], [9, 53], [9, 53.3], [8, 53.3], [8, 53]]]}
+
+    def upstream(self):
+        return mock.patch(
+            "requests.Session.request",
+            side_effect=lambda *args, **kwargs: fake_upstream(
+                self.csv, headers={"Content-Type": "text/csv"}))
+
+    def post(self, data):
+        return self.client.post(self.url, data=data,
+                                content_type="application/json")
+
+    def test_only_features_in_the_polygon_come_back(self):
+        with self.upstream():
+            response = self.post(json.dumps(self.polygon))
+        collection = json.loads(response.content.decode("utf-8"))
+        self.assertEqual(["Bremen"], [feature["properties"]["station"]
+                                      for feature in collection["features"]])
+
+    def test_works_without_a_csrf_token(self):
+        client = Client(enforce_csrf_checks=True)
+        with self.upstream():
+            response = client.post(self.url, data=json.dumps(self.polygon),
+                                   content_type="application/json")
+        self.assertEqual(200, response.status_code)
+
+    def test_get_is_not_allowed(self):
+        self.assertEqual(405, self.client.get(self.url).status_code)
+
+    def test_broken_polygon_is_a_bad_request(self):
+        self.assertEqual(400, self.post("not json").status_code)
+        self.assertEqual(400, self.post(json.dumps(
+            {"type": "Point", "coordinates": [1, 2]})).status_code)
+
+
+@override_settings(DATASET_SIMPLIFY_ZOOMS=(3, 12))
+class LoadDatasetSimplifiedTests(TemporaryPayloadCacheMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+
+        self.ds1 = Dataset.objects.create(
+            account=self.u1.account,
+            author="zmtdummy",
+            title="Weser",
+            url="https://example.com/weser.geojson")
+
+        self.url = reverse("load_dataset", kwargs={"pk": self.ds1.pk})
+        # a river that wiggles by about 100m, every 1km
+        self.coordinates = [[8.5 + i * 0.01, 53.0 + (i % 2) * 0.001]
+                            for i in range(50)]
+        self.geojson = json.dumps({"type": "FeatureCollection", "features": [
+            {"type": "Feature", "properties": {"name": "Weser"},
+             "geometry": {"type": "LineString",
+                          "coordinates": self.coordinates}}]}).encode("utf-8")
+
+    def upstream(self):
+        return mock.patch(
+            "requests.Session.request",
+            side_effect=lambda *args, **kwargs: fake_upstream(
+                self.geojson,
+                headers={"Content-Type": "application/geo+json"}))
+
+    def line(self, response):
+        collection = json.loads(response.content.decode("utf-8"))
+        return collection["features"][0]["geometry"]["coordinates"]
+
+    def test_zoomed_out_gets_a_simplified_line(self):
+        with self.upstream():
+            response = self.client.get(self.url + "?zoom=2")
+        self.assertEqual("application/geo+json", response["Content-Type"])
+        self.assertEqual(2, len(self.line(response)))
+
+    def test_zoomed_in_keeps_the_wiggles(self):
+        with self.upstream():
+            response = self.client.get(self.url + "?zoom=12")
+        self.assertEqual(50, len(self.line(response)))
+
+    def test_beyond_the_last_level_gets_the_original_file(self):
+        with self.upstream():
+            response = self.client.get(self.url + "?zoom=18")
+        self.assertEqual(self.geojson, response.content)
+
+    def test_tolerance_picks_a_level(self):
+        with self.upstream():
+            response = self.client.get(self.url + "?tolerance=0.5")
+        self.assertEqual(2, len(self.line(response)))
+
+    def test_levels_are_cached(self):
+        with self.upstream() as request:
+            self.client.get(self.url + "?zoom=2")
+            response = self.client.get(self.url + "?zoom=3")
+        self.assertEqual(1, request.call_count)
+        self.assertEqual("hit", response["X-Dataset-Cache"])
+
+    def test_levels_are_built_by_the_background_job(self):
+        with self.upstream() as request:
+            build_levels(self.ds1.pk)
+            self.client.get(self.url + "?zoom=3")
+            response = self.client.get(self.url + "?zoom=12")
+        self.assertEqual(1, request.call_count)
+        self.assertEqual("hit", response["X-Dataset-Cache"])
+
+    def test_background_job_reads_the_file_once(self):
+        with self.upstream(), \
+                mock.patch("datasets.simplify.features",
+                           wraps=features) as read:
+            build_levels(self.ds1.pk)
+        self.assertEqual(1, read.call_count)
+        for zoom in (3, 12):
+            self.assertIsNotNone(payload_cache().get(
+                self.ds1, "simplified.{}".format(zoom)))
+
+    def test_points_get_no_levels(self):
+        self.geojson = json.dumps({"type": "FeatureCollection", "features": [
+            {"type": "Feature", "properties": {},
+             "geometry": {"type": "Point", "coordinates": [8.8, 53.1]}}]
+        }).encode("utf-8")
+        with self.upstream():
+            build_levels(self.ds1.pk)
+        self.assertIsNone(payload_cache().get(self.ds1, "simplified.3"))
+
+    def test_harvested_points_are_not_read_at_all(self):
+        Dataset.objects.filter(pk=self.ds1.pk).update(
+            geometry_types="MultiPoint,Point",
+            content_sha1=hashlib.sha1(self.geojson).hexdigest())
+        with self.upstream(), \
+                mock.patch("datasets.simplify.features",
+                           wraps=features) as read:
+            build_levels(self.ds1.pk)
+        self.assertFalse(read.called)
+
+    def test_csv_is_the_same_file_at_every_zoom(self):
+        self.ds1.url = "https://example.com/stations.csv"
+        self.ds1.save()
+        self.geojson = b"station,lat,lon\nBremen,53.1,8.8\n"
+        with self.upstream():
+            for query in ("?zoom=3", "?zoom=12", "?zoom=18"):
+                response = self.client.get(self.url + query)
+                self.assertEqual(self.geojson, response.content)
+
+    def test_harvested_points_are_served_as_they_are(self):
+        Dataset.objects.filter(pk=self.ds1.pk).update(
+            geometry_types="Point")
+        with self.upstream(), \
+                mock.patch("datasets.simplify.features",
+                           wraps=features) as read:
+            response = self.client.get(self.url + "?zoom=3")
+        self.assertFalse(read.called)
+        self.assertEqual(self.geojson, response.content)
+        self.assertIsNone(payload_cache().get(self.ds1, "simplified.3"))
+
+    def test_saving_the_dataset_starts_the_background_job(self):
+        self.ds1.url = "https://example.com/moved.geojson"
+        with mock.patch("datasets.models.run_in_background") as run:
+            self.ds1.save()
+        run.assert_any_call(build_levels, self.ds1.pk)
+
+    def test_broken_zoom_is_a_bad_request(self):
+        for query in ("?zoom=a", "?zoom=-1", "?tolerance=x",
+                      "?tolerance=-1", "?tolerance=nan"):
+            response = self.client.get(self.url + query)
+            self.assertEqual(400, response.status_code)
+
+
+class DatasetClustersTests(TemporaryPayloadCacheMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+
+        self.ds1 = Dataset.objects.create(
+            account=self.u1.account,
+            author="zmtdummy",
+            title="Stations",
+            url="https://example.com/stations.csv")
+
+        self.csv = (b"station,lat,lon\n"
+                    b"Bremen,53.1,8.8\n"
+                    b"Bremen Nord,53.17,8.62\n"
+                    b"Sydney,-33.9,151.2\n")
+
+    def clusters(self, z, query=""):
+        return self.client.get(reverse(
+            "dataset_clusters", kwargs={"pk": self.ds1.pk, "z": z}) + query)
+
+    def upstream(self):
+        return mock.patch(
+            "requests.Session.request",
+            side_effect=lambda *args, **kwargs: fake_upstream(
+                self.csv, headers={"Content-Type": "text/csv"}))
+
+    def point_counts(self, response):
+        collection = json.loads(response.content.decode("utf-8"))
+        return sorted(feature["properties"].get("point_count", 1)
+                      for feature in collection["features"])
+
+    def test_zoomed_out_bremen_is_one_cluster(self):
+        with self.upstream():
+            response = self.clusters(3)
+        self.assertEqual([1, 2], self.point_counts(response))
+
+    def test_zoomed_in_every_station_is_on_its_own(self):
+        with self.upstream():
+            response = self.clusters(12)
+        self.assertEqual([1, 1, 1], self.point_counts(response))
+
+    def test_bbox_limits_the_clusters(self):
+        with self.upstream():
+            response = self.clusters(3, "?bbox=0,40,20,60")
+        self.assertEqual([2], self.point_counts(response))
+
+    def test_clusters_are_only_built_once(self):
+        with self.upstream() as request, \
+                mock.patch("datasets.clusters.ClusterLevels.build",
+                           wraps=ClusterLevels.build) as build:
+            self.clusters(3)
+            self.clusters(5)
+        self.assertEqual(1, request.call_count)
+        self.assertEqual(1, build.call_count)
+
+    def test_broken_bbox_is_a_bad_request(self):
+        self.assertEqual(400, self.clusters(3, "?bbox=1,2").status_code)
+
+    def test_zoom_beyond_the_tiles_is_404(self):
+        self.assertEqual(404, self.clusters(99).status_code)
+
+
+class LoadDatasetCoalescingTests(TemporaryPayloadCacheMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+
+        self.ds1 = Dataset.objects.create(
+            account=self.u1.account,
+            author="zmtdummy",
+            title="Harbours",
+            url="https://example.com/harbours.geojson")
+        self.url = reverse("load_dataset", kwargs={"pk": self.ds1.pk})
+
+    def upstream(self):
+        return mock.patch(
+            "requests.Session.request",
+            side_effect=lambda *args, **kwargs: fake_upstream(
+                GEOJSON, headers={"Content-Type": "application/geo+json"}))
+
+    def test_request_waits_for_the_download_in_flight(self):
+        # another request is downloading the file right now
+        leader = payload_flight(payload_cache(), self.ds1)
+
+        def download():
+            with self.upstream():
+                fetch_payload(self.ds1, payload_cache())
+            leader.land()
+
+        with mock.patch("datasets.cache.payload_flight",
+                        return_value=solo("test")):
+            threading.Timer(0.2, download).start()
+            with mock.patch("requests.Session.request") as request:
+                response = self.client.get(self.url)
+
+        self.assertEqual(0, request.call_count)
+        self.assertEqual("coalesced", response["X-Dataset-Cache"])
+        self.assertEqual(GEOJSON, response.content)
+
+    def test_streamed_download_goes_on_without_its_browser(self):
+        with self.settings(DATASET_STREAM_THRESHOLD=10), self.upstream():
+            response = self.client.get(self.url)
+            self.assertTrue(response.streaming)
+            download = current_download("{}.raw.{}".format(
+                self.ds1.pk, source_version(self.ds1)))
+            response.close()
+        if download is not None:
+            download.flight.event.wait(5)
+        self.assertEqual(GEOJSON, payload_cache().get(self.ds1).read())
+        self.assertTrue(payload_flight(payload_cache(), self.ds1).leader)
+
+    def test_requests_in_the_meantime_follow_the_download(self):
+        go_on = threading.Event()
+
+        class Trickle:
+            """
+            Upstream sends a bit of the file and then waits for go_on.
+            """
+            sent = 0
+
+            def read(self, size=-1):
+                if self.sent == 0:
+                    self.sent = 20
+                    return GEOJSON[:20]
+                go_on.wait(5)
+                chunk = GEOJSON[self.sent:]
+                self.sent = len(GEOJSON)
+                return chunk
+
+        def trickle(*args, **kwargs):
+            response = fake_upstream(b"", headers={
+                "Content-Type": "application/geo+json"})
+            response.raw = Trickle()
+            return response
+
+        with self.settings(DATASET_STREAM_THRESHOLD=10), \
+                mock.patch("requests.Session.request",
+                           side_effect=trickle) as request:
+            first = self.client.get(self.url)
+            second = self.client.get(self.url)
+            go_on.set()
+            first_body = b"".join(first.streaming_content)
+            second_body = b"".join(second.streaming_content)
+
+        self.assertEqual(1, request.call_count)
+        self.assertEqual("miss", first["X-Dataset-Cache"])
+        self.assertEqual("coalesced", second["X-Dataset-Cache"])
+        self.assertEqual(GEOJSON, first_body)
+        self.assertEqual(GEOJSON, second_body)
+        self.assertEqual(GEOJSON, payload_cache().get(self.ds1).read())
+
+    def test_failed_download_lands_too(self):
+        with mock.patch("requests.Session.request",
+                        side_effect=requests.ConnectionError):
+            with self.assertRaises(requests.ConnectionError):
+                self.client.get(self.url)
+        self.assertTrue(payload_flight(payload_cache(), self.ds1).leader)
+
+
+@override_settings(DATASET_COMPRESS_MIN_BYTES=0)
+class LoadDatasetCompressionTests(TemporaryPayloadCacheMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.u1 = User.objects.create_user(
+            username="test_user", password="test_password")
+        self.ds1 = Dataset.objects.create(
+            account=self.u1.account,
+            author="zmtdummy",
+            title="Harbours",
+            url="https://example.com/harbours.geojson",
+            dataset_user="zmtdummy",
+            dataset_password="zmtBremen1991")
+        self.url = reverse("load_dataset", kwargs={"pk": self.ds1.pk})
+
+    def upstream(self):
+        return mock.patch(
+            "requests.Session.request",
+            side_effect=lambda *args, **kwargs: fake_upstream(
+                GEOJSON, headers={"Content-Type": "application/geo+json",
+                                  "ETag": '"v1"'}))
+
+    def get(self, data=None, **headers):
+        response = self.client.get(self.url, data,
+                                   HTTP_ACCEPT_ENCODING="gzip", **headers)
+        if response.streaming:
+            return response, b"".join(response.streaming_content)
+        return response, response.content
+
+    def test_miss_is_compressed_and_cached_as_it_is(self):
+        with self.upstream():
+            response, body = self.get()
+        self.assertEqual("gzip", response["Content-Encoding"])
+        self.assertEqual('"v1-gzip"', response["ETag"])
+        self.assertIn("Accept-Encoding", response["Vary"])
+        self.assertEqual(GEOJSON, gzip.decompress(body))
+        self.assertEqual(GEOJSON, payload_cache().get(self.ds1).read())
+
+    def test_compressed_copy_is_kept(self):
+        with self.upstream():
+            self.get()
+            first, first_body = self.get()
+            with mock.patch("main.views.compressed_chunks") as compressing:
+                second, second_body = self.get()
+        compressing.assert_not_called()
+        self.assertEqual("hit", second["X-Dataset-Cache"])
+        self.assertEqual("gzip", second["Content-Encoding"])
+        self.assertEqual(first_body, second_body)
+        self.assertEqual(GEOJSON, gzip.decompress(second_body))
+        self.assertEqual(str(len(second_body)), second["Content-Length"])
+
+    def test_compressed_copy_answers_conditional_requests(self):
+        with self.upstream():
+            self.get()
+            response, body = self.get(HTTP_IF_NONE_MATCH='"v1-gzip"')
+        self.assertEqual(304, response.status_code)
+
+    def test_plain_file_without_accept_encoding(self):
+        with self.upstream():
+            self.get()
+            response = self.client.get(self.url)
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual('"v1"', response["ETag"])
+        self.assertEqual(GEOJSON, response.content)
+        self.assertIn("Accept-Encoding", response["Vary"])
+
+    @override_settings(DATASET_STREAM_THRESHOLD=10)
+    def test_streamed_files_are_compressed(self):
+        with self.upstream():
+            response, body = self.get()
+        self.assertTrue(response.streaming)
+        self.assertFalse(response.has_header("Content-Length"))
+        self.assertEqual(GEOJSON, gzip.decompress(body))
+        self.assertEqual(GEOJSON, payload_cache().get(self.ds1).read())
+
+    def test_built_files_are_compressed(self):
+        with self.upstream():
+            response, body = self.get({"bbox": "-180,-90,180,90"})
+        self.assertEqual("gzip", response["Content-Encoding"])
+        self.assertEqual("FeatureCollection",
+                         json.loads(gzip.decompress(body))["type"])